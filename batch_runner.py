@@ -0,0 +1,365 @@
+"""Offline batch-API execution (main.py --batch-mode).
+
+兩階段：先把所有 Structurizer 請求打包成一個 batch → 送出 → 輪詢 → 存進 table store，
+再對 Utilizer 請求做同樣的事。每個 batch ID (連同請求內容的雜湊) 記在 state 檔，中斷後
+以相同請求重跑會接續輪詢，不會重送；請求不同 (prompt 改了、多了列…) 就送新的 batch，
+結果收進來後該筆記錄即刪除。後端：OpenAI Batch API、Anthropic Message Batches、以及本機檔案模擬
+(LocalBatchBackend，用於離線測試整個流程)。
+"""
+import json
+import time
+import hashlib
+import uuid
+import pathlib
+from typing import Any, Dict, List, Optional, Tuple
+
+from structurizer import Structurizer
+from utilizer import Utilizer
+from utils.llm_cache import CachedLLM
+from utils.table_store import TableStore
+
+QUERY = "本案是否仍行國民法官審判？"
+MAX_TOKENS = 2048       # 與 llm(...) 預設值一致，快取 key 才能互通
+TERMINAL = {"completed", "failed", "expired", "cancelled"}
+
+
+def _wrap(content: str, model: str, finish_reason: Any = "stop") -> Dict[str, Any]:
+    """包成 Structurizer / Utilizer 使用的 OpenAI 相容格式。"""
+    return {
+        "choices": [{
+            "message": {"role": "assistant", "content": content},
+            "finish_reason": finish_reason,
+        }],
+        "model": model,
+    }
+
+
+# -----------------------------------------------------------------------------
+# Backends
+# -----------------------------------------------------------------------------
+
+class BatchBackend:
+    """submit → status → results。results 回傳 {custom_id: wrapped_response}。"""
+
+    def submit(self, requests: List[Dict[str, Any]], name: str) -> str:
+        raise NotImplementedError
+
+    def status(self, batch_id: str) -> Tuple[str, str]:
+        """→ (normalized status, 進度說明)。status ∈ TERMINAL 或 'in_progress'。"""
+        raise NotImplementedError
+
+    def results(self, batch_id: str) -> Dict[str, Dict[str, Any]]:
+        raise NotImplementedError
+
+    @staticmethod
+    def openai_line(req: Dict[str, Any]) -> Dict[str, Any]:
+        return {
+            "custom_id": req["custom_id"],
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": {
+                "model": req["model"],
+                "messages": req["messages"],
+                "temperature": req["temperature"],
+                "max_tokens": req["max_tokens"],
+            },
+        }
+
+    @staticmethod
+    def parse_openai_output(lines, model: str) -> Dict[str, Dict[str, Any]]:
+        out = {}
+        for line in lines:
+            if not line.strip():
+                continue
+            rec = json.loads(line)
+            resp = rec.get("response") or {}
+            if rec.get("error") or resp.get("status_code") != 200:
+                print(f"⚠️ batch item {rec['custom_id']} failed: {rec.get('error') or resp}")
+                continue
+            choice = resp["body"]["choices"][0]
+            out[rec["custom_id"]] = _wrap(choice["message"]["content"], model,
+                                          choice.get("finish_reason"))
+        return out
+
+
+class OpenAIBatchBackend(BatchBackend):
+    def __init__(self, client, model: str):
+        self.client = client          # openai.OpenAI
+        self.model = model
+
+    def submit(self, requests, name):
+        payload = "\n".join(json.dumps(self.openai_line(r), ensure_ascii=False)
+                            for r in requests)
+        f = self.client.files.create(file=(f"{name}.jsonl", payload.encode("utf-8")),
+                                     purpose="batch")
+        batch = self.client.batches.create(input_file_id=f.id,
+                                           endpoint="/v1/chat/completions",
+                                           completion_window="24h",
+                                           metadata={"name": name})
+        return batch.id
+
+    def status(self, batch_id):
+        b = self.client.batches.retrieve(batch_id)
+        counts = b.request_counts
+        progress = f"{counts.completed + counts.failed}/{counts.total}" if counts else ""
+        state = b.status if b.status in TERMINAL else "in_progress"
+        return state, progress
+
+    def results(self, batch_id):
+        b = self.client.batches.retrieve(batch_id)
+        if not b.output_file_id:
+            return {}
+        text = self.client.files.content(b.output_file_id).text
+        return self.parse_openai_output(text.splitlines(), self.model)
+
+
+class AnthropicBatchBackend(BatchBackend):
+    """Anthropic Message Batches (需 anthropic SDK >= MIN_SDK，才有 messages.batches)。"""
+
+    MIN_SDK = (0, 39)
+
+    def __init__(self, client, model: str):
+        if not hasattr(client.messages, "batches"):
+            raise RuntimeError("anthropic SDK 沒有 messages.batches；請升級到 "
+                               f">= {'.'.join(map(str, self.MIN_SDK))} 或改用 --batch_backend local")
+        self.client = client          # anthropic.Anthropic
+        self.model = model
+
+    def submit(self, requests, name):
+        from claude_api import split_system
+
+        items = []
+        for r in requests:
+            system, messages = split_system(r["messages"])
+            params = {
+                "model": r["model"],
+                "max_tokens": r["max_tokens"],
+                "temperature": r["temperature"],
+                "messages": messages,
+            }
+            if system:
+                params["system"] = system
+            items.append({"custom_id": r["custom_id"], "params": params})
+        batch = self.client.messages.batches.create(requests=items)
+        return batch.id
+
+    def status(self, batch_id):
+        b = self.client.messages.batches.retrieve(batch_id)
+        c = b.request_counts
+        done = c.succeeded + c.errored + c.canceled + c.expired
+        progress = f"{done}/{done + c.processing}"
+        return ("completed" if b.processing_status == "ended" else "in_progress"), progress
+
+    def results(self, batch_id):
+        out = {}
+        for entry in self.client.messages.batches.results(batch_id):
+            if entry.result.type != "succeeded":
+                print(f"⚠️ batch item {entry.custom_id} failed: {entry.result.type}")
+                continue
+            msg = entry.result.message
+            text = msg.content[0].text if msg.content else ""
+            out[entry.custom_id] = _wrap(text, self.model, msg.stop_reason)
+        return out
+
+
+class LocalBatchBackend(BatchBackend):
+    """本機檔案模擬：以 OpenAI batch JSONL 格式寫入 <root>/<batch_id>/，
+    第一次 status() 時用給定的 llm 逐筆執行並寫出 output.jsonl。
+    """
+
+    def __init__(self, root: str or pathlib.Path, llm, model: str = "local"):
+        self.root = pathlib.Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.llm = llm
+        self.model = model
+
+    def submit(self, requests, name):
+        batch_id = f"local_{name}_{uuid.uuid4().hex[:8]}"
+        d = self.root / batch_id
+        d.mkdir()
+        with open(d / "input.jsonl", "w", encoding="utf-8") as fw:
+            for r in requests:
+                fw.write(json.dumps(self.openai_line(r), ensure_ascii=False) + "\n")
+        (d / "status.json").write_text(json.dumps({"status": "validating"}))
+        return batch_id
+
+    def status(self, batch_id):
+        d = self.root / batch_id
+        state = json.loads((d / "status.json").read_text())["status"]
+        if state not in TERMINAL:
+            self._process(d)
+            state = "completed"
+        return state, ""
+
+    def _process(self, d: pathlib.Path) -> None:
+        with open(d / "input.jsonl", encoding="utf-8") as fr, \
+             open(d / "output.jsonl", "w", encoding="utf-8") as fw:
+            for line in fr:
+                req = json.loads(line)
+                body = req["body"]
+                try:
+                    resp = self.llm(body["messages"], temperature=body["temperature"],
+                                    max_tokens=body["max_tokens"])
+                    rec = {"custom_id": req["custom_id"], "error": None,
+                           "response": {"status_code": 200, "body": resp}}
+                except Exception as e:
+                    rec = {"custom_id": req["custom_id"], "error": str(e),
+                           "response": None}
+                fw.write(json.dumps(rec, ensure_ascii=False, default=str) + "\n")
+        (d / "status.json").write_text(json.dumps({"status": "completed"}))
+
+    def results(self, batch_id):
+        path = self.root / batch_id / "output.jsonl"
+        with open(path, encoding="utf-8") as fr:
+            return self.parse_openai_output(fr, self.model)
+
+
+def make_backend(llm_name: str, llm, model_name: str, batch_dir: pathlib.Path,
+                 backend: str = "auto") -> BatchBackend:
+    if backend == "local":
+        # 快取由 BatchRunner.run_phase 統一查詢 / 寫入；backend 拿未包快取的 client，
+        # 同一請求才不會查兩次、存兩次
+        while isinstance(llm, CachedLLM):
+            llm = llm.llm
+        return LocalBatchBackend(batch_dir / "local", llm, model_name)
+    if llm_name == "openai":
+        return OpenAIBatchBackend(llm.client, model_name)
+    if llm_name == "claude":
+        return AnthropicBatchBackend(llm.client, model_name)
+    raise ValueError(f"{llm_name} 沒有 batch API；請改用 --batch_backend local")
+
+
+# -----------------------------------------------------------------------------
+# Runner
+# -----------------------------------------------------------------------------
+
+class BatchRunner:
+    """兩階段 batch 流程；batch ID 存在 state_path，可中斷後接續。"""
+
+    def __init__(self, llm, backend: BatchBackend, model_name: str,
+                 store: TableStore, util_prompt: pathlib.Path,
+                 state_path: pathlib.Path, poll_interval: float = 60.0,
+                 vocab=None):
+        self.llm = llm
+        self.backend = backend
+        self.model_name = model_name
+        self.store = store
+        self.util_prompt = pathlib.Path(util_prompt)
+        self.state_path = pathlib.Path(state_path)
+        self.poll_interval = poll_interval
+        self.vocab = vocab                      # FactorVocab：每件 prompt 帶相關的既有欄名
+        self.tables: Dict[int, str] = {}       # run() 之後：idx → 表格 Markdown
+        self.state = (json.loads(self.state_path.read_text())
+                      if self.state_path.exists() else {})
+
+    def _save_state(self) -> None:
+        self.state_path.parent.mkdir(parents=True, exist_ok=True)
+        self.state_path.write_text(json.dumps(self.state, indent=2))
+
+    @staticmethod
+    def digest(requests: List[Dict[str, Any]]) -> str:
+        """請求 id + 內容的雜湊：只有完全相同的一批請求才能接續舊 batch。"""
+        blob = json.dumps(requests, ensure_ascii=False, sort_keys=True, default=str)
+        return hashlib.sha256(blob.encode("utf-8")).hexdigest()
+
+    def _request(self, custom_id: str, messages: List[Dict]) -> Dict[str, Any]:
+        return {"custom_id": custom_id, "model": self.model_name,
+                "messages": messages,
+                "temperature": 0.0, "max_tokens": MAX_TOKENS}
+
+    def run_phase(self, phase: str, requests: List[Dict[str, Any]],
+                  batch_id: Optional[str] = None) -> Dict[str, Dict[str, Any]]:
+        """送出 (或接續) 一個 batch，等它結束後回傳 {custom_id: response}。
+
+        若 llm 有快取 (CachedLLM)，先用快取剔除已完成的請求，結束後把新結果寫回快取。
+        """
+        lookup = getattr(self.llm, "lookup", None)
+        done: Dict[str, Dict[str, Any]] = {}
+        pending = []
+        for r in requests:
+            hit = lookup(r["messages"], r["temperature"], r["max_tokens"]) if lookup else None
+            if hit is not None:
+                done[r["custom_id"]] = hit
+            else:
+                pending.append(r)
+        print(f"[{phase}] {len(requests)} requests, {len(done)} from cache, {len(pending)} to batch")
+        if not pending:
+            return done
+
+        digest = self.digest(pending)
+        saved = self.state.get(phase)
+        if not batch_id and isinstance(saved, dict):
+            if saved.get("digest") == digest:
+                batch_id = saved["batch_id"]
+            else:
+                print(f"[{phase}] requests changed since batch {saved.get('batch_id')}; "
+                      "submitting a new batch")
+        if batch_id:                                # --*_batch_id 明確指定的一律接續
+            print(f"[{phase}] resume batch {batch_id}")
+        else:
+            batch_id = self.backend.submit(pending, name=f"{self.state_path.stem}_{phase}")
+            print(f"[{phase}] submitted batch {batch_id}")
+        self.state[phase] = {"batch_id": batch_id, "digest": digest}
+        self._save_state()
+
+        while True:
+            status, progress = self.backend.status(batch_id)
+            print(f"[{phase}] {batch_id}: {status} {progress}")
+            if status in TERMINAL:
+                break
+            time.sleep(self.poll_interval)
+        if status != "completed":
+            raise RuntimeError(f"batch {batch_id} ended with status {status}")
+
+        results = self.backend.results(batch_id)
+        store = getattr(self.llm, "store", None)
+        by_id = {r["custom_id"]: r for r in pending}
+        for cid, resp in results.items():
+            if store and cid in by_id:
+                r = by_id[cid]
+                store(resp, r["messages"], r["temperature"], r["max_tokens"])
+        done.update(results)
+        del self.state[phase]                   # 已收進來：之後的執行不可再接續這個 batch
+        self._save_state()
+        return done
+
+    def run(self, cases: List[Tuple[int, str, str]],
+            struct_batch_id: Optional[str] = None,
+            util_batch_id: Optional[str] = None) -> Dict[int, Tuple[Any, str]]:
+        """cases = [(idx, title, core_text)] → {idx: (verdict, reason)}。"""
+        # ---------- Phase 1: Structurizer ----------
+        # batch 每件只送一個請求：不分段建表 (key 也就與整篇建表的一致)
+        structurizer = Structurizer(self.llm, store=self.store, chunk_tokens=0)
+        tables = self.tables = {}
+        reqs, keys = [], {}
+        for idx, title, core in cases:
+            docs = [{"title": title, "document": core}]
+            keys[idx] = structurizer.table_key(docs)
+            table_md = structurizer.reuse(keys[idx], docs, idx)   # 內容相同的表格不再送 batch
+            if table_md is not None:
+                tables[idx] = table_md
+            else:
+                hints = self.vocab.relevant(core) if self.vocab is not None else None
+                reqs.append(self._request(f"struct-{idx}",
+                                          structurizer.compose_messages(docs, hints)))
+        responses = self.run_phase("structurize", reqs, struct_batch_id) if reqs else {}
+        for idx, title, _ in cases:
+            resp = responses.get(f"struct-{idx}")
+            if resp is not None:
+                tables[idx] = structurizer.save_response(resp, keys[idx], [{"title": title}])
+
+        # ---------- Phase 2: Utilizer ----------
+        utilizer = Utilizer(self.llm, prompt_path=str(self.util_prompt))
+        ready = [(idx, core) for idx, _, core in cases if idx in tables]
+        reqs = [self._request(f"util-{idx}", utilizer.compose_messages(
+                    QUERY, core, idx, table_md=tables[idx]))
+                for idx, core in ready]
+        replies = self.run_phase("utilize", reqs, util_batch_id)
+
+        verdicts = {}
+        for idx, _ in ready:
+            resp = replies.get(f"util-{idx}")
+            if resp is None:
+                continue
+            verdicts[idx] = utilizer.parse_reply(resp["choices"][0]["message"]["content"])
+        return verdicts
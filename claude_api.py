@@ -1,22 +1,56 @@
 # claude_api.py
 import os, anthropic
+from collections import Counter
+from utils.rate_limit import SCHEDULER, estimate_tokens
+from utils.hedging import timeout_kw
+from utils.tokens import get_counter
+
+
+def split_system(messages, cache_prefix=True):
+    """OpenAI 格式 → (system blocks, 其餘 messages)。
+
+    Claude 不接受 role=system 的 message，需改放 `system=`；靜態前綴加上
+    cache_control，後續呼叫只需付 cache read 的價格。
+    """
+    system = [{"type": "text", "text": m["content"]}
+              for m in messages if m.get("role") == "system"]
+    rest = [m for m in messages if m.get("role") != "system"]
+    if system and cache_prefix:
+        system[-1]["cache_control"] = {"type": "ephemeral"}
+    return system, rest
 
 class ClaudeAPI:
     """
     Mimic GeminiAPI / OpenAIAPI interface:
         llm(messages=[{"role":"user","content":"hi"}], temperature=0.7)
     and expose `self.response` for downstream code.
+    `await llm.acall(...)` is the asyncio twin of `llm(...)`.
     """
     def __init__(self, api_key: str or None = None,
-                 model_name: str = "claude-3-sonnet-20240229"):
+                 model_name: str = "claude-3-sonnet-20240229",
+                 base_url: str or None = None):
         api_key = api_key or os.getenv("ANTHROPIC_API_KEY")
         if not api_key:
             raise EnvironmentError("請先設定 ANTHROPIC_API_KEY")
-        self.client = anthropic.Anthropic(api_key=api_key)
+        self.api_key = api_key
+        # 重試交給共用 SCHEDULER，SDK 內建重試關閉以免疊加
+        # base_url：相容 server (mock_llm.py)；未給則用 ANTHROPIC_BASE_URL 或官方端點
+        self.base_url = base_url
+        self.client = anthropic.Anthropic(api_key=api_key, base_url=base_url, max_retries=0)
+        self._aclient = None          # AsyncAnthropic：第一次 acall 時才建立
         self.model_name = model_name
         self.response = None
         # token usage (optional)
         self.prompt_tokens = self.completion_tokens = self.total_tokens = 0
+        self.cached_prompt_tokens = self.cache_creation_tokens = 0
+        self.usage_totals = Counter()     # 整輪累計：prompt / cached / cache_creation / completion
+
+    @property
+    def aclient(self):
+        if self._aclient is None:
+            self._aclient = anthropic.AsyncAnthropic(api_key=self.api_key, base_url=self.base_url,
+                                                    max_retries=0)
+        return self._aclient
 
     def __call__(self, messages, temperature=0.7, max_tokens=2048, **kw):
         """
@@ -25,21 +59,139 @@ class ClaudeAPI:
         can keep the same code.
         """
         # Claude 要求每段 content 為 str；role 支援 system / user / assistant
-        resp = self.client.messages.create(
-            model=self.model_name,
-            max_tokens=max_tokens,
-            temperature=temperature,
-            messages=messages,
-            **kw
+        kw = self._with_system(messages, kw)
+        resp = SCHEDULER.call(
+            "claude", self.model_name,
+            lambda: self.client.messages.create(
+                model=self.model_name,
+                max_tokens=max_tokens,
+                temperature=temperature,
+                **timeout_kw(kw)
+            ),
+            cost=estimate_tokens(messages, max_tokens, self.model_name),
+        )
+        return self._wrap(resp, messages)
+
+    async def acall(self, messages, temperature=0.7, max_tokens=2048, **kw):
+        kw = self._with_system(messages, kw)
+        resp = await SCHEDULER.acall(
+            "claude", self.model_name,
+            lambda: self.aclient.messages.create(
+                model=self.model_name,
+                max_tokens=max_tokens,
+                temperature=temperature,
+                **timeout_kw(kw)
+            ),
+            cost=estimate_tokens(messages, max_tokens, self.model_name),
+        )
+        return self._wrap(resp, messages)
+
+    def stream(self, messages, temperature=0.7, max_tokens=2048, **kw):
+        """逐段 yield 文字 (text_delta)；提早 close() generator 即中斷串流。"""
+        kw = self._with_system(messages, kw)
+        resp = SCHEDULER.call(
+            "claude", self.model_name,
+            lambda: self.client.messages.create(
+                model=self.model_name,
+                max_tokens=max_tokens,
+                temperature=temperature,
+                stream=True,
+                **timeout_kw(kw)
+            ),
+            cost=estimate_tokens(messages, max_tokens, self.model_name),
+        )
+        usage, pieces = {}, []
+        try:
+            for event in resp:
+                self._collect_usage(event, usage)
+                if event.type == "content_block_delta" and event.delta.type == "text_delta":
+                    pieces.append(event.delta.text)
+                    yield event.delta.text
+        finally:
+            resp.close()
+            self._stream_usage(messages, usage, pieces)
+
+    async def astream(self, messages, temperature=0.7, max_tokens=2048, **kw):
+        kw = self._with_system(messages, kw)
+        resp = await SCHEDULER.acall(
+            "claude", self.model_name,
+            lambda: self.aclient.messages.create(
+                model=self.model_name,
+                max_tokens=max_tokens,
+                temperature=temperature,
+                stream=True,
+                **timeout_kw(kw)
+            ),
+            cost=estimate_tokens(messages, max_tokens, self.model_name),
         )
+        usage, pieces = {}, []
+        try:
+            async for event in resp:
+                self._collect_usage(event, usage)
+                if event.type == "content_block_delta" and event.delta.type == "text_delta":
+                    pieces.append(event.delta.text)
+                    yield event.delta.text
+        finally:
+            await resp.close()
+            self._stream_usage(messages, usage, pieces)
+
+    @staticmethod
+    def _with_system(messages, kw):
+        system, rest = split_system(messages)
+        kw = dict(kw, messages=rest)
+        if system:
+            kw["system"] = system
+            # 舊版 SDK / API 需 beta header 才會啟用 prompt caching
+            kw.setdefault("extra_headers", {"anthropic-beta": "prompt-caching-2024-07-31"})
+        return kw
+
+    def _record_usage(self, messages, input_tokens, output_tokens, cache_read=0,
+                      cache_write=0, measured=True) -> None:
+        # usage 計算：input_tokens 只含未命中快取的部分
+        self.cached_prompt_tokens  = cache_read
+        self.cache_creation_tokens = cache_write
+        self.prompt_tokens     = input_tokens + cache_read + cache_write
+        self.completion_tokens = output_tokens
+        self.total_tokens      = self.prompt_tokens + output_tokens
+        self.usage_totals.update(prompt=self.prompt_tokens, cached=cache_read,
+                                 cache_creation=cache_write,
+                                 completion=self.completion_tokens)
+        if measured:
+            get_counter(self.model_name).observe(messages, self.prompt_tokens)
+
+    @staticmethod
+    def _collect_usage(event, usage) -> None:
+        """message_start 帶輸入 (含快取) token，message_delta 帶累計的輸出 token。"""
+        if event.type == "message_start":
+            u = event.message.usage
+            usage.update(input_tokens=u.input_tokens,
+                         cache_read=getattr(u, "cache_read_input_tokens", 0) or 0,
+                         cache_write=getattr(u, "cache_creation_input_tokens", 0) or 0)
+        elif event.type == "message_delta" and getattr(event, "usage", None) is not None:
+            usage["output_tokens"] = event.usage.output_tokens
+
+    def _stream_usage(self, messages, usage, pieces) -> None:
+        """串流結束：有 message_start 就以實際 usage 記錄 (提早中斷時輸出 token 以已收到的
+        文字估算)；連 message_start 都沒收到才整筆估算，且不拿來校正估算器。"""
+        counter = get_counter(self.model_name)
+        output = usage.get("output_tokens")
+        if output is None:
+            output = counter.count("".join(pieces))
+        if "input_tokens" in usage:
+            self._record_usage(messages, usage["input_tokens"], output,
+                               usage["cache_read"], usage["cache_write"])
+        else:
+            self._record_usage(messages, counter.count_messages(messages), output,
+                               measured=False)
+
+    def _wrap(self, resp, messages=()):
         self.response = resp
         choice = resp.content[0].text if resp.content else ""
 
-        # usage 計算
         usage = resp.usage
-        self.prompt_tokens     = usage.input_tokens
-        self.completion_tokens = usage.output_tokens
-        self.total_tokens      = usage.input_tokens + usage.output_tokens
+        self._record_usage(messages, usage.input_tokens, usage.output_tokens,
+                           getattr(usage, "cache_read_input_tokens", 0) or 0,
+                           getattr(usage, "cache_creation_input_tokens", 0) or 0)
 
         return {
             "choices": [{
@@ -47,4 +199,10 @@ class ClaudeAPI:
                 "finish_reason": resp.stop_reason,
             }],
             "model": self.model_name,
+            "usage": {
+                "prompt_tokens": self.prompt_tokens,
+                "cached_tokens": self.cached_prompt_tokens,
+                "cache_creation_tokens": self.cache_creation_tokens,
+                "completion_tokens": self.completion_tokens,
+            },
         }
@@ -1,4 +1,6 @@
 import os
+import re
+import glob
 import json
 
 model_name = "qwen"
@@ -14,45 +16,16 @@ total_datas = []
 
 dir_path = f"./eval_results{git_hash}/{model_name}/loong{suffix}"
 
-if os.path.exists(f"{dir_path}/final_output_0.jsonl"):
-    a_s = [json.loads(line) for line in open(f"{dir_path}/final_output_0.jsonl")]
-    print(len(a_s))
-    total_datas += a_s
-
-if os.path.exists(f"{dir_path}/final_output_1.jsonl"):
-    b_s = [json.loads(line) for line in open(f"{dir_path}/final_output_1.jsonl")]
-    print(len(b_s))
-    total_datas += b_s
-
-if os.path.exists(f"{dir_path}/final_output_2.jsonl"):
-    c_s = [json.loads(line) for line in open(f"{dir_path}/final_output_2.jsonl")]
-    print(len(c_s))
-    total_datas += c_s
-
-if os.path.exists(f"{dir_path}/final_output_3.jsonl"):
-    d_s = [json.loads(line) for line in open(f"{dir_path}/final_output_3.jsonl")]
-    print(len(d_s))
-    total_datas += d_s
-
-if os.path.exists(f"{dir_path}/final_output_4.jsonl"):
-    e_s = [json.loads(line) for line in open(f"{dir_path}/final_output_4.jsonl")]
-    print(len(e_s))
-    total_datas += e_s
-
-if os.path.exists(f"{dir_path}/final_output_5.jsonl"):
-    f_s = [json.loads(line) for line in open(f"{dir_path}/final_output_5.jsonl")]
-    print(len(f_s))
-    total_datas += f_s
-
-if os.path.exists(f"{dir_path}/final_output_6.jsonl"):
-    g_s = [json.loads(line) for line in open(f"{dir_path}/final_output_6.jsonl")]
-    print(len(g_s))
-    total_datas += g_s
-
-if os.path.exists(f"{dir_path}/final_output_7.jsonl"):
-    h_s = [json.loads(line) for line in open(f"{dir_path}/final_output_7.jsonl")]
-    print(len(h_s))
-    total_datas += h_s
+# 不再寫死 8 個 worker：依 worker_id 順序合併所有 final_output_{id}.jsonl
+worker_files = {}
+for path in glob.glob(f"{dir_path}/final_output_*.jsonl"):
+    m = re.fullmatch(r"final_output_(\d+)\.jsonl", os.path.basename(path))
+    if m:                                # 略過 final_output_error_{id}.jsonl
+        worker_files[int(m.group(1))] = path
+for wid, path in sorted(worker_files.items()):
+    datas = [json.loads(line) for line in open(path)]
+    print(os.path.basename(path), len(datas))
+    total_datas += datas
 
 print("len(total_datas)", len(total_datas))
 
@@ -0,0 +1,90 @@
+import re
+import pathlib
+from typing import Dict, List, Set, Tuple
+
+from structurizer import Structurizer
+from utilizer import Utilizer
+from utils.prompts import PROMPTS
+from utils.telemetry import stage
+from utils.table_store import TableStore, table_key
+
+# "### Verdict" 區塊標題 (容許 ## / ** 等變化)
+VERDICT_HEADER = re.compile(r"^[#\s\*]*verdict[\s\*:：]*$", re.IGNORECASE | re.MULTILINE)
+
+
+class FusedJudge:
+    """--pipeline fused：一次呼叫同時產生布林表與判決。
+
+    裁定書與法條只送一次；表格照樣存進 table store，
+    回傳 (verdict, reason, table_md)，輸出欄位與 two-stage 相同。
+    """
+
+    def __init__(self, llm, table_kb_path: str or pathlib.Path = "table_kb",
+                 prompt_path: str = "prompts/fused_table_verdict.txt",
+                 store: TableStore or None = None):
+        self.llm = llm
+        self.structurizer = Structurizer(llm, table_kb_path=table_kb_path, store=store)
+        self.prompt_path = pathlib.Path(prompt_path)
+        PROMPTS.register(self.prompt_path, "fused")     # 建構時就載入並驗證 prompt
+
+    @property
+    def template(self):
+        return PROMPTS.get(self.prompt_path, "fused")
+
+    # ------------------------------------------------------------------
+    def judge(self, core_text: str, data_id: int or str,
+              existing_factors: Set[str] or None = None,
+              title: str = None) -> Tuple[bool, str, str]:
+        print(f"data_id {data_id}: fused table + verdict …")
+        messages = self.compose_messages(core_text, existing_factors)
+        with stage("fused", data_id):
+            response = self.llm(messages, temperature=0.0)
+        return self.save_response(response, self.table_key(core_text), title)
+
+    async def ajudge(self, core_text: str, data_id: int or str,
+                     existing_factors: Set[str] or None = None,
+                     title: str = None) -> Tuple[bool, str, str]:
+        """asyncio 版 judge：改走 `llm.acall`。"""
+        print(f"data_id {data_id}: fused table + verdict …")
+        messages = self.compose_messages(core_text, existing_factors)
+        with stage("fused", data_id):
+            response = await self.llm.acall(messages, temperature=0.0)
+        return self.save_response(response, self.table_key(core_text), title)
+
+    # ------------------------------------------------------------------
+    def compose_messages(self, core_text: str,
+                         existing_factors: Set[str] or None = None) -> List[Dict]:
+        """→ [system: 法條 + 兩個 Task 的說明, user: 裁定書 + 輸出格式 + 既有欄名]。"""
+        return self.template.messages(extra=Structurizer.factors_section(existing_factors),
+                                      core=core_text.strip())
+
+    def table_key(self, core_text: str) -> str:
+        """fused prompt 產生的表格另有自己的 key (prompt 指紋不同於 two-stage)；欄名提示不納入。"""
+        prompt_fp = self.template.fingerprint_with(Structurizer.factors_section())
+        return table_key(core_text, prompt_fp, getattr(self.llm, "model_name", ""))
+
+    def save_response(self, response: Dict, key: str,
+                      title: str = None) -> Tuple[bool, str, str]:
+        """拆出表格存進 table store，並解析判決。"""
+        table_md, verdict_text = self.split_reply(response["choices"][0]["message"]["content"])
+        docs = [{"title": title}] if title is not None else ()
+        table_md = self.structurizer.save_response(
+            {"choices": [{"message": {"content": table_md}}]}, key, docs)
+        return (*Utilizer.parse_reply(verdict_text), table_md)
+
+    @staticmethod
+    def split_reply(reply: str) -> Tuple[str, str]:
+        """→ (兩行 Markdown 表格, 判決文字)。
+
+        以 `### Verdict` 分段；模型漏寫標題時，表格行 (以 | 開頭) 之外的文字都當判決。
+        """
+        m = VERDICT_HEADER.search(reply)
+        if m:
+            head, verdict = reply[:m.start()], reply[m.end():]
+        else:
+            head, verdict = reply, None
+        table_lines = [ln.strip() for ln in head.splitlines() if ln.strip().startswith("|")]
+        if verdict is None:
+            verdict = "\n".join(ln for ln in reply.splitlines()
+                                if ln.strip() and not ln.strip().startswith(("|", "#")))
+        return "\n".join(table_lines), verdict.strip()
@@ -3,25 +3,43 @@ import os, time, functools
 import google.generativeai as genai
 from google.generativeai.types import HarmCategory, HarmBlockThreshold
 from typing import List, Dict, Any
+from collections import Counter
+from utils.rate_limit import SCHEDULER, estimate_tokens
+from utils.hedging import timeout_kw
+from utils.tokens import get_counter
+
+
+SAFETY_SETTINGS = {
+    HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: HarmBlockThreshold.BLOCK_ONLY_HIGH,
+    HarmCategory.HARM_CATEGORY_HARASSMENT: HarmBlockThreshold.BLOCK_ONLY_HIGH,
+    HarmCategory.HARM_CATEGORY_HATE_SPEECH: HarmBlockThreshold.BLOCK_ONLY_HIGH,
+}
+
+@functools.lru_cache()
+def _configure(api_key: str):
+    """genai.configure 是全域設定：同一把 key 只做一次，且延到建立 client 時才做。"""
+    genai.configure(api_key=api_key)
 
-# 同時接受兩種環境變數名稱
-api_key = os.getenv("GOOGLE_API_KEY") or os.getenv("GEMINI_API_KEY")
-if not api_key:
-    raise EnvironmentError("請設定 GOOGLE_API_KEY / GEMINI_API_KEY")
-genai.configure(api_key=api_key)
 
 @functools.lru_cache()
 def _get_model(name: str):
     return genai.GenerativeModel(name)
 
 class GeminiAPI:
-    def __init__(self, model_name="gemini-2.0-flash"):
+    def __init__(self, model_name="gemini-2.0-flash", api_key=None):
+        # 同時接受兩種環境變數名稱
+        api_key = api_key or os.getenv("GOOGLE_API_KEY") or os.getenv("GEMINI_API_KEY")
+        if not api_key:
+            raise EnvironmentError("請設定 GOOGLE_API_KEY / GEMINI_API_KEY")
+        _configure(api_key)
         self.model_name = model_name
         self.model = _get_model(model_name)
         self.response = None
         self.prompt_tokens = 0
         self.completion_tokens = 0
         self.total_tokens = 0
+        self.cached_prompt_tokens = 0
+        self.usage_totals = Counter()     # 整輪累計：prompt / cached / completion
 
     # def __call__(
     #     self,
@@ -66,47 +84,143 @@ class GeminiAPI:
     #     return wrapped
 
     def __call__(self, messages, temperature=0.7, max_tokens=2048, retry=3, **kwargs):
+        """retry：可重試錯誤 (429 / 5xx / timeout) 的重送次數，退避交給 SCHEDULER。"""
+        prompt = self._msgs_to_prompt(messages)
+        gen_cfg = dict(temperature=temperature, max_output_tokens=max_tokens, **kwargs)
+
+        resp = SCHEDULER.call(
+            "gemini", self.model_name,
+            lambda: self.model.generate_content(
+                prompt, 
+                generation_config=gen_cfg,
+                safety_settings=SAFETY_SETTINGS,
+                request_options=timeout_kw({}),
+            ),
+            cost=estimate_tokens(messages, max_tokens, self.model_name),
+            max_retries=retry,
+        )
+        return self._wrap(resp, messages)
+
+    async def acall(self, messages, temperature=0.7, max_tokens=2048, retry=3, **kwargs):
+        """asyncio 版 __call__（generate_content_async），回傳格式相同。"""
+        prompt = self._msgs_to_prompt(messages)
+        gen_cfg = dict(temperature=temperature, max_output_tokens=max_tokens, **kwargs)
+
+        resp = await SCHEDULER.acall(
+            "gemini", self.model_name,
+            lambda: self.model.generate_content_async(
+                prompt,
+                generation_config=gen_cfg,
+                safety_settings=SAFETY_SETTINGS,
+                request_options=timeout_kw({}),
+            ),
+            cost=estimate_tokens(messages, max_tokens, self.model_name),
+            max_retries=retry,
+        )
+        return self._wrap(resp, messages)
+
+    def stream(self, messages, temperature=0.7, max_tokens=2048, retry=3, **kwargs):
+        """逐段 yield 文字；呼叫端停止迭代即不再讀取後續 chunk。"""
+        prompt = self._msgs_to_prompt(messages)
+        gen_cfg = dict(temperature=temperature, max_output_tokens=max_tokens, **kwargs)
+
+        resp = SCHEDULER.call(
+            "gemini", self.model_name,
+            lambda: self.model.generate_content(
+                prompt,
+                generation_config=gen_cfg,
+                safety_settings=SAFETY_SETTINGS,
+                request_options=timeout_kw({}),
+                stream=True,
+            ),
+            cost=estimate_tokens(messages, max_tokens, self.model_name),
+            max_retries=retry,
+        )
+        meta, pieces = None, []
+        try:
+            for chunk in resp:
+                meta = getattr(chunk, "usage_metadata", None) or meta   # 最後一個 chunk 為總計
+                if chunk.parts:
+                    pieces.append(chunk.text)
+                    yield chunk.text
+        finally:
+            self._stream_usage(messages, meta, pieces)
+
+    async def astream(self, messages, temperature=0.7, max_tokens=2048, retry=3, **kwargs):
         prompt = self._msgs_to_prompt(messages)
         gen_cfg = dict(temperature=temperature, max_output_tokens=max_tokens, **kwargs)
 
-        for attempt in range(retry):
-            try:
-                resp = self.model.generate_content(
-                    prompt, 
-                    generation_config=gen_cfg,
-                    safety_settings={
-                        HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: HarmBlockThreshold.BLOCK_ONLY_HIGH,
-                        HarmCategory.HARM_CATEGORY_HARASSMENT: HarmBlockThreshold.BLOCK_ONLY_HIGH,
-                        HarmCategory.HARM_CATEGORY_HATE_SPEECH: HarmBlockThreshold.BLOCK_ONLY_HIGH,
-                    }
-                )
-
-                # === 1. 把 Gemini 回傳包成 OpenAI 兼容格式
-                wrapped = {
-                    "choices": [{
-                        "message": {
-                            "role": "assistant",
-                            "content": resp.text,
-                        },
-                        "finish_reason": "stop",
-                    }],
-                    "model": self.model_name,
-                }
-
-                # === 2. 關鍵：更新實例屬性
-                self.response = wrapped                    # ←★★★
-                self.completion_tokens = getattr(resp, "token_count", 0)
-                self.prompt_tokens = 0
-                self.total_tokens = self.prompt_tokens + self.completion_tokens
-
-                # === 3. 回傳
-                return wrapped
-
-            except Exception as e:
-                if attempt == retry - 1:
-                    raise
-                time.sleep(1)
+        resp = await SCHEDULER.acall(
+            "gemini", self.model_name,
+            lambda: self.model.generate_content_async(
+                prompt,
+                generation_config=gen_cfg,
+                safety_settings=SAFETY_SETTINGS,
+                request_options=timeout_kw({}),
+                stream=True,
+            ),
+            cost=estimate_tokens(messages, max_tokens, self.model_name),
+            max_retries=retry,
+        )
+        meta, pieces = None, []
+        try:
+            async for chunk in resp:
+                meta = getattr(chunk, "usage_metadata", None) or meta   # 最後一個 chunk 為總計
+                if chunk.parts:
+                    pieces.append(chunk.text)
+                    yield chunk.text
+        finally:
+            self._stream_usage(messages, meta, pieces)
+
+    def _record_usage(self, messages, meta) -> None:
+        self.prompt_tokens = getattr(meta, "prompt_token_count", 0) or 0
+        self.cached_prompt_tokens = getattr(meta, "cached_content_token_count", 0) or 0
+        self.completion_tokens = getattr(meta, "candidates_token_count", 0) or 0
+        self.total_tokens = (getattr(meta, "total_token_count", 0)
+                             or self.prompt_tokens + self.completion_tokens)
+        self.usage_totals.update(prompt=self.prompt_tokens,
+                                 cached=self.cached_prompt_tokens,
+                                 completion=self.completion_tokens)
+        get_counter(self.model_name).observe(messages, self.prompt_tokens)
+
+    def _stream_usage(self, messages, meta, pieces) -> None:
+        """串流結束：有 usage_metadata 就照實記錄；否則以 utils.tokens 估算 (不校正)。"""
+        if meta is not None and getattr(meta, "prompt_token_count", 0):
+            self._record_usage(messages, meta)
+            return
+        counter = get_counter(self.model_name)
+        self.cached_prompt_tokens = 0
+        self.prompt_tokens = counter.count_messages(messages)
+        self.completion_tokens = counter.count("".join(pieces))
+        self.total_tokens = self.prompt_tokens + self.completion_tokens
+        self.usage_totals.update(prompt=self.prompt_tokens, cached=0,
+                                 completion=self.completion_tokens)
+
+    def _wrap(self, resp, messages=()):
+        # === 1. usage：取自 usage_metadata (舊版 SDK 沒有時記 0)
+        self._record_usage(messages, getattr(resp, "usage_metadata", None))
+
+        # === 2. 把 Gemini 回傳包成 OpenAI 兼容格式
+        finish = resp.candidates[0].finish_reason if resp.candidates else None
+        wrapped = {
+            "choices": [{
+                "message": {
+                    "role": "assistant",
+                    "content": resp.text,
+                },
+                "finish_reason": getattr(finish, "name", finish) or "stop",
+            }],
+            "model": self.model_name,
+            "usage": {
+                "prompt_tokens": self.prompt_tokens,
+                "cached_tokens": self.cached_prompt_tokens,
+                "completion_tokens": self.completion_tokens,
+            },
+        }
 
+        # === 3. 關鍵：更新實例屬性
+        self.response = wrapped                    # ←★★★
+        return wrapped
 
     @staticmethod
     def _msgs_to_prompt(msgs: List[Dict[str, str]]) -> str:
@@ -1,26 +1,38 @@
 import os
-import io
 import json
 import copy
 import time
-import tqdm
 import random
 import pathlib
 random.seed(1024)
 import argparse
-import re
-import datetime as dt
-import pandas as pd
+import asyncio
 from typing import Dict, Any, Set, Tuple
 
-# from gemini_api import GeminiAPI
-from openai_api import OpenAIAPI
-# from claude_api  import ClaudeAPI
-# from utils.qwenapi import QwenAPI
+# provider SDK 與 pandas 都延到真正用到時才 import (見 providers.py)
+from providers import PROVIDERS, DEFAULT_MODELS, make_client, validate
 
 # from router import Router
 from structurizer import Structurizer
 from utilizer import Utilizer
+from fused import FusedJudge
+from batch_runner import BatchRunner, AnthropicBatchBackend, make_backend
+from shard_runner import ShardRunner
+from staged_runner import StagedRunner
+from utils.llm_cache import LLMCache, CachedLLM
+from utils.rate_limit import SCHEDULER, DEFAULT_LIMITS
+from utils.telemetry import Telemetry, InstrumentedLLM, format_summary
+from utils.hedging import HedgedLLM, DeadlineExpired, deadline
+from utils.journal import ResultJournal, case_key
+from utils.sheet_io import load_sheet, iter_rows, SheetWriter
+from utils.table_store import TableStore, open_table_store
+from utils.dedup import DuplicatePlan, find_duplicates
+from utils.prompts import PROMPTS, PromptError
+from utils.markdown_table import parse_row, parse_tables, split_cols
+from utils.factor_matrix import build_from_records
+from utils.factor_vocab import FactorVocab, load_embedder
+
+CASE_COLS = ["裁定字號", "reasoning"]   # 跑案件時只需讀這兩欄；其餘欄由 SheetWriter 帶回
 
 # -----------------------------------------------------------------------------
 # CLI 參數設定
@@ -36,174 +48,822 @@ def build_parser() -> argparse.ArgumentParser:
     
     # LLM 參數
     parser.add_argument("--llm_name",
-                    choices=["gemini", "openai", "claude"],
+                    choices=list(PROVIDERS),
                     default="claude")
-    parser.add_argument("--model_name", default="claude-3-7-sonnet-20250219")
+    parser.add_argument("--model_name", default=None,
+                        help="未給則用各 provider 預設 (見 DEFAULT_MODELS)")
+    parser.add_argument("--url", default="10.32.15.63:1225",
+                        help="qwen：自架 vLLM (OpenAI 相容) server 的 host:port")
+    parser.add_argument("--base_url", default=None,
+                        help="openai / claude 改打相容 server，例如 mock_llm.py："
+                             "http://127.0.0.1:8000/v1 (openai)、http://127.0.0.1:8000 (claude)")
+
+    # 執行模式
+    parser.add_argument("--pipeline", choices=["two-stage", "fused"], default="two-stage",
+                        help="two-stage：Structurizer → Utilizer 兩次呼叫；"
+                             "fused：一次呼叫同時產生布林表與判決 (table_kb 與輸出欄位相同)")
+    parser.add_argument("--concurrency", type=int, default=1,
+                        help="同時處理的案件數；>1 時改用 asyncio 執行 (llm.acall)，"
+                             "輸出列順序仍與輸入相同")
+    parser.add_argument("--staged", action="store_true",
+                        help="Structurizer / Utilizer 分成兩組 worker，以 bounded queue 串接，"
+                             "建表與判決可重疊進行 (asyncio，two-stage 專用)")
+    parser.add_argument("--struct_concurrency", type=int, default=None,
+                        help="--staged：Structurizer 階段並行數 (預設同 --concurrency)")
+    parser.add_argument("--util_concurrency", type=int, default=None,
+                        help="--staged：Utilizer 階段並行數 (預設同 --concurrency)")
+    parser.add_argument("--stage_queue", type=int, default=None,
+                        help="--staged：兩階段間 queue 上限 (預設 2 × util_concurrency)")
+    parser.add_argument("--util_llm_name", choices=list(PROVIDERS), default=None,
+                        help="--staged：Utilizer 階段改用此 provider (預設同 --llm_name)")
+    parser.add_argument("--util_model_name", default=None,
+                        help="--staged：Utilizer 階段的 model (預設見 DEFAULT_MODELS)")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="多程序模式：N 個 worker 共用一個工作佇列 (快的多拿)，結果由主程序"
+                             "依列號合併；<KEY>S=k1,k2,… (如 ANTHROPIC_API_KEYS) 可讓 worker 輪用多組金鑰")
+    parser.add_argument("--verdict-only", "--verdict_only", dest="verdict_only",
+                        action="store_true",
+                        help="Utilizer 改用串流，讀到開頭 TRUE/FALSE 即中斷；reason 欄留空")
+    parser.add_argument("--stream_verdict", action="store_true",
+                        help="Utilizer 改用串流，判決一出現就先印出 (reason 仍完整讀完)")
+
+    # 中斷續跑：每完成一件寫一行 journal
+    parser.add_argument("--journal", default=None,
+                        help="結果 journal (JSONL)；預設 data/output/<input>.journal.jsonl")
+    parser.add_argument("--resume", action="store_true",
+                        help="跳過 journal 中已完成的案件 (以裁定字號 + 內容 hash 比對，與列號無關)")
+    parser.add_argument("--rebuild", action="store_true",
+                        help="不呼叫 LLM，只用 journal + 輸入檔重建輸出 Excel")
+
+    # 輸入 / 輸出
+    parser.add_argument("--table_store", default="table_kb",
+                        help="布林表存放處 (以裁定書內容 + prompt + model 的 hash 為 key，"
+                             "同一份裁定書不再重建)：目錄或 .sqlite 單檔 (多個 worker 同時寫不搶目錄)")
+    parser.add_argument("--factor_vocab", default="cache/factor_vocab.json",
+                        help="跨執行保存的動態欄名字彙表 (同義欄名歸到同一正式名稱)")
+    parser.add_argument("--no_factor_vocab", action="store_true",
+                        help="不使用字彙表：prompt 不帶既有欄名、輸出欄名不正規化")
+    parser.add_argument("--factor_topk", type=int, default=30,
+                        help="prompt 只帶與該件最相關的前 K 個既有欄名 (0 = 不帶)")
+    parser.add_argument("--factor_threshold", type=float, default=0.7,
+                        help="欄名字元 bigram 相似度 >= 此值視為同義")
+    parser.add_argument("--factor_embed", default=None, metavar="MODEL",
+                        help="另以本機 sentence-transformers 模型比對欄名語意 (需安裝該套件)")
+    parser.add_argument("--ingest_cache", default="cache/ingest",
+                        help="Excel 轉 Parquet 的快取目錄；輸入檔 mtime / 內容 hash 變了才重新解析")
+    parser.add_argument("--output_formats", type=lambda s: [f for f in s.split(",") if f],
+                        default=[], metavar="csv,parquet",
+                        help="除了 _withVerdict.xlsx 之外，另存同名 .csv / .parquet")
+    parser.add_argument("--factor_matrix", default=None, metavar="PATH",
+                        help="另存 案件 × 動態欄 稀疏矩陣 (.npz 結尾為 numpy 檔，其餘為 Parquet 目錄)，"
+                             "用 utils.factor_matrix.FactorMatrix.load 讀回")
+
+    # 重複案件：送 LLM 前先合併，每份裁定書只跑一次，結果再複製回所有相同的列
+    parser.add_argument("--dedup", choices=["off", "exact", "near"], default="off",
+                        help="exact：正規化 (空白/全半形/標點) 後完全相同；"
+                             "near：再加 MinHash/LSH 近似重複")
+    parser.add_argument("--dedup_threshold", type=float, default=0.9,
+                        help="--dedup near 的 Jaccard 相似度門檻 (字元 5-gram)")
+
+    # Batch API (兩階段：Structurizer batch → Utilizer batch)
+    parser.add_argument("--batch-mode", "--batch_mode", dest="batch_mode",
+                        action="store_true",
+                        help="改用 provider batch API（較便宜、額度高，但非即時）")
+    parser.add_argument("--batch_backend", choices=["auto", "local"], default="auto",
+                        help="auto：依 --llm_name 用 OpenAI / Anthropic batch；"
+                             "local：本機檔案模擬 (離線測試)")
+    parser.add_argument("--batch_dir", default="batches",
+                        help="batch state 檔與 local backend 檔案位置")
+    parser.add_argument("--poll_interval", type=float, default=60.0, help="輪詢間隔 (秒)")
+    parser.add_argument("--struct_batch_id", default=None,
+                        help="接續指定的 Structurizer batch（預設讀 state 檔）")
+    parser.add_argument("--util_batch_id", default=None,
+                        help="接續指定的 Utilizer batch（預設讀 state 檔）")
+
+    # LLM 回應快取 (SQLite)
+    parser.add_argument("--cache_path", default="cache/llm_cache.sqlite",
+                        help="LLM 回應快取檔；相同 provider/model/messages/參數 不再重打 API")
+    parser.add_argument("--no_cache", action="store_true", help="完全不使用快取")
+    parser.add_argument("--cache_bypass", action="store_true",
+                        help="不讀快取（強制重打 API），但仍以新結果覆寫")
+    parser.add_argument("--cache_max_entries", type=int, default=None)
+    parser.add_argument("--cache_max_age_days", type=float, default=None)
+    parser.add_argument("--cache_max_size_mb", type=float, default=None)
+
+    # 限流 (覆寫 utils/rate_limit.DEFAULT_LIMITS；未給則用預設額度)
+    parser.add_argument("--rpm", type=float, default=None, help="requests per minute 上限")
+    parser.add_argument("--tpm", type=float, default=None, help="tokens per minute 上限")
+    parser.add_argument("--max_inflight", type=int, default=None,
+                        help="單一 provider/model 同時在途請求上限 (遇 429 會自動下修)")
+    parser.add_argument("--max_retries", type=int, default=None,
+                        help="可重試錯誤 (429 / 5xx / timeout) 的最大重送次數")
+
+    # 尾延遲：hedge 到第二個 provider + 每件案件的截止時間
+    parser.add_argument("--hedge_llm", choices=list(PROVIDERS),
+                        default=None,
+                        help="primary 超過延遲門檻仍未回覆時，同一請求再送給此 provider，先回者勝出")
+    parser.add_argument("--hedge_model", default=None,
+                        help="hedge 端的 model (預設見 DEFAULT_MODELS)")
+    parser.add_argument("--hedge_percentile", type=float, default=95.0,
+                        help="以 primary 最近延遲的第幾百分位作為 hedge 門檻")
+    parser.add_argument("--hedge_after", type=float, default=None,
+                        help="固定 hedge 門檻 (秒)；給了就不看百分位")
+    parser.add_argument("--case_deadline", type=float, default=None,
+                        help="單件案件 (Structurizer + Utilizer 含重試) 的時限 (秒)；逾時該列跳過")
+
+    parser.add_argument("--dry-run", "--dry_run", dest="dry_run", action="store_true",
+                        help="只檢查設定 (金鑰、套件、輸入檔、prompt)，不 import SDK、不呼叫 LLM")
+    parser.add_argument("--prompt_hot_reload", action="store_true",
+                        help="執行中 prompt 檔被修改時自動重新載入 (驗證失敗則沿用舊版)")
+    parser.add_argument("--chunk_tokens", type=int, default=Structurizer.CHUNK_TOKENS,
+                        help="裁定書超過此 token 數時依段落切開、各段建表後合併 (0 = 不分段)")
+    parser.add_argument("--chunk_concurrency", type=int, default=Structurizer.CHUNK_CONCURRENCY,
+                        help="分段建表時同一件同時送出的段數")
+
+    # 觀測
+    parser.add_argument("--record", default=None, metavar="PATH",
+                        help="把每次 LLM 回覆錄成 JSONL transcript (--workers 時為 <PATH>.w<i>)；"
+                             "mock_llm.py --transcript / MOCK_TRANSCRIPT 可重播")
+    parser.add_argument("--telemetry", default=None, metavar="PATH",
+                        help="每次 LLM 呼叫寫一行 JSONL (階段、案件、排隊/延遲、token、費用)；"
+                             "結束時另存 <PATH>.summary.json (--workers 時各 worker 寫 <PATH>.w<i>，"
+                             "結束時併入 <PATH>)")
 
     # parser.add_argument("--api_key", type=str, default=None,
     #                     help="可選，若未給則讀 GOOGLE_API_KEY / GEMINI_API_KEY")
     return parser
 
-def auto_cast(txt: str):
-    s = str(txt).strip()
-    # 空字串或只含 -、_、─ 等視為 missing
-    if not s or re.fullmatch(r"[-_─]+", s):
-        return None, "empty"
+def parse_table_cols(tbl_md: str, idx: int, vocab: FactorVocab = None
+                     ) -> Tuple[Dict[str, bool], Dict[str, Dict[str, Any]]]:
+    """Markdown 布林表 → BASE 布林欄與動態欄 (格式壞掉時 BASE 全 False，不中斷整張 sheet)。
+
+    給了 vocab 時動態欄改用正式名稱，並計入字彙表。
+    """
+    row = parse_row(tbl_md, Structurizer.BASE_COLS)
+    if row is None:
+        print(f"⚠️ data_id {idx}: markdown 表格缺表頭或資料列，布林欄以 False 填入")
+    bool_cols, extra_cols = split_cols(row, Structurizer.BASE_COLS)
+    if vocab is not None:
+        extra_cols = vocab.observe(extra_cols)
+    return bool_cols, extra_cols
+
+
+def parse_tables_cols(tables: Dict[int, str], vocab: FactorVocab = None
+                      ) -> Dict[int, Tuple[Dict[str, bool], Dict[str, Dict[str, Any]]]]:
+    """parse_table_cols 的批次版 (batch 模式)：所有表格的儲存格一次向量化轉型。"""
+    parsed = parse_tables(tables, Structurizer.BASE_COLS)
+    for idx in parsed.malformed:
+        print(f"⚠️ data_id {idx}: markdown 表格缺表頭或資料列，布林欄以 False 填入")
+    if vocab is not None:
+        for idx in sorted(parsed):
+            bool_cols, extra_cols = parsed[idx]
+            parsed[idx] = (bool_cols, vocab.observe(extra_cols))
+    return parsed
+
+
+class CasePipeline:
+    """一次執行共用的 Structurizer + Utilizer (或 FusedJudge)。
+
+    每次執行只建一次 (prompt 在建構時載入、驗證)，之後每件交給 run_one_case /
+    run_one_case_async；StagedRunner 也是同樣做法。
+    """
+
+    QUERY = "本案是否仍行國民法官審判？"
+
+    def __init__(self, llm, store: TableStore, util_prompt_path: pathlib.Path,
+                 pipeline: str = "two-stage", chunk_tokens: int = None,
+                 chunk_concurrency: int = None):
+        self.pipeline = pipeline
+        self.fused = self.structurizer = self.utilizer = None
+        if pipeline == "fused":
+            self.fused = FusedJudge(llm, store=store)
+        else:
+            self.structurizer = Structurizer(llm, store=store, chunk_tokens=chunk_tokens,
+                                             chunk_concurrency=chunk_concurrency)
+            self.utilizer = Utilizer(llm, prompt_path=str(util_prompt_path))
 
-    if s.upper() in {"TRUE", "FALSE"}:
-        return s.upper() == "TRUE", "bool"
-    try:
-        num = float(s) if "." in s else int(s)
-        return num, "number"
-    except ValueError:
-        pass
-    try:
-        return dt.date.fromisoformat(s), "date"
-    except ValueError:
-        pass
-    return s, "text"
+    @classmethod
+    def from_args(cls, args, llm, store: TableStore, util_prompt_path: pathlib.Path):
+        return cls(llm, store, util_prompt_path, args.pipeline,
+                   chunk_tokens=args.chunk_tokens, chunk_concurrency=args.chunk_concurrency)
 
-def is_data_line(ln: str) -> bool:
-    core = ln.strip().strip("|").replace("-", "").replace(":", "").strip()
-    return bool(core)           # 有真正字元才算資料
 
 def run_one_case(
-    llm,
-    table_dir: pathlib.Path,
+    pipe: CasePipeline,
     title: str,
     core_text: str,
     idx: int,
-    util_prompt_path: pathlib.Path,
-    existing_factors: Set[str],
+    vocab: FactorVocab = None,
+    verdict_only: bool = False,
+    on_verdict=None,
 ):
+    """一件：Structurizer → Utilizer (或 fused 一次呼叫)。
+
+    vocab：跨件 / 跨執行的欄名字彙表；prompt 只帶與本件相關的前 K 個既有欄名，
+    輸出的動態欄改用正式名稱。
+    """
+    hints = vocab.relevant(core_text) if vocab is not None else None
+
+    if pipe.fused is not None:
+        verdict, reason, table_md = pipe.fused.judge(
+            core_text, idx, existing_factors=hints, title=title)
+        bool_cols, extra_cols = parse_table_cols(table_md, idx, vocab)
+        return verdict, reason, bool_cols, extra_cols
 
     # ---------- Structurizer ----------
     docs = [{"title": title, "document": core_text}]
-    Structurizer(llm, table_kb_path=str(table_dir)).do_construct_table(
+    table_md = pipe.structurizer.do_construct_table(
         docs=docs,
         data_id=idx,
-        existing_factors=existing_factors,   # ★ 給 LLM 參考
+        existing_factors=hints,   # ★ 給 LLM 參考
     )
 
-    # ---------- 讀回 & 取前兩行表格 ----------
-    tbl_md  = (table_dir / f"data_{idx}.md").read_text(encoding="utf-8")
-    lines   = [ln for ln in tbl_md.splitlines()
-               if ln.strip().startswith("|") and ln.count("|") >= 9 and is_data_line(ln)]
-    # one_csv = "\n".join(",".join(c.strip() for c in ln.strip("| ").split("|"))
-                        # for ln in lines)
-    if len(lines) < 2:
-        raise ValueError(f"data_id {idx}: markdown 表格缺資料列")
-
-    header, data = lines[0], lines[1]
-    table_csv = "\n".join(
-        ",".join(c.strip() for c in ln.strip("| ").split("|"))
-        for ln in (header, data)
+    # ---------- 解析表格 (直接用記憶體中的字串，不再讀檔；欄名經 vocab 正規化) ----------
+    bool_cols, extra_cols = parse_table_cols(table_md, idx, vocab)
+
+    # ---------- Utilizer ----------
+    verdict, reason = pipe.utilizer.infer_boolean(
+        query=pipe.QUERY,
+        data_id=idx,
+        core_text=core_text,
+        verdict_only=verdict_only,
+        on_verdict=on_verdict,
+        table_md=table_md,
     )
-    df_tbl  = pd.read_csv(io.StringIO(table_csv), skipinitialspace=True)
-    df_tbl.rename(columns=lambda c: c.strip(), inplace=True)
 
-    BASE = Structurizer.BASE_COLS
-    bool_cols: Dict[str, bool]      = {}
-    extra_cols: Dict[str, Dict[str, Any]] = {}
+    # print(verdict, reason)
+
+    return verdict, reason, bool_cols, extra_cols
 
-    for name, raw_val in df_tbl.iloc[0].items():
-        val, typ = auto_cast(str(raw_val))
-        if name in BASE:
-            bool_cols[name] = bool(val) if typ == "bool" else False
-        else:
-            if val is not None:
-                extra_cols[name] = {"value": val, "type": typ}
-            else:
-                extra_cols[name] = {"value": "NA", "type": "empty"}
 
-    # 把新出現欄寫回 set 供下一篇 Prompt
-    existing_factors.update(extra_cols.keys())
+async def run_one_case_async(
+    pipe: CasePipeline,
+    title: str,
+    core_text: str,
+    idx: int,
+    vocab: FactorVocab = None,
+    verdict_only: bool = False,
+    on_verdict=None,
+):
+    """run_one_case 的 asyncio 版本：兩次 LLM 呼叫改為 await llm.acall。"""
+    hints = vocab.relevant(core_text) if vocab is not None else None
+    if pipe.fused is not None:
+        verdict, reason, table_md = await pipe.fused.ajudge(
+            core_text, idx, existing_factors=hints, title=title)
+        bool_cols, extra_cols = parse_table_cols(table_md, idx, vocab)
+        return verdict, reason, bool_cols, extra_cols
 
-    # ---------- Utilizer ----------
-    util = Utilizer(llm, table_kb_path=str(table_dir),
-                    prompt_path=str(util_prompt_path))
-    verdict, reason = util.infer_boolean(
-        query="本案是否仍行國民法官審判？",
+    docs = [{"title": title, "document": core_text}]
+    table_md = await pipe.structurizer.ado_construct_table(
+        docs=docs,
         data_id=idx,
-        core_text=core_text,
+        existing_factors=hints,
     )
 
-    # print(verdict, reason)
+    bool_cols, extra_cols = parse_table_cols(table_md, idx, vocab)
 
+    verdict, reason = await pipe.utilizer.ainfer_boolean(
+        query=pipe.QUERY,
+        data_id=idx,
+        core_text=core_text,
+        verdict_only=verdict_only,
+        on_verdict=on_verdict,
+        table_md=table_md,
+    )
     return verdict, reason, bool_cols, extra_cols
 
 
+def result_fields(v, r, bool_cols, extra_cols) -> Dict[str, Any]:
+    """每列要附加到輸入欄之後的欄位；輸入欄本身由 SheetWriter 串流合併。"""
+    fields = dict(bool_cols)     # ← 把 L1~L5 + Accomplice…Victim 9 欄展開
+    fields.update({              # 再補 verdict / reason
+        "verdict": v,
+        "reason":  r,
+    })
+
+    for k, meta in extra_cols.items():        # 動態欄
+        fields[f"{k}_value"] = meta["value"]
+        fields[f"{k}_type"]  = meta["type"]
+    return fields
+
+
+def journal_fields(rec) -> Dict[str, Any]:
+    return result_fields(rec["verdict"], rec["reason"], rec["bool_cols"], rec["extra_cols"])
+
+
+def case_text(idx, row) -> Tuple[str, str]:
+    """(裁定字號, 裁定理由)；空白儲存格 (None) 視為缺值。"""
+    title = row.get("裁定字號")
+    core  = row.get("reasoning")
+    return (f"case-{idx}" if title is None else str(title),
+            "" if core is None else str(core))
+
+
+def rows_from_journal(source: pathlib.Path, journal: ResultJournal, writer: SheetWriter):
+    """依輸入檔順序，把 journal 已完成的案件放進 writer (--rebuild / 中斷後存檔)。"""
+    for idx, row in iter_rows(source, columns=CASE_COLS):
+        rec = journal.get(case_key(*case_text(idx, row)))
+        if rec is not None:
+            writer.add(idx, journal_fields(rec))
+
+
+def iter_cases(source: pathlib.Path, writer: SheetWriter, journal: ResultJournal = None,
+               resume: bool = False, duplicates: DuplicatePlan = None):
+    """輸入列 → 要送 LLM 的 (列號, 裁定字號, 裁定書)。
+
+    reasoning 空白的列略過；--resume 命中 journal 的列直接交給 writer；
+    --dedup 判為重複的列留給 fan_out_duplicates 複製代表列的結果。
+    """
+    for idx, row in iter_rows(source, columns=CASE_COLS):
+        title, core = case_text(idx, row)
+        if not core.strip():
+            print(f"⚠️ row {idx}: reasoning 空白，跳過")
+            continue
+        if resume and journal is not None:
+            rec = journal.get(case_key(title, core))
+            if rec is not None:
+                writer.add(idx, journal_fields(rec))
+                continue
+        if duplicates is not None and idx in duplicates:
+            continue
+        yield idx, title, core
+
+
+def plan_duplicates(source: pathlib.Path, near: bool, threshold: float) -> DuplicatePlan:
+    """--dedup：先掃過整張表 (只讀裁定書欄)，找出完全 / 近似重複的列。"""
+    rows = ((idx, core) for idx, (_, core) in
+            ((idx, case_text(idx, row)) for idx, row in iter_rows(source, columns=CASE_COLS))
+            if core.strip())
+    plan = find_duplicates(rows, near=near, threshold=threshold)
+    print(plan.summary())
+    return plan
+
+
+def fan_out_duplicates(source: pathlib.Path, plan: DuplicatePlan, writer: SheetWriter,
+                       journal: ResultJournal):
+    """把代表列的結果複製到重複列，並以重複列自己的 key 寫進 journal。"""
+    reps = set(plan.rep_of.values())
+    rep_keys: Dict[int, str] = {}
+    copied = 0
+    for idx, row in iter_rows(source, columns=CASE_COLS):     # 代表列一定在重複列之前
+        if idx in reps:
+            rep_keys[idx] = case_key(*case_text(idx, row))
+        if idx not in plan:
+            continue
+        title, core = case_text(idx, row)
+        key = case_key(title, core)
+        rec = journal.get(key) or journal.get(rep_keys.get(plan.rep_of[idx]))
+        if rec is None:              # 代表列沒跑完 (逾時 / 中斷)
+            continue
+        if key not in journal:
+            rec = journal.append(key, title, core, idx, rec["verdict"], rec["reason"],
+                                 rec["bool_cols"], rec["extra_cols"])
+            copied += 1
+        writer.add(idx, journal_fields(rec))
+    if copied:
+        print(f"dedup: {copied} 列沿用代表列的結果")
+
+
+def write_factor_matrix(source: pathlib.Path, journal: ResultJournal, path) -> None:
+    """--factor_matrix：依輸入列順序，把 journal 中已完成的案件存成稀疏矩陣。"""
+    records = ((idx, rec) for idx, rec in
+               ((idx, journal.get(case_key(*case_text(idx, row))))
+                for idx, row in iter_rows(source, columns=CASE_COLS))
+               if rec is not None)
+    fm = build_from_records(records, Structurizer.BASE_COLS)
+    print(f"{fm} → {fm.save(path)}")
+
+
+def early_verdict_printer(idx, title):
+    """--stream_verdict：串流讀到判決就先印，不等 reason 寫完。"""
+    return lambda v: print(f"[{idx}] {title} ⇢ (early)", v)
+
+
+async def closing(coro, *llms):
+    """跑完 coro 後關閉各 client 綁在這個 event loop 上的連線池 (例如 QwenAPI.aclose)。"""
+    try:
+        return await coro
+    finally:
+        for llm in llms:
+            clients = (llm.primary, llm.secondary) if isinstance(llm, HedgedLLM) else (llm,)
+            for client in clients:
+                aclose = getattr(client, "aclose", None)
+                if aclose is not None:
+                    await aclose()
+
+
+async def run_sheet_async(pipe: CasePipeline, source: pathlib.Path, writer: SheetWriter,
+                          concurrency: int,
+                          verdict_only: bool = False, stream_verdict: bool = False,
+                          case_deadline: float = None,
+                          journal: ResultJournal = None, resume: bool = False,
+                          duplicates: DuplicatePlan = None, vocab: FactorVocab = None):
+    """同時最多 *concurrency* 件在途；列是邊跑邊讀的 (先取得名額才讀下一列)。"""
+    sem = asyncio.Semaphore(concurrency)
+
+    async def one(idx, title, core):
+        try:
+            try:
+                with deadline(case_deadline):
+                    v, r, bool_cols, extra_cols = await run_one_case_async(
+                        pipe, title, core, idx, vocab,
+                        verdict_only=verdict_only,
+                        on_verdict=early_verdict_printer(idx, title) if stream_verdict else None)
+            except DeadlineExpired:
+                print(f"⚠️ row {idx}: 超過 --case_deadline {case_deadline}s，跳過")
+                return
+        finally:
+            sem.release()
+        if journal is not None:
+            journal.append(case_key(title, core), title, core, idx, v, r, bool_cols, extra_cols)
+        writer.add(idx, result_fields(v, r, bool_cols, extra_cols))
+        print(f"[{idx}] {title} →", v)
+
+    pending = set()
+    try:
+        for idx, title, core in iter_cases(source, writer, journal, resume, duplicates):
+            await sem.acquire()
+            for task in [t for t in pending if t.done()]:
+                pending.discard(task)
+                task.result()                       # 讓例外照常往外拋
+            pending.add(asyncio.ensure_future(one(idx, title, core)))
+        await asyncio.gather(*pending)
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+def run_sheet_batch(args, llm, source: pathlib.Path, writer: SheetWriter,
+                    input_path: pathlib.Path,
+                    store: TableStore, util_prompt: pathlib.Path,
+                    journal: ResultJournal = None, duplicates: DuplicatePlan = None,
+                    vocab: FactorVocab = None):
+    """--batch-mode：兩階段 batch，結果依輸入列號交給 writer。"""
+    if args.verdict_only or args.stream_verdict:
+        print("⚠️ batch 模式不支援串流，忽略 --verdict-only / --stream_verdict")
+    if args.pipeline == "fused":
+        print("⚠️ batch 模式固定走 two-stage，忽略 --pipeline fused")
+    batch_dir = pathlib.Path(args.batch_dir)
+    backend = make_backend(args.llm_name, llm, args.model_name, batch_dir,
+                           args.batch_backend)
+    runner = BatchRunner(llm, backend, args.model_name, store, util_prompt,
+                         state_path=batch_dir / f"state_{input_path.stem}.json",
+                         poll_interval=args.poll_interval, vocab=vocab)
+
+    cases = list(iter_cases(source, writer, journal, args.resume, duplicates))
+
+    verdicts = runner.run(cases, args.struct_batch_id, args.util_batch_id)
+    parsed = parse_tables_cols({idx: runner.tables[idx] for idx in verdicts}, vocab)
+
+    for idx, title, core in cases:
+        if idx not in verdicts:
+            continue
+        v, r = verdicts[idx]
+        bool_cols, extra_cols = parsed[idx]
+        if journal is not None:
+            journal.append(case_key(title, core), title, core, idx, v, r, bool_cols, extra_cols)
+        writer.add(idx, result_fields(v, r, bool_cols, extra_cols))
+        print(f"[{idx}] {title} →", v)
+
+
+def check_config(args) -> list:
+    """--dry-run：回傳設定問題清單 (空 = 可執行)。"""
+    import importlib.util
+
+    problems = validate(args.llm_name)
+    if args.hedge_llm:
+        problems += validate(args.hedge_llm)
+
+    input_path = "data" / pathlib.Path(args.input_file)
+    suffix = input_path.suffix.lower()
+    if not input_path.exists():
+        problems.append(f"找不到輸入檔 {input_path}")
+    if suffix not in {".txt", ".md", ".xlsx", ".xls"}:
+        problems.append("input_file 必須是 .txt/.md 或 .xlsx/.xls")
+    if suffix in {".xlsx", ".xls"}:
+        engine = "openpyxl" if suffix == ".xlsx" else "xlrd"
+        for mod in ("pandas", "pyarrow", engine):
+            if importlib.util.find_spec(mod) is None:
+                problems.append(f"讀寫 Excel 需要套件 {mod}")
+
+    problems += load_prompts(args)
+
+    if args.batch_mode and args.batch_backend == "auto" \
+            and args.llm_name not in {"openai", "claude"}:
+        problems.append(f"{args.llm_name} 沒有 batch API；請改用 --batch_backend local")
+    if args.batch_mode and args.batch_backend == "auto" and args.llm_name == "claude":
+        problems += check_sdk("anthropic", AnthropicBatchBackend.MIN_SDK, "Message Batches")
+    unknown = set(args.output_formats) - {"csv", "parquet"}
+    if unknown:
+        problems.append(f"--output_formats 只支援 csv / parquet: {', '.join(sorted(unknown))}")
+    if args.concurrency < 1:
+        problems.append("--concurrency 需 >= 1")
+    if args.workers < 1:
+        problems.append("--workers 需 >= 1")
+    if args.chunk_tokens < 0:
+        problems.append("--chunk_tokens 需 >= 0 (0 = 不分段)")
+    if args.chunk_concurrency < 1:
+        problems.append("--chunk_concurrency 需 >= 1")
+    for flag in ("struct_concurrency", "util_concurrency", "stage_queue"):
+        if getattr(args, flag) is not None and getattr(args, flag) < 1:
+            problems.append(f"--{flag} 需 >= 1")
+    if args.util_llm_name:
+        problems += validate(args.util_llm_name)
+    if not 0 < args.dedup_threshold <= 1:
+        problems.append("--dedup_threshold 需介於 0 與 1 之間")
+    if args.dedup == "near" and importlib.util.find_spec("numpy") is None:
+        problems.append("--dedup near 需要套件 numpy")
+    if args.factor_embed and importlib.util.find_spec("sentence_transformers") is None:
+        problems.append("--factor_embed 需要套件 sentence-transformers")
+    if args.factor_topk < 0:
+        problems.append("--factor_topk 需 >= 0")
+    if args.factor_matrix:
+        for mod in ("numpy",) + (() if args.factor_matrix.endswith(".npz") else ("pyarrow",)):
+            if importlib.util.find_spec(mod) is None:
+                problems.append(f"--factor_matrix 需要套件 {mod}")
+    return problems
+
+
+def check_sdk(dist: str, minimum: tuple, feature: str) -> list:
+    """不 import SDK，只看已安裝的版本號；太舊時回傳問題說明。"""
+    from importlib.metadata import version, PackageNotFoundError
+
+    try:
+        installed = version(dist)
+    except PackageNotFoundError:
+        return [f"{feature} 需要套件 {dist}"]
+    parts = tuple(int(p) for p in installed.split(".")[:len(minimum)] if p.isdigit())
+    if parts < minimum:
+        need = ".".join(map(str, minimum))
+        return [f"{feature} 需要 {dist} >= {need} (目前 {installed})；請升級或改用 --batch_backend local"]
+    return []
+
+
+def load_prompts(args) -> list:
+    """載入並驗證這次會用到的 prompt (缺欄位、多餘欄位、未跳脫的大括號)；回傳問題清單。
+
+    之後每件只做 user 後綴的 format；--prompt_hot_reload 時檔案改了會自動換新版。
+    """
+    PROMPTS.configure(hot_reload=args.prompt_hot_reload)
+    if args.pipeline == "fused" and not (args.batch_mode or args.staged):
+        needed = [("prompts/fused_table_verdict.txt", "fused")]
+    else:
+        needed = [(Structurizer.PROMPT, "structurize"), (args.util_prompt, "utilize")]
+    problems = []
+    for path, role in needed:
+        try:
+            PROMPTS.register(path, role)
+        except FileNotFoundError:
+            problems.append(f"找不到 prompt {path}")
+        except PromptError as e:
+            problems.append(f"prompt {e}")
+    return problems
+
+
+def configure_scheduler(args, share: int = 1) -> None:
+    """套用 --rpm / --tpm / --max_inflight / --max_retries。
+
+    share：有幾個程序共用同一組金鑰 (--workers)；rpm / tpm 依此平分，合計不超過帳號額度。
+    """
+    rpm, tpm = args.rpm, args.tpm
+    if share > 1:
+        base = DEFAULT_LIMITS.get(args.llm_name, DEFAULT_LIMITS["openai"])
+        rpm = (rpm or base["rpm"]) / share
+        tpm = (tpm or base["tpm"]) / share
+    SCHEDULER.configure(args.llm_name, args.model_name, rpm=rpm, tpm=tpm,
+                        max_concurrency=args.max_inflight)
+    if args.max_retries is not None:
+        SCHEDULER.max_retries = args.max_retries
+
+
+def open_cache(args):
+    if args.no_cache:
+        return None
+    return LLMCache(args.cache_path,
+                    max_entries=args.cache_max_entries,
+                    max_age_days=args.cache_max_age_days,
+                    max_size_mb=args.cache_max_size_mb)
+
+
+def open_vocab(args):
+    if args.no_factor_vocab:
+        return None
+    embedder = load_embedder(args.factor_embed) if args.factor_embed else None
+    return FactorVocab(args.factor_vocab, threshold=args.factor_threshold,
+                       top_k=args.factor_topk, embedder=embedder)
+
+
+def build_llm(args, telemetry=None, cache=None, record=None):
+    """→ (llm, hedged)；hedged 為 None 表示未開 --hedge_llm。record：--record 的 transcript 路徑。"""
+
+    def wrap(client, llm_name):
+        """client → (record) → (telemetry) → (cache)；hedge 的兩端各自有快取與事件紀錄。"""
+        if record:                          # 只錄真的送出的請求 (快取命中不重複寫)
+            from mock_llm import RecordingLLM
+            client = RecordingLLM(client, record)
+        if telemetry is not None:
+            client = InstrumentedLLM(client, telemetry, provider=llm_name)
+        if cache is not None:
+            client = CachedLLM(client, cache, provider=llm_name, bypass=args.cache_bypass)
+        return client
+
+    llm = wrap(make_client(args.llm_name, args.model_name, args.url, args.base_url),
+               args.llm_name)
+    if not args.hedge_llm:
+        return llm, None
+    hedge_model = args.hedge_model or DEFAULT_MODELS[args.hedge_llm]
+    hedged = HedgedLLM(llm, wrap(make_client(args.hedge_llm, hedge_model, args.url),
+                                 args.hedge_llm),
+                       percentile=args.hedge_percentile, hedge_after=args.hedge_after)
+    print(f"Hedging {args.llm_name}/{args.model_name} → {args.hedge_llm}/{hedge_model}")
+    return hedged, hedged
+
+
 def main():
     args = build_parser().parse_args()
 
-    # llm          = GeminiAPI(model_name=args.llm_name)
-    if args.llm_name == "gemini":
-        llm = GeminiAPI(model_name=args.model_name)
-    elif args.llm_name == "openai":   # openai
-        llm = OpenAIAPI(model_name=args.model_name)
-    else:
-        llm = ClaudeAPI(model_name=args.model_name)
-    input_path   = "data" / pathlib.Path(args.input_file)
-    util_prompt  = pathlib.Path(args.util_prompt)
-    table_dir    = pathlib.Path("table_kb")
-    table_dir.mkdir(exist_ok=True)
+    args.model_name = args.model_name or DEFAULT_MODELS[args.llm_name]
+
+    if args.dry_run:
+        problems = check_config(args)
+        print(f"llm: {args.llm_name}/{args.model_name}"
+              + (f"  hedge: {args.hedge_llm}/{args.hedge_model or DEFAULT_MODELS[args.hedge_llm]}"
+                 if args.hedge_llm else ""))
+        print(f"input: data/{args.input_file}  util_prompt: {args.util_prompt}  "
+              f"mode: {'batch' if args.batch_mode else 'staged' if args.staged else f'workers={args.workers}' if args.workers > 1 else f'concurrency={args.concurrency}'}")
+        for p in problems:
+            print("❌", p)
+        if not problems:
+            print("✅ 設定檢查通過")
+        raise SystemExit(1 if problems else 0)
+
+    if args.staged and args.pipeline == "fused":
+        print("⚠️ --staged 只適用 two-stage，改走 two-stage")
+    if args.pipeline == "fused" and (args.verdict_only or args.stream_verdict) \
+            and not args.staged:
+        print("⚠️ fused 模式不串流，忽略 --verdict-only / --stream_verdict")
+
+    problems = load_prompts(args)
+    if problems:
+        raise SystemExit("\n".join(f"❌ {p}" for p in problems))
+    configure_scheduler(args)
+
+    telemetry = Telemetry(args.telemetry) if args.telemetry else None
+    cache = open_cache(args)
+
+    input_path = "data" / pathlib.Path(args.input_file)
+    sharded = (args.workers > 1 and not args.batch_mode
+               and input_path.suffix.lower() in {".xlsx", ".xls"})
+
+    llm = hedged = shard = None
+    if not args.rebuild and not sharded:
+        # --rebuild 只讀 journal，不需要 client / 金鑰；--workers 由各 worker 自建 client
+        llm, hedged = build_llm(args, telemetry, cache, record=args.record)
+
+    util_llm = llm
+    if args.staged and args.util_llm_name and llm is not None:
+        util_args = copy.copy(args)
+        util_args.llm_name = args.util_llm_name
+        util_args.model_name = args.util_model_name or DEFAULT_MODELS[args.util_llm_name]
+        configure_scheduler(util_args)
+        util_llm, _ = build_llm(util_args, telemetry, cache, record=args.record)
+        print(f"Utilizer stage: {util_args.llm_name}/{util_args.model_name}")
 
-    results = []  # 蒐集輸出供寫回 Excel
+    util_prompt  = pathlib.Path(args.util_prompt)
+    store        = open_table_store(args.table_store)
+    vocab        = None if args.rebuild else open_vocab(args)
 
     if input_path.suffix.lower() in {".txt", ".md"}:
         core = input_path.read_text(encoding="utf-8")
-        v, r, tbl = run_one_case(llm, table_dir,
-                                 title=input_path.stem,
-                                 core_text=core,
-                                 idx=0,
-                                 util_prompt_path=util_prompt)
+        v, r, bool_cols, extra_cols = run_one_case(CasePipeline.from_args(args, llm, store,
+                                                                          util_prompt),
+                                                   title=input_path.stem,
+                                                   core_text=core,
+                                                   idx=0,
+                                                   vocab=vocab,
+                                                   verdict_only=args.verdict_only,
+                                                   on_verdict=early_verdict_printer(0, input_path.stem)
+                                                   if args.stream_verdict else None)
+        print("Verdict:", v, "\nReason:", r)
         # print(tbl)
-        # print("Verdict:", v, "\nReason:", r)
 
     elif input_path.suffix.lower() in {".xlsx", ".xls"}:
-        df = pd.read_excel(input_path)
-        for idx, row in df.iterrows():
-            print(idx)
-            title = str(row.get("裁定字號", f"case-{idx}"))
-            core  = str(row.get("reasoning", ""))  # 裁定理由欄
-            if not core.strip():
-                print(f"⚠️ row {idx}: reasoning 空白，跳過")
-                continue
-            
-            existing_factors: set[str] = set()
-            v, r, bool_cols, extra_cols = run_one_case(llm, table_dir, title, core, idx, util_prompt, existing_factors)
-            
-            row_dict = row.to_dict()
-            row_dict.update(bool_cols)   # ← 把 L1~L5 + Accomplice…Victim 9 欄展開
-            row_dict.update({            # 再補 verdict / reason
-                "verdict": v,
-                "reason":  r,
-            })
-            
-            for k, meta in extra_cols.items():        # 動態欄
-                row_dict[f"{k}_value"] = meta["value"]
-                row_dict[f"{k}_type"]  = meta["type"]
-            
-            results.append(row_dict)
-
-            print(f"[{idx}] {title} →", v)
-
-        # 將結果寫回新檔
+        # Excel 只解析一次，之後從 Parquet 快取逐列讀取
+        source = load_sheet(input_path, cache_dir=args.ingest_cache)
         out_dir  = input_path.parent / "output"          # data/output
-        out_dir.mkdir(exist_ok=True)                     # 若還沒建資料夾
-        out_path = out_dir / f"{input_path.stem}_withVerdict.xlsx"
-        out_df = pd.DataFrame(results)
-        
-        # 去掉所有 Unnamed 欄、刪欄名尾空白
-        out_df = out_df.loc[:, ~out_df.columns.str.contains("^Unnamed")]
-        out_df.rename(columns=lambda c: c.strip(), inplace=True)
-        
-        out_df.to_excel(out_path, index=False)
-        print("✅ All done! Saved to", out_path)
+        writer = SheetWriter(out_dir / f"{input_path.stem}_withVerdict.xlsx",
+                             extra_formats=args.output_formats)
+        journal = ResultJournal(args.journal or
+                                input_path.parent / "output" / f"{input_path.stem}.journal.jsonl")
+        if args.resume or args.rebuild:
+            print(f"journal {journal.path}: {len(journal)} 件已完成")
+        duplicates = None
+        if args.dedup != "off" and not args.rebuild:
+            duplicates = plan_duplicates(source, near=args.dedup == "near",
+                                         threshold=args.dedup_threshold)
+        if args.rebuild:
+            rows_from_journal(source, journal, writer)
+        elif args.batch_mode:
+            run_sheet_batch(args, llm, source, writer, input_path, store, util_prompt,
+                            journal=journal, duplicates=duplicates, vocab=vocab)
+        elif sharded:
+            try:
+                shard = ShardRunner(args, util_prompt, telemetry)
+                shard.run(source, writer, journal, duplicates, vocab)
+            except KeyboardInterrupt:
+                print(f"⏸ 中斷；已完成的案件在 {journal.path}，可用 --resume 接續")
+                rows_from_journal(source, journal, writer)
+        elif args.staged:
+            try:
+                asyncio.run(closing(StagedRunner(
+                    llm, util_llm, store, util_prompt,
+                    struct_concurrency=args.struct_concurrency or args.concurrency,
+                    util_concurrency=args.util_concurrency or args.concurrency,
+                    queue_size=args.stage_queue,
+                    verdict_only=args.verdict_only,
+                    on_verdict=early_verdict_printer if args.stream_verdict else None,
+                    case_deadline=args.case_deadline,
+                    vocab=vocab,
+                    chunk_tokens=args.chunk_tokens,
+                    chunk_concurrency=args.chunk_concurrency,
+                ).run(source, writer, journal=journal, resume=args.resume,
+                      duplicates=duplicates), llm, util_llm))
+            except KeyboardInterrupt:
+                print(f"⏸ 中斷；已完成的案件在 {journal.path}，可用 --resume 接續")
+                rows_from_journal(source, journal, writer)
+        elif args.concurrency > 1:
+            try:
+                pipe = CasePipeline.from_args(args, llm, store, util_prompt)
+                asyncio.run(closing(run_sheet_async(pipe, source, writer, args.concurrency,
+                                                    verdict_only=args.verdict_only,
+                                                    stream_verdict=args.stream_verdict,
+                                                    case_deadline=args.case_deadline,
+                                                    journal=journal,
+                                                    resume=args.resume,
+                                                    duplicates=duplicates,
+                                                    vocab=vocab), llm))
+            except KeyboardInterrupt:
+                print(f"⏸ 中斷；已完成的案件在 {journal.path}，可用 --resume 接續")
+                rows_from_journal(source, journal, writer)
+        else:
+            pipe = CasePipeline.from_args(args, llm, store, util_prompt)
+            try:
+                for idx, title, core in iter_cases(source, writer, journal, args.resume,
+                                                   duplicates):
+                    print(idx)
+                    key = case_key(title, core)
+
+                    try:
+                        with deadline(args.case_deadline):
+                            v, r, bool_cols, extra_cols = run_one_case(
+                                pipe, title, core, idx, vocab,
+                                verdict_only=args.verdict_only,
+                                on_verdict=early_verdict_printer(idx, title) if args.stream_verdict else None)
+                    except DeadlineExpired:
+                        print(f"⚠️ row {idx}: 超過 --case_deadline {args.case_deadline}s，跳過")
+                        continue
+                    journal.append(key, title, core, idx, v, r, bool_cols, extra_cols)
+                    writer.add(idx, result_fields(v, r, bool_cols, extra_cols))
+
+                    print(f"[{idx}] {title} →", v)
+            except KeyboardInterrupt:
+                print(f"⏸ 中斷；已完成的案件在 {journal.path}，可用 --resume 接續")
+                rows_from_journal(source, journal, writer)
+        if duplicates:
+            fan_out_duplicates(source, duplicates, writer, journal)
+        if args.factor_matrix:
+            write_factor_matrix(source, journal, args.factor_matrix)
+        journal.close()
+
+        # 將結果寫回新檔：輸入列逐列合併新增欄位，串流寫出 (不組整張 DataFrame)
+        written = writer.close(source)
+        print("✅ All done! Saved to", ", ".join(str(p) for p in written))
 
     else:
         raise ValueError("input_file 必須是 .txt/.md 或 .xlsx/.xls")
 
+    store.close()
+    if vocab is not None:
+        vocab.save()
+        print(vocab.summary())
+    if cache is not None:
+        print("LLM cache:", cache.stats())
+    if shard is not None:                       # --workers：各 worker 回報的加總
+        print("Rate limiter:", {k: dict(v) for k, v in shard.rate_limiter.items()})
+        usage = shard.usage
+    else:
+        print("Rate limiter:", SCHEDULER.stats())
+        usage = getattr(llm, "usage_totals", None)
+    if usage:
+        print(f"Token usage: input {usage['prompt']} "
+              f"(cached {usage['cached']}, uncached {usage['prompt'] - usage['cached']}), "
+              f"output {usage['completion']}")
+    if hedged is not None:
+        print("Hedging:", hedged.stats())
+    if telemetry is not None:
+        print(format_summary(telemetry.close()))
+        print(f"Telemetry: {telemetry.path}")
+
 
 # -----------------------------------------------------------------------------
 # 主流程
@@ -0,0 +1,73 @@
+"""把舊版以列號命名的 table_kb/data_{idx}.md 轉成內容定址的 table store。
+
+舊檔只知道列號，所以要給產生它們的那張 sheet：第 idx 列的裁定書內容 + 目前的
+construct prompt + model 算出 key，表格存成 `<key>.md` 並寫入 裁定字號 索引。
+之後用同一個 model 跑到同一份裁定書 (不論哪張 sheet、第幾列) 都會直接沿用。
+
+    python migrate_table_kb.py --sheet cases_with_reasoning_cleaned.xlsx
+    python migrate_table_kb.py --sheet ... --dest cache/tables.sqlite --keep
+"""
+import re
+import pathlib
+import argparse
+from types import SimpleNamespace
+
+from providers import PROVIDERS, DEFAULT_MODELS
+from structurizer import Structurizer
+from utils.sheet_io import load_sheet, iter_rows
+from utils.table_store import open_table_store
+
+LEGACY = re.compile(r"data_(\d+)\.md")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--sheet", required=True,
+                        help="產生這些表格的輸入檔 (data/ 底下)，列號須與 data_{idx} 對應")
+    parser.add_argument("--src", default="table_kb", help="舊版 data_{idx}.md 所在目錄")
+    parser.add_argument("--dest", default=None, help="目的 table store (預設同 --src)")
+    parser.add_argument("--llm_name", choices=list(PROVIDERS), default="claude",
+                        help="產生舊表格的 provider (決定 model 指紋)")
+    parser.add_argument("--model_name", default=None)
+    parser.add_argument("--ingest_cache", default="cache/ingest")
+    parser.add_argument("--keep", action="store_true", help="保留舊檔 (預設轉換後刪除)")
+    args = parser.parse_args()
+
+    from main import CASE_COLS, case_text
+
+    src = pathlib.Path(args.src)
+    legacy = {int(m.group(1)): p for p in src.iterdir() if (m := LEGACY.fullmatch(p.name))}
+    if not legacy:
+        print(f"{src}: 沒有 data_{{idx}}.md，不需轉換")
+        return
+
+    model = args.model_name or DEFAULT_MODELS[args.llm_name]
+    store = open_table_store(args.dest or src)
+    # 舊表格都是整篇一次建的 → 以不分段的 key 存入
+    structurizer = Structurizer(SimpleNamespace(model_name=model), store=store, chunk_tokens=0)
+    source = load_sheet("data" / pathlib.Path(args.sheet), cache_dir=args.ingest_cache)
+
+    moved = 0
+    for idx, row in iter_rows(source, columns=CASE_COLS):
+        path = legacy.pop(idx, None)
+        if path is None:
+            continue
+        title, core = case_text(idx, row)
+        docs = [{"title": title, "document": core}]
+        key = structurizer.table_key(docs)
+        structurizer.save_response(
+            {"choices": [{"message": {"content": path.read_text(encoding="utf-8")}}]},
+            key, docs)
+        if not args.keep:
+            path.unlink()
+        moved += 1
+    store.close()
+
+    print(f"migrated {moved} tables → {store} (model {model})")
+    if legacy:
+        print(f"⚠️ {len(legacy)} 個檔案在 sheet 中找不到對應列，未轉換: "
+              + ", ".join(p.name for _, p in sorted(legacy.items())))
+
+
+if __name__ == "__main__":
+    main()
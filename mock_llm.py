@@ -0,0 +1,521 @@
+"""Offline stand-in LLM：OpenAI 相容 HTTP server + in-process FakeLLM。
+
+回覆內容：先查 transcript (JSONL，每行 {"messages": [...], "content": "..."})，
+沒有就依 prompt 種類合成：Structurizer → 合法的 Markdown 布林表，
+Utilizer → `TRUE. ...` / `FALSE. ...`，fused prompt → 兩者依序。同一份 messages 永遠得到相同回覆 (以 hash 當亂數種子)。
+延遲 (lognormal)、錯誤率、429 (附 Retry-After) 與 SSE 串流皆可設定。
+
+    python mock_llm.py --port 8000 --latency_ms 800 --throttle_rate 0.05
+    # 任一 client 指過去：
+    python main.py --llm_name openai --base_url http://127.0.0.1:8000/v1 ...
+    python main.py --llm_name claude --base_url http://127.0.0.1:8000 ...
+    python main.py --llm_name qwen   --url 127.0.0.1:8000 ...
+    # 或完全不開 server：
+    python main.py --llm_name mock ...      (設定見 FakeLLM.from_env)
+
+錄製：`main.py --record rec.jsonl` 以 RecordingLLM 包住真 client，之後
+`--transcript rec.jsonl` (或 MOCK_TRANSCRIPT=rec.jsonl) 即可重播。
+"""
+import os
+import json
+import math
+import time
+import uuid
+import random
+import asyncio
+import hashlib
+import pathlib
+import argparse
+import threading
+from collections import Counter
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from typing import Dict, Iterator, List, Optional
+
+from utils.rate_limit import SCHEDULER, estimate_tokens
+from utils.tokens import get_counter
+
+BASE_COLS = ["L1", "L2", "L3", "L4", "L5", "涉及共犯", "涉及外國人", "和解", "被害人考量"]
+EXTRA_COLS = ["媒體影響", "證人人數", "被告認罪", "案件複雜度", "審理期間"]
+VERDICT_REASONS = [
+    "被告就被訴事實為有罪之陳述，且依案件情節不行國民參與審判為適當。",
+    "案件情節繁雜，非經長久時日顯難完成審判。",
+    "無事實足認行國民參與審判有難期公正之虞，仍應行國民參與審判。",
+    "本案尚無國民法官法第6條第1項各款情形。",
+]
+
+
+def messages_key(messages: List[Dict]) -> str:
+    blob = json.dumps(messages, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(blob.encode("utf-8")).hexdigest()
+
+
+class MockResponder:
+    """決定每個請求的回覆、延遲與是否注入錯誤；server 與 FakeLLM 共用。"""
+
+    def __init__(self, transcript: Optional[str] = None, latency_ms: float = 0.0,
+                 latency_sigma: float = 0.5, error_rate: float = 0.0,
+                 throttle_rate: float = 0.0, retry_after: float = 1.0,
+                 chunk_chars: int = 8, seed: int = 1024):
+        self.latency_ms = latency_ms          # lognormal 中位數
+        self.latency_sigma = latency_sigma
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.chunk_chars = chunk_chars
+        self.seed = seed
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self.transcript: Dict[str, str] = {}
+        if transcript:
+            self.load_transcript(transcript)
+        self.stats = Counter()
+
+    def load_transcript(self, path: str) -> None:
+        with open(path, encoding="utf-8") as fh:
+            for line in fh:
+                if line.strip():
+                    rec = json.loads(line)
+                    self.transcript[messages_key(rec["messages"])] = rec["content"]
+        print(f"mock: loaded {len(self.transcript)} transcript entries from {path}")
+
+    # ------------------------------------------------------------------
+    def latency(self) -> float:
+        if self.latency_ms <= 0:
+            return 0.0
+        with self._lock:
+            z = self._rng.gauss(0.0, 1.0)
+        return self.latency_ms / 1000.0 * math.exp(self.latency_sigma * z)
+
+    def fault(self) -> Optional[str]:
+        """→ None / "throttle" (429) / "error" (500)。"""
+        with self._lock:
+            u = self._rng.random()
+        if u < self.throttle_rate:
+            self.stats["throttled"] += 1
+            return "throttle"
+        if u < self.throttle_rate + self.error_rate:
+            self.stats["errors"] += 1
+            return "error"
+        return None
+
+    def reply(self, messages: List[Dict]) -> str:
+        key = messages_key(messages)
+        if key in self.transcript:
+            self.stats["replayed"] += 1
+            return self.transcript[key]
+        self.stats["synthesized"] += 1
+        rng = random.Random(f"{self.seed}:{key}")
+        text = "\n".join(str(m.get("content", "")) for m in messages)
+        if "Structured Knowledge" in text:
+            return self.verdict(rng)
+        if "### Verdict" in text:            # --pipeline fused：表格 + 判決
+            return f"### Table\n{self.table(rng)}\n### Verdict\n{self.verdict(rng)}"
+        return self.table(rng)
+
+    @staticmethod
+    def verdict(rng: random.Random) -> str:
+        return f"{'TRUE' if rng.random() < 0.5 else 'FALSE'}. {rng.choice(VERDICT_REASONS)}"
+
+    @staticmethod
+    def table(rng: random.Random) -> str:
+        extra = rng.sample(EXTRA_COLS, rng.randint(0, 2))
+        header = BASE_COLS + extra
+        values = ["TRUE" if rng.random() < 0.4 else "FALSE" for _ in BASE_COLS]
+        for col in extra:
+            values.append(str(rng.randint(1, 12)) if col in ("證人人數", "審理期間")
+                          else rng.choice(["TRUE", "FALSE"]))
+        return "\n".join("| " + " | ".join(row) + " |" for row in (header, values))
+
+    def chunks(self, text: str) -> Iterator[str]:
+        for i in range(0, len(text), self.chunk_chars):
+            yield text[i:i + self.chunk_chars]
+
+
+# -----------------------------------------------------------------------------
+# In-process client
+# -----------------------------------------------------------------------------
+
+class MockHTTPError(Exception):
+    """與 SDK 例外相同的形狀 (status_code / response.headers)，讓 SCHEDULER 照常退避。"""
+
+    class _Response:
+        def __init__(self, status_code, headers):
+            self.status_code = status_code
+            self.headers = headers
+
+    def __init__(self, status_code: int, retry_after: Optional[float] = None):
+        super().__init__(f"mock HTTP {status_code}")
+        self.status_code = status_code
+        headers = {"retry-after": str(retry_after)} if retry_after is not None else {}
+        self.response = self._Response(status_code, headers)
+
+
+class FakeLLM:
+    """與 OpenAIAPI 等相同介面的 in-process 假 client (不開 socket)。"""
+
+    def __init__(self, model_name: str = "mock", responder: Optional[MockResponder] = None):
+        self.model_name = model_name
+        self.responder = responder or MockResponder()
+        self.response = None
+        self.prompt_tokens = self.completion_tokens = self.total_tokens = 0
+        self.cached_prompt_tokens = 0
+        self.usage_totals = Counter()
+
+    @classmethod
+    def from_env(cls, model_name: str = "mock") -> "FakeLLM":
+        """MOCK_TRANSCRIPT / MOCK_LATENCY_MS / MOCK_LATENCY_SIGMA / MOCK_ERROR_RATE /
+        MOCK_THROTTLE_RATE / MOCK_RETRY_AFTER / MOCK_SEED。"""
+        env = os.environ
+        return cls(model_name, MockResponder(
+            transcript=env.get("MOCK_TRANSCRIPT"),
+            latency_ms=float(env.get("MOCK_LATENCY_MS", 0)),
+            latency_sigma=float(env.get("MOCK_LATENCY_SIGMA", 0.5)),
+            error_rate=float(env.get("MOCK_ERROR_RATE", 0)),
+            throttle_rate=float(env.get("MOCK_THROTTLE_RATE", 0)),
+            retry_after=float(env.get("MOCK_RETRY_AFTER", 1.0)),
+            seed=int(env.get("MOCK_SEED", 1024)),
+        ))
+
+    def _attempt(self, messages):
+        fault = self.responder.fault()
+        if fault == "throttle":
+            raise MockHTTPError(429, self.responder.retry_after)
+        if fault == "error":
+            raise MockHTTPError(500)
+        return self.responder.reply(messages)
+
+    def __call__(self, messages, temperature=0.7, max_tokens=2048, **kw):
+        def attempt():
+            time.sleep(self.responder.latency())
+            return self._attempt(messages)
+
+        content = SCHEDULER.call("mock", self.model_name, attempt,
+                                 cost=estimate_tokens(messages, max_tokens, self.model_name))
+        return self._wrap(content, messages)
+
+    async def acall(self, messages, temperature=0.7, max_tokens=2048, **kw):
+        async def attempt():
+            await asyncio.sleep(self.responder.latency())
+            return self._attempt(messages)
+
+        content = await SCHEDULER.acall("mock", self.model_name, attempt,
+                                        cost=estimate_tokens(messages, max_tokens, self.model_name))
+        return self._wrap(content, messages)
+
+    def stream(self, messages, temperature=0.7, max_tokens=2048, **kw):
+        content = SCHEDULER.call("mock", self.model_name, lambda: self._attempt(messages),
+                                 cost=estimate_tokens(messages, max_tokens, self.model_name))
+        time.sleep(self.responder.latency())          # time to first token
+        pieces = []
+        try:
+            for piece in self.responder.chunks(content):
+                pieces.append(piece)
+                yield piece
+        finally:                                      # 提早中斷時只計已送出的部分
+            self._wrap("".join(pieces), messages)
+
+    async def astream(self, messages, temperature=0.7, max_tokens=2048, **kw):
+        async def attempt():
+            return self._attempt(messages)
+
+        content = await SCHEDULER.acall("mock", self.model_name, attempt,
+                                        cost=estimate_tokens(messages, max_tokens, self.model_name))
+        await asyncio.sleep(self.responder.latency())
+        pieces = []
+        try:
+            for piece in self.responder.chunks(content):
+                pieces.append(piece)
+                yield piece
+        finally:
+            self._wrap("".join(pieces), messages)
+
+    def _wrap(self, content, messages):
+        counter = get_counter(self.model_name)
+        self.prompt_tokens = counter.count_messages(messages)
+        self.completion_tokens = counter.count(content)
+        self.total_tokens = self.prompt_tokens + self.completion_tokens
+        self.usage_totals.update(prompt=self.prompt_tokens, cached=0,
+                                 completion=self.completion_tokens)
+        self.response = {
+            "choices": [{
+                "message": {"role": "assistant", "content": content},
+                "finish_reason": "stop",
+            }],
+            "model": self.model_name,
+            "usage": {
+                "prompt_tokens": self.prompt_tokens,
+                "cached_tokens": 0,
+                "completion_tokens": self.completion_tokens,
+            },
+        }
+        return self.response
+
+
+class RecordingLLM:
+    """包住真 client，把 (messages, content) 寫成 transcript，供 mock 之後重播。
+
+    串流只在讀完整段回覆時才記錄 (verdict-only 提早關閉的半截回覆不寫)。
+    同一程序內寫同一個檔案的 RecordingLLM (hedge、--util_llm_name) 共用一把鎖。
+    """
+
+    _LOCKS: Dict[str, threading.Lock] = {}
+
+    def __init__(self, llm, path: str or pathlib.Path):
+        self.llm = llm
+        self.path = pathlib.Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = self._LOCKS.setdefault(str(self.path.resolve()), threading.Lock())
+
+    def __getattr__(self, name):
+        return getattr(self.llm, name)
+
+    def _record(self, messages, resp):
+        self._write(messages, resp["choices"][0]["message"]["content"])
+
+    def _write(self, messages, content: str) -> None:
+        line = json.dumps({"messages": messages, "content": content}, ensure_ascii=False)
+        with self._lock, self.path.open("a", encoding="utf-8") as fh:
+            fh.write(line + "\n")
+
+    def __call__(self, messages, temperature=0.7, max_tokens=2048, **kw):
+        resp = self.llm(messages, temperature=temperature, max_tokens=max_tokens, **kw)
+        self._record(messages, resp)
+        return resp
+
+    async def acall(self, messages, temperature=0.7, max_tokens=2048, **kw):
+        resp = await self.llm.acall(messages, temperature=temperature,
+                                    max_tokens=max_tokens, **kw)
+        self._record(messages, resp)
+        return resp
+
+    def stream(self, messages, temperature=0.7, max_tokens=2048, **kw):
+        pieces = []
+        inner = self.llm.stream(messages, temperature=temperature, max_tokens=max_tokens, **kw)
+        try:
+            for piece in inner:
+                pieces.append(piece)
+                yield piece
+        finally:
+            inner.close()
+        self._write(messages, "".join(pieces))
+
+    async def astream(self, messages, temperature=0.7, max_tokens=2048, **kw):
+        pieces = []
+        inner = self.llm.astream(messages, temperature=temperature,
+                                 max_tokens=max_tokens, **kw)
+        try:
+            async for piece in inner:
+                pieces.append(piece)
+                yield piece
+        finally:
+            await inner.aclose()
+        self._write(messages, "".join(pieces))
+
+
+# -----------------------------------------------------------------------------
+# HTTP server (OpenAI /v1/chat/completions + Anthropic /v1/messages)
+# -----------------------------------------------------------------------------
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"          # keep-alive，與真 server 行為一致
+    responder: MockResponder = None
+
+    def log_message(self, fmt, *args):
+        pass
+
+    def _send_json(self, status: int, obj: Dict, headers: Optional[Dict] = None) -> None:
+        body = json.dumps(obj, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _start_sse(self) -> None:
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+
+    def _sse(self, data: Dict, event: Optional[str] = None) -> None:
+        out = (f"event: {event}\n" if event else "") + \
+              f"data: {json.dumps(data, ensure_ascii=False)}\n\n"
+        self.wfile.write(out.encode("utf-8"))
+        self.wfile.flush()
+
+    def do_GET(self):
+        if self.path.rstrip("/") in ("/health", "/v1/health"):
+            self._send_json(200, {"status": "ok", **self.responder.stats})
+        elif self.path.rstrip("/") == "/v1/models":
+            self._send_json(200, {"object": "list",
+                                  "data": [{"id": "mock", "object": "model"}]})
+        else:
+            self._send_json(404, {"error": {"message": f"no route {self.path}"}})
+
+    def do_POST(self):
+        n = int(self.headers.get("Content-Length", 0))
+        body = json.loads(self.rfile.read(n) or b"{}")
+        path = self.path.split("?")[0].rstrip("/")
+        if path.endswith("/chat/completions"):
+            messages, anthropic = body.get("messages", []), False
+        elif path.endswith("/messages"):
+            # Anthropic：system 另外放；轉回 OpenAI 格式再決定回覆，key 才會與其他 client 相同
+            system = body.get("system") or []
+            if isinstance(system, str):
+                system = [{"text": system}]
+            messages = [{"role": "system", "content": b["text"]} for b in system]
+            for m in body.get("messages", []):
+                content = m["content"]
+                if isinstance(content, list):     # content blocks
+                    content = "".join(b.get("text", "") for b in content)
+                messages.append({"role": m["role"], "content": content})
+            anthropic = True
+        else:
+            self._send_json(404, {"error": {"message": f"no route {self.path}"}})
+            return
+
+        self.responder.stats["requests"] += 1
+        fault = self.responder.fault()
+        if fault == "throttle":
+            self._send_json(429, {"error": {"type": "rate_limit_error",
+                                            "message": "mock rate limit"}},
+                            {"Retry-After": f"{self.responder.retry_after:g}"})
+            return
+        if fault == "error":
+            self._send_json(500, {"error": {"type": "api_error", "message": "mock failure"}})
+            return
+
+        time.sleep(self.responder.latency())
+        content = self.responder.reply(messages)
+        model = body.get("model", "mock")
+        counter = get_counter(model)
+        prompt_tokens = counter.count_messages(messages)
+        completion_tokens = counter.count(content)
+
+        if body.get("stream"):
+            self._start_sse()
+            if anthropic:
+                self._stream_anthropic(model, content, prompt_tokens, completion_tokens)
+            else:
+                include_usage = (body.get("stream_options") or {}).get("include_usage")
+                self._stream_openai(model, content, prompt_tokens, completion_tokens,
+                                    include_usage)
+            return
+
+        if anthropic:
+            self._send_json(200, {
+                "id": f"msg_{uuid.uuid4().hex[:24]}", "type": "message",
+                "role": "assistant", "model": model,
+                "content": [{"type": "text", "text": content}],
+                "stop_reason": "end_turn", "stop_sequence": None,
+                "usage": {"input_tokens": prompt_tokens, "output_tokens": completion_tokens,
+                          "cache_read_input_tokens": 0, "cache_creation_input_tokens": 0},
+            })
+        else:
+            self._send_json(200, {
+                "id": f"chatcmpl-{uuid.uuid4().hex[:24]}", "object": "chat.completion",
+                "created": int(time.time()), "model": model,
+                "choices": [{"index": 0, "finish_reason": "stop",
+                             "message": {"role": "assistant", "content": content}}],
+                "usage": {"prompt_tokens": prompt_tokens,
+                          "completion_tokens": completion_tokens,
+                          "total_tokens": prompt_tokens + completion_tokens,
+                          "prompt_tokens_details": {"cached_tokens": 0}},
+            })
+
+    def _stream_openai(self, model: str, content: str, prompt_tokens: int = 0,
+                       completion_tokens: int = 0, include_usage: bool = False) -> None:
+        cid, created = f"chatcmpl-{uuid.uuid4().hex[:24]}", int(time.time())
+
+        def chunk(delta, finish=None):
+            return {"id": cid, "object": "chat.completion.chunk", "created": created,
+                    "model": model,
+                    "choices": [{"index": 0, "delta": delta, "finish_reason": finish}]}
+
+        try:
+            self._sse(chunk({"role": "assistant", "content": ""}))
+            for piece in self.responder.chunks(content):
+                self._sse(chunk({"content": piece}))
+            self._sse(chunk({}, "stop"))
+            if include_usage:                 # stream_options.include_usage：choices 為空的 usage chunk
+                self._sse({"id": cid, "object": "chat.completion.chunk", "created": created,
+                           "model": model, "choices": [],
+                           "usage": {"prompt_tokens": prompt_tokens,
+                                     "completion_tokens": completion_tokens,
+                                     "total_tokens": prompt_tokens + completion_tokens}})
+            self.wfile.write(b"data: [DONE]\n\n")
+        except (BrokenPipeError, ConnectionResetError):
+            pass                              # client 提早中斷 (verdict-only)
+
+    def _stream_anthropic(self, model, content, prompt_tokens, completion_tokens) -> None:
+        try:
+            self._sse({"type": "message_start", "message": {
+                "id": f"msg_{uuid.uuid4().hex[:24]}", "type": "message",
+                "role": "assistant", "model": model, "content": [],
+                "stop_reason": None, "stop_sequence": None,
+                "usage": {"input_tokens": prompt_tokens, "output_tokens": 0}}},
+                "message_start")
+            self._sse({"type": "content_block_start", "index": 0,
+                       "content_block": {"type": "text", "text": ""}}, "content_block_start")
+            for piece in self.responder.chunks(content):
+                self._sse({"type": "content_block_delta", "index": 0,
+                           "delta": {"type": "text_delta", "text": piece}},
+                          "content_block_delta")
+            self._sse({"type": "content_block_stop", "index": 0}, "content_block_stop")
+            self._sse({"type": "message_delta",
+                       "delta": {"stop_reason": "end_turn", "stop_sequence": None},
+                       "usage": {"output_tokens": completion_tokens}}, "message_delta")
+            self._sse({"type": "message_stop"}, "message_stop")
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+
+def serve(responder: MockResponder, host: str = "127.0.0.1", port: int = 8000,
+          background: bool = False) -> ThreadingHTTPServer:
+    """啟動 server；background=True 時在 daemon thread 執行並立即回傳 (測試用)。"""
+    handler = type("Handler", (MockHandler,), {"responder": responder})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    if background:
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline OpenAI / Anthropic 相容 mock LLM server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--transcript", default=None,
+                        help="JSONL：{messages, content}；命中即重播 (main.py --record 可錄製)")
+    parser.add_argument("--latency_ms", type=float, default=0.0, help="延遲中位數 (ms)")
+    parser.add_argument("--latency_sigma", type=float, default=0.5,
+                        help="lognormal σ；越大尾延遲越長")
+    parser.add_argument("--error_rate", type=float, default=0.0, help="回 500 的機率")
+    parser.add_argument("--throttle_rate", type=float, default=0.0,
+                        help="回 429 (附 Retry-After) 的機率")
+    parser.add_argument("--retry_after", type=float, default=1.0)
+    parser.add_argument("--chunk_chars", type=int, default=8, help="串流每段字數")
+    parser.add_argument("--seed", type=int, default=1024)
+    args = parser.parse_args()
+
+    responder = MockResponder(args.transcript, args.latency_ms, args.latency_sigma,
+                              args.error_rate, args.throttle_rate, args.retry_after,
+                              args.chunk_chars, args.seed)
+    server = serve(responder, args.host, args.port)
+    print(f"mock LLM on http://{args.host}:{args.port}  "
+          f"(OpenAI: /v1/chat/completions, Anthropic: /v1/messages)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print("mock stats:", dict(responder.stats))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,37 +1,155 @@
 # openai_api.py
 import os, functools, openai
+from collections import Counter
+from utils.rate_limit import SCHEDULER, estimate_tokens
+from utils.hedging import timeout_kw
+from utils.tokens import get_counter
 
 class OpenAIAPI:
-    def __init__(self, api_key=None, model_name="gpt-4o-mini"):
+    def __init__(self, api_key=None, model_name="gpt-4o-mini", base_url=None):
         api_key = api_key or os.getenv("OPENAI_API_KEY")
         if not api_key:
             raise EnvironmentError("OPENAI_API_KEY 未設定")
         # 1.x 寫法：建立 client 物件
-        self.client = openai.OpenAI(api_key=api_key)
+        self.api_key = api_key
+        # 重試交給共用 SCHEDULER，SDK 內建重試關閉以免疊加
+        # base_url：OpenAI 相容 server (vLLM / mock_llm.py)；未給則用 OPENAI_BASE_URL 或官方端點
+        self.base_url = base_url
+        self.client = openai.OpenAI(api_key=api_key, base_url=base_url, max_retries=0)
+        self._aclient = None          # AsyncOpenAI：第一次 acall 時才建立
         self.model_name = model_name
         self.response = None
+        self.cached_prompt_tokens = 0
+        self.usage_totals = Counter()     # 整輪累計：prompt / cached / completion
+
+    @property
+    def aclient(self):
+        if self._aclient is None:
+            self._aclient = openai.AsyncOpenAI(api_key=self.api_key, base_url=self.base_url,
+                                              max_retries=0)
+        return self._aclient
 
     def __call__(self, messages, temperature=0.7, max_tokens=2048, **kw):
-        resp = self.client.chat.completions.create(
-            model=self.model_name,
-            messages=messages,
-            temperature=temperature,
-            max_tokens=max_tokens,
-            **kw
+        resp = SCHEDULER.call(
+            "openai", self.model_name,
+            lambda: self.client.chat.completions.create(
+                model=self.model_name,
+                messages=messages,
+                temperature=temperature,
+                max_tokens=max_tokens,
+                **timeout_kw(kw)
+            ),
+            cost=estimate_tokens(messages, max_tokens, self.model_name),
         )
-        self.response = resp      # 保留完整物件
-        choice = resp.choices[0].message.content
+        return self._wrap(resp, messages)
+
+    async def acall(self, messages, temperature=0.7, max_tokens=2048, **kw):
+        """Async 版本；介面與回傳格式同 __call__，供 main --concurrency 使用。"""
+        resp = await SCHEDULER.acall(
+            "openai", self.model_name,
+            lambda: self.aclient.chat.completions.create(
+                model=self.model_name,
+                messages=messages,
+                temperature=temperature,
+                max_tokens=max_tokens,
+                **timeout_kw(kw)
+            ),
+            cost=estimate_tokens(messages, max_tokens, self.model_name),
+        )
+        return self._wrap(resp, messages)
+
+    def stream(self, messages, temperature=0.7, max_tokens=2048, **kw):
+        """逐段 yield 文字；呼叫端提早 close() generator 即中斷串流、不再計費。"""
+        resp = SCHEDULER.call(
+            "openai", self.model_name,
+            lambda: self.client.chat.completions.create(
+                model=self.model_name,
+                messages=messages,
+                temperature=temperature,
+                max_tokens=max_tokens,
+                stream=True,
+                stream_options={"include_usage": True},     # 最後一個 chunk 附 usage
+                **timeout_kw(kw)
+            ),
+            cost=estimate_tokens(messages, max_tokens, self.model_name),
+        )
+        usage, pieces = None, []
+        try:
+            for chunk in resp:
+                usage = chunk.usage or usage
+                if chunk.choices and chunk.choices[0].delta.content:
+                    pieces.append(chunk.choices[0].delta.content)
+                    yield chunk.choices[0].delta.content
+        finally:
+            resp.close()
+            self._stream_usage(messages, usage, pieces)
 
-        # usage 統計
-        usage = resp.usage
+    async def astream(self, messages, temperature=0.7, max_tokens=2048, **kw):
+        resp = await SCHEDULER.acall(
+            "openai", self.model_name,
+            lambda: self.aclient.chat.completions.create(
+                model=self.model_name,
+                messages=messages,
+                temperature=temperature,
+                max_tokens=max_tokens,
+                stream=True,
+                stream_options={"include_usage": True},
+                **timeout_kw(kw)
+            ),
+            cost=estimate_tokens(messages, max_tokens, self.model_name),
+        )
+        usage, pieces = None, []
+        try:
+            async for chunk in resp:
+                usage = chunk.usage or usage
+                if chunk.choices and chunk.choices[0].delta.content:
+                    pieces.append(chunk.choices[0].delta.content)
+                    yield chunk.choices[0].delta.content
+        finally:
+            await resp.close()
+            self._stream_usage(messages, usage, pieces)
+
+    def _record_usage(self, messages, usage) -> None:
+        details = getattr(usage, "prompt_tokens_details", None)
+        self.cached_prompt_tokens = getattr(details, "cached_tokens", 0) or 0
         self.prompt_tokens     = usage.prompt_tokens
         self.completion_tokens = usage.completion_tokens
         self.total_tokens      = usage.total_tokens
+        self.usage_totals.update(prompt=self.prompt_tokens,
+                                 cached=self.cached_prompt_tokens,
+                                 completion=self.completion_tokens)
+        get_counter(self.model_name).observe(messages, self.prompt_tokens)
+
+    def _stream_usage(self, messages, usage, pieces) -> None:
+        """串流結束：有 usage chunk 就照實記錄；提早中斷 (沒收到) 時以 utils.tokens 估算，
+        估算值不拿來校正估算器。"""
+        if usage is not None:
+            self._record_usage(messages, usage)
+            return
+        counter = get_counter(self.model_name)
+        self.cached_prompt_tokens = 0
+        self.prompt_tokens = counter.count_messages(messages)
+        self.completion_tokens = counter.count("".join(pieces))
+        self.total_tokens = self.prompt_tokens + self.completion_tokens
+        self.usage_totals.update(prompt=self.prompt_tokens, cached=0,
+                                 completion=self.completion_tokens)
+
+    def _wrap(self, resp, messages=()):
+        self.response = resp      # 保留完整物件
+        choice = resp.choices[0].message.content
+
+        # usage 統計；OpenAI 對 ≥1024 token 的相同前綴自動快取 (cached_tokens)
+        self._record_usage(messages, resp.usage)
 
         return {
             "choices": [{
                 "message": {"role": "assistant", "content": choice},
                 "finish_reason": resp.choices[0].finish_reason
             }],
-            "model": self.model_name
+            "model": self.model_name,
+            "usage": {
+                "prompt_tokens": self.prompt_tokens,
+                "cached_tokens": self.cached_prompt_tokens,
+                "completion_tokens": self.completion_tokens,
+            },
         }
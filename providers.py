@@ -0,0 +1,73 @@
+"""Provider registry：`--llm_name` → client class，用到哪家才 import 哪家的 SDK。
+
+`validate()` 只查環境變數與 SDK 是否安裝 (importlib.util.find_spec，不真的 import)，
+供 main.py --dry-run 與健康檢查使用。
+"""
+import os
+import importlib
+import importlib.util
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+
+class Provider(NamedTuple):
+    module: str                  # client 所在模組
+    cls: str                     # client class 名稱
+    sdk: Optional[str]           # 需要的第三方套件 (find_spec 用)；None = 不需要
+    env_keys: Tuple[str, ...]    # 任一存在即可；空 tuple 表示不需金鑰
+    default_model: str
+
+
+PROVIDERS: Dict[str, Provider] = {
+    "claude": Provider("claude_api", "ClaudeAPI", "anthropic",
+                       ("ANTHROPIC_API_KEY",), "claude-3-7-sonnet-20250219"),
+    "openai": Provider("openai_api", "OpenAIAPI", "openai",
+                       ("OPENAI_API_KEY",), "gpt-4o-mini"),
+    "gemini": Provider("gemini_api", "GeminiAPI", "google.generativeai",
+                       ("GOOGLE_API_KEY", "GEMINI_API_KEY"), "gemini-2.0-flash"),
+    "qwen":   Provider("utils.qwenapi", "QwenAPI", "requests",
+                       (), "Qwen"),          # vLLM --served-model-name
+    "mock":   Provider("mock_llm", "FakeLLM", None,
+                       (), "mock"),          # 離線 in-process 假 client
+}
+
+DEFAULT_MODELS = {name: p.default_model for name, p in PROVIDERS.items()}
+
+
+def client_class(llm_name: str):
+    """第一次用到時才 import 對應模組 (與其 SDK)。"""
+    p = PROVIDERS[llm_name]
+    return getattr(importlib.import_module(p.module), p.cls)
+
+
+def make_client(llm_name: str, model_name: str = None, url: str = None,
+                base_url: str = None):
+    """url：qwen 的 host:port；base_url：openai / claude 改打相容 server (如 mock_llm.py)。"""
+    model_name = model_name or DEFAULT_MODELS[llm_name]
+    cls = client_class(llm_name)
+    if llm_name == "qwen":
+        return cls(url=f"http://{url}/v1/chat/completions", model_name=model_name)
+    if llm_name == "mock":
+        return cls.from_env(model_name)
+    if base_url and llm_name in ("openai", "claude"):
+        return cls(model_name=model_name, base_url=base_url)
+    return cls(model_name=model_name)
+
+
+def _sdk_installed(name: str) -> bool:
+    try:
+        return importlib.util.find_spec(name) is not None
+    except ModuleNotFoundError:          # 父套件 (google) 不存在
+        return False
+
+
+def validate(llm_name: str) -> List[str]:
+    """→ 問題清單 (空 = 可用)；不 import SDK、不連網。"""
+    p = PROVIDERS.get(llm_name)
+    if p is None:
+        return [f"未知的 provider: {llm_name} (可用: {', '.join(PROVIDERS)})"]
+    problems = []
+    if p.sdk and not _sdk_installed(p.sdk):
+        problems.append(f"{llm_name}: 未安裝套件 {p.sdk}")
+    if p.env_keys and not any(os.getenv(k) for k in p.env_keys):
+        problems.append(f"{llm_name}: 請設定 {' / '.join(p.env_keys)}")
+    return problems
@@ -1,3 +1,6 @@
+from utils.prompts import PROMPTS
+
+
 class Router:
     def __init__(self, llm):
         self.llm = llm
@@ -5,9 +8,7 @@ class Router:
     def do_route(self, query, core_content, data_id):
         print(f"data_id: {data_id}, do_route...") 
         
-        raw_prompt = open("prompts/route.txt", "r").read()
-
-        prompt = raw_prompt.format(
+        prompt = PROMPTS.get("prompts/route.txt").format(
             query=query,
             titles=core_content
         )
@@ -0,0 +1,233 @@
+"""--workers N：多程序 sharded runner。
+
+主程序把輸入列逐列放進共用的 task queue (有上限，邊讀邊放)，N 個 worker 程序各自建
+LLM client、跑 main.run_one_case，做完就再拿下一件 —— 快的 worker 自然多拿，不必像
+main_original.py 那樣預先切固定的 200 列。結果經 result queue 回到主程序，由主程序統一
+寫 journal、交給 SheetWriter (依列號排序輸出)，進度也集中在主程序印。
+
+多組金鑰：設定 `<KEY>S=k1,k2,…` (例如 ANTHROPIC_API_KEYS)，worker i 使用第 i % n 組；
+同一組金鑰的 worker 平分 --rpm / --tpm (未給則平分 DEFAULT_LIMITS)。
+
+--telemetry：各 worker 寫自己的 <PATH>.w<i>，結束時把事件連同限流統計、token 用量一起
+回報給主程序，由主程序併進 <PATH> 並印出整體摘要。
+"""
+import os
+import queue
+import pathlib
+import threading
+import multiprocessing as mp
+from collections import Counter
+from typing import Any, Dict, Optional
+
+from providers import PROVIDERS
+from utils.table_store import open_table_store
+
+RESULT_POLL = 1.0      # 主程序等結果的逾時 (秒)；逾時就檢查 worker 是否還活著
+
+
+def key_pool(env_key: str):
+    """`<KEY>S` 裡逗號分隔的多組金鑰；沒設就是空 list。"""
+    raw = os.getenv(env_key + "S", "")
+    return [k.strip() for k in raw.split(",") if k.strip()]
+
+
+def assign_keys(llm_names, wid: int, workers: int) -> int:
+    """把第 wid 個 worker 的金鑰環境變數換成輪到的那一組；回傳共用同組金鑰的 worker 數。"""
+    share = workers
+    for name in llm_names:
+        p = PROVIDERS.get(name)
+        for env_key in (p.env_keys if p else ()):
+            pool = key_pool(env_key)
+            if pool:
+                os.environ[env_key] = pool[wid % len(pool)]
+                share = min(share, sum(1 for w in range(workers)
+                                       if w % len(pool) == wid % len(pool)))
+                break
+    return share
+
+
+def worker_main(wid: int, args, util_prompt: str, tasks, results) -> None:
+    """worker 程序進入點 (spawn)：取 task → run_one_case → 回報，直到收到 None。"""
+    import main as app
+    from utils.hedging import DeadlineExpired, deadline
+    from utils.rate_limit import SCHEDULER
+    from utils.telemetry import Telemetry
+
+    share = assign_keys([args.llm_name, args.hedge_llm], wid, args.workers)
+    app.load_prompts(args)                          # 主程序已驗證過，這裡只是各自載入一次
+    app.configure_scheduler(args, share=share)
+    telemetry = Telemetry(f"{args.telemetry}.w{wid}") if args.telemetry else None
+    cache = app.open_cache(args)
+    llm, _ = app.build_llm(args, telemetry, cache,
+                           record=f"{args.record}.w{wid}" if args.record else None)
+    store = open_table_store(args.table_store)       # 各程序自己的連線 / handle
+    vocab = app.open_vocab(args)                     # 唯讀快照：只挑提示欄名，存檔由主程序負責
+    pipe = app.CasePipeline.from_args(args, llm, store, pathlib.Path(util_prompt))
+
+    try:
+        while True:
+            item = tasks.get()
+            if item is None:
+                break
+            idx, title, core = item
+            try:
+                with deadline(args.case_deadline):
+                    out = app.run_one_case(pipe, title, core, idx, vocab,
+                                           verdict_only=args.verdict_only,
+                                           on_verdict=(app.early_verdict_printer(idx, title)
+                                                       if args.stream_verdict else None))
+            except DeadlineExpired:
+                results.put(("skip", wid, idx,
+                             f"超過 --case_deadline {args.case_deadline}s"))
+            except Exception as e:          # 單件失敗不拖垮整個 worker
+                results.put(("error", wid, idx, repr(e)))
+            else:
+                results.put(("done", wid, idx, out))
+    finally:
+        store.close()
+        if telemetry is not None:
+            telemetry.close()
+        stats: Dict[str, Any] = {"rate_limiter": SCHEDULER.stats(),
+                                 "usage": dict(getattr(llm, "usage_totals", None) or {})}
+        if telemetry is not None:
+            stats["telemetry"] = list(telemetry.events)
+        if cache is not None:
+            stats["cache"] = cache.stats()
+            cache.close()
+        results.put(("exit", wid, None, stats))
+
+
+class ShardRunner:
+    """主程序端：啟動 worker、餵工作、收結果並合併。"""
+
+    def __init__(self, args, util_prompt: pathlib.Path, telemetry=None):
+        self.args = args
+        self.workers = args.workers
+        self.util_prompt = util_prompt
+        self.telemetry = telemetry              # 主程序的 Telemetry：併入各 worker 的事件
+        self.ctx = mp.get_context("spawn")      # 不 fork 主程序的 thread / socket / SQLite 連線
+        self.progress = Counter()
+        self.per_worker = Counter()
+        self.rate_limiter: Dict[str, Counter] = {}  # 各 worker 的 SCHEDULER.stats() 加總
+        self.usage = Counter()                      # 各 worker 的 usage_totals 加總
+        self.reported = set()                       # 已回報統計 ("exit") 的 worker
+        self.feed_error: Optional[BaseException] = None   # feeder thread 讀檔失敗 → run() 重新丟出
+
+    # ------------------------------------------------------------------
+    def _feed(self, source, writer, journal, duplicates, tasks, pending: Dict[int, tuple],
+              stop: threading.Event) -> None:
+        """feeder thread：逐列放進 task queue；--resume 命中的列直接交給 writer。"""
+        from main import iter_cases
+
+        try:
+            for idx, title, core in iter_cases(source, writer, journal, self.args.resume,
+                                               duplicates):
+                if stop.is_set():
+                    break
+                pending[idx] = (title, core)
+                self.progress["queued"] += 1
+                while not stop.is_set():
+                    try:
+                        tasks.put((idx, title, core), timeout=RESULT_POLL)
+                        break
+                    except queue.Full:
+                        continue
+        except BaseException as e:          # 例外不能死在 daemon thread 裡：交給 run() 處理
+            self.feed_error = e
+        finally:
+            self.progress["fed_all"] = 1
+            for _ in range(self.workers):
+                tasks.put(None)
+
+    def run(self, source: pathlib.Path, writer, journal, duplicates=None, vocab=None) -> None:
+        from main import result_fields
+        from utils.journal import case_key
+
+        tasks = self.ctx.Queue(maxsize=self.workers * 4)
+        results = self.ctx.Queue()
+        pending: Dict[int, tuple] = {}
+        stop = threading.Event()
+
+        procs = [self.ctx.Process(target=worker_main, name=f"shard-{wid}",
+                                  args=(wid, self.args, str(self.util_prompt),
+                                        tasks, results))
+                 for wid in range(self.workers)]
+        for p in procs:
+            p.start()
+        print(f"Sharded run: {self.workers} workers")
+        feeder = threading.Thread(target=self._feed, name="shard-feeder", daemon=True,
+                                  args=(source, writer, journal, duplicates,
+                                        tasks, pending, stop))
+        feeder.start()
+
+        exited = set()
+        try:
+            while len(exited) < self.workers:
+                try:
+                    kind, wid, idx, payload = results.get(timeout=RESULT_POLL)
+                except queue.Empty:
+                    dead = [wid for wid, p in enumerate(procs)
+                            if not p.is_alive() and wid not in exited]
+                    for wid in dead:
+                        print(f"⚠️ worker {wid} 異常結束 (exitcode {procs[wid].exitcode})")
+                        exited.add(wid)
+                    continue
+                if kind == "exit":
+                    exited.add(wid)
+                    self._report_worker(wid, payload)
+                    continue
+                title, core = pending.pop(idx)
+                self.per_worker[wid] += 1
+                if kind == "done":
+                    v, r, bool_cols, extra_cols = payload
+                    if vocab is not None:          # worker 各自的快照可能不同 → 以主程序為準
+                        extra_cols = vocab.observe(extra_cols)
+                    journal.append(case_key(title, core), title, core, idx,
+                                   v, r, bool_cols, extra_cols)
+                    writer.add(idx, result_fields(v, r, bool_cols, extra_cols))
+                    self.progress["done"] += 1
+                    print(f"[{idx}] {title} → {v}  ({self.status()}, w{wid})")
+                else:
+                    self.progress[kind] += 1
+                    print(f"⚠️ row {idx}: {payload}，跳過 (w{wid})")
+        except BaseException:
+            stop.set()
+            for p in procs:
+                p.terminate()
+            raise
+        finally:
+            stop.set()
+            for p in procs:
+                p.join(timeout=5)
+        feeder.join(timeout=RESULT_POLL)
+        if self.feed_error is not None:
+            raise RuntimeError(f"讀取輸入失敗，只跑了 {self.status()}；"
+                               "修正後可用 --resume 補跑") from self.feed_error
+        if pending:
+            print(f"⚠️ {len(pending)} 件未完成 (worker 異常結束)；可用 --resume 補跑")
+        lost = self.workers - len(self.reported)
+        if lost:
+            print(f"⚠️ {lost} 個 worker 未回報統計；整體 telemetry / 用量不含這些 worker")
+        print("Sharded run:", self.status(),
+              "per worker:", dict(sorted(self.per_worker.items())))
+
+    def status(self) -> str:
+        p = self.progress
+        total = "?" if not p["fed_all"] else p["queued"]
+        text = f"{p['done'] + p['error'] + p['skip']}/{total}"
+        if p["error"] or p["skip"]:
+            text += f" (error {p['error']}, skip {p['skip']})"
+        return text
+
+    def _report_worker(self, wid: int, stats: Optional[Dict[str, Any]]) -> None:
+        if not stats:
+            return
+        self.reported.add(wid)
+        if "cache" in stats:
+            print(f"w{wid} LLM cache:", stats["cache"])
+        print(f"w{wid} Rate limiter:", stats["rate_limiter"])
+        for key, st in stats["rate_limiter"].items():
+            self.rate_limiter.setdefault(key, Counter()).update(st)
+        self.usage.update(stats.get("usage", {}))
+        if self.telemetry is not None:
+            self.telemetry.absorb(stats.get("telemetry", ()))
@@ -0,0 +1,178 @@
+"""--staged：Structurizer / Utilizer 兩組 worker 以 bounded queue 串接 (asyncio)。
+
+    rows ─▶ [struct queue] ─▶ S 個 Structurizer worker ─▶ [util queue] ─▶ U 個 Utilizer worker
+
+第 i+1 件的建表不必等第 i 件的判決回來；兩個階段各自有並行上限 (可打不同 model / 額度)，
+下游 queue 滿了上游就停 (backpressure)，不會把整張表都先建完堆在記憶體。結束時印出各階段
+的忙碌比例與「等上游 / 被下游卡住」的時間，看得出哪一段是瓶頸。
+"""
+import time
+import asyncio
+import pathlib
+from typing import Any, Dict, List
+
+from structurizer import Structurizer
+from utilizer import Utilizer
+from utils.hedging import DeadlineExpired, deadline
+from utils.journal import case_key
+from utils.table_store import TableStore
+
+DONE = object()      # queue 結束標記
+
+
+class StageStats:
+    """單一階段的累計：處理件數、忙碌 / 等上游 (starved) / 等下游 (blocked) 秒數。"""
+
+    def __init__(self, name: str, workers: int):
+        self.name = name
+        self.workers = workers
+        self.items = 0
+        self.busy_s = self.starved_s = self.blocked_s = 0.0
+
+    def summary(self, wall_s: float) -> Dict[str, Any]:
+        capacity = max(wall_s * self.workers, 1e-9)
+        return {
+            "workers": self.workers,
+            "items": self.items,
+            "utilization": round(self.busy_s / capacity, 3),
+            "starved": round(self.starved_s / capacity, 3),
+            "blocked": round(self.blocked_s / capacity, 3),
+        }
+
+
+class StagedRunner:
+    QUERY = "本案是否仍行國民法官審判？"
+
+    def __init__(self, struct_llm, util_llm, store: TableStore,
+                 util_prompt: pathlib.Path, struct_concurrency: int,
+                 util_concurrency: int, queue_size: int = None,
+                 verdict_only: bool = False, on_verdict=None,
+                 case_deadline: float = None, vocab=None, chunk_tokens: int = None,
+                 chunk_concurrency: int = None):
+        self.structurizer = Structurizer(struct_llm, store=store, chunk_tokens=chunk_tokens,
+                                         chunk_concurrency=chunk_concurrency)
+        self.utilizer = Utilizer(util_llm, prompt_path=str(util_prompt))
+        self.queue_size = queue_size or 2 * util_concurrency
+        self.verdict_only = verdict_only
+        self.on_verdict = on_verdict           # (idx, title) → callback，同 early_verdict_printer
+        self.case_deadline = case_deadline
+        self.vocab = vocab                     # FactorVocab (見 run_one_case)
+        self.stats = {"structurize": StageStats("structurize", struct_concurrency),
+                      "utilize": StageStats("utilize", util_concurrency)}
+
+    # ------------------------------------------------------------------
+    @staticmethod
+    async def _get(q: asyncio.Queue, st: StageStats):
+        t0 = time.monotonic()
+        item = await q.get()
+        st.starved_s += time.monotonic() - t0
+        return item
+
+    @staticmethod
+    async def _put(q: asyncio.Queue, item, st: StageStats) -> None:
+        t0 = time.monotonic()
+        await q.put(item)
+        st.blocked_s += time.monotonic() - t0
+
+    def _left(self, due):
+        return None if due is None else due - time.monotonic()
+
+    async def _structurize(self, q_in, q_out) -> None:
+        from main import parse_table_cols
+
+        st = self.stats["structurize"]
+        while True:
+            item = await self._get(q_in, st)
+            if item is DONE:
+                return
+            idx, title, core = item
+            due = None if self.case_deadline is None else time.monotonic() + self.case_deadline
+            t0 = time.monotonic()
+            try:
+                with deadline(self.case_deadline):
+                    table_md = await self.structurizer.ado_construct_table(
+                        docs=[{"title": title, "document": core}], data_id=idx,
+                        existing_factors=self.vocab.relevant(core) if self.vocab else None)
+            except DeadlineExpired:
+                print(f"⚠️ row {idx}: 超過 --case_deadline {self.case_deadline}s (structurize)，跳過")
+                continue
+            finally:
+                st.busy_s += time.monotonic() - t0
+            bool_cols, extra_cols = parse_table_cols(table_md, idx, self.vocab)
+            st.items += 1
+            await self._put(q_out, (idx, title, core, table_md, bool_cols, extra_cols, due), st)
+
+    async def _utilize(self, q_in, finish) -> None:
+        st = self.stats["utilize"]
+        while True:
+            item = await self._get(q_in, st)
+            if item is DONE:
+                return
+            idx, title, core, table_md, bool_cols, extra_cols, due = item
+            t0 = time.monotonic()
+            try:
+                with deadline(self._left(due)):
+                    v, r = await self.utilizer.ainfer_boolean(
+                        query=self.QUERY, data_id=idx, core_text=core,
+                        verdict_only=self.verdict_only, table_md=table_md,
+                        on_verdict=self.on_verdict(idx, title) if self.on_verdict else None)
+            except DeadlineExpired:
+                print(f"⚠️ row {idx}: 超過 --case_deadline {self.case_deadline}s (utilize)，跳過")
+                continue
+            finally:
+                st.busy_s += time.monotonic() - t0
+            st.items += 1
+            finish(idx, title, core, v, r, bool_cols, extra_cols)
+
+    async def run(self, source: pathlib.Path, writer, journal=None, resume: bool = False,
+                  duplicates=None):
+        from main import iter_cases, result_fields
+
+        n_struct = self.stats["structurize"].workers
+        n_util = self.stats["utilize"].workers
+        q_struct: asyncio.Queue = asyncio.Queue(maxsize=n_struct)
+        q_util: asyncio.Queue = asyncio.Queue(maxsize=self.queue_size)
+
+        def finish(idx, title, core, v, r, bool_cols, extra_cols):
+            if journal is not None:
+                journal.append(case_key(title, core), title, core, idx, v, r,
+                               bool_cols, extra_cols)
+            writer.add(idx, result_fields(v, r, bool_cols, extra_cols))
+            print(f"[{idx}] {title} →", v)
+
+        async def produce():
+            for case in iter_cases(source, writer, journal, resume, duplicates):
+                await q_struct.put(case)
+            for _ in range(n_struct):
+                await q_struct.put(DONE)
+
+        async def struct_stage():
+            await asyncio.gather(*(self._structurize(q_struct, q_util)
+                                   for _ in range(n_struct)))
+            for _ in range(n_util):
+                await q_util.put(DONE)
+
+        t0 = time.monotonic()
+        tasks: List[asyncio.Future] = [asyncio.ensure_future(produce()),
+                                       asyncio.ensure_future(struct_stage())]
+        tasks += [asyncio.ensure_future(self._utilize(q_util, finish)) for _ in range(n_util)]
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+            print(format_stage_stats(self.summary(time.monotonic() - t0)))
+
+    def summary(self, wall_s: float) -> Dict[str, Any]:
+        return {name: st.summary(wall_s) for name, st in self.stats.items()}
+
+
+def format_stage_stats(summary: Dict[str, Dict[str, Any]]) -> str:
+    lines = ["Stage utilization (busy / starved / blocked，佔 workers × 牆鐘時間):"]
+    for name, s in summary.items():
+        lines.append(f"  {name:<12} x{s['workers']:<3} {s['items']:>5} 件  "
+                     f"busy {s['utilization']:.0%}  starved {s['starved']:.0%}  "
+                     f"blocked {s['blocked']:.0%}")
+    busiest = max(summary, key=lambda k: summary[k]["utilization"])
+    lines.append(f"  瓶頸：{busiest} (可提高其並行數或額度)")
+    return "\n".join(lines)
@@ -1,6 +1,16 @@
 import json, pathlib
+import asyncio
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Dict, Set
 
+from utils.prompts import PROMPTS
+from utils.telemetry import stage
+from utils.tokens import get_counter
+from utils.sections import chunk_sections
+from utils.markdown_table import parse_row, merge_rows, format_row
+from utils.table_store import TableStore, DirTableStore, table_key
+
 class Structurizer:
     """產生 <單一> Markdown Boolean Table。
     允許動態欄位；可將現有欄名清單 (existing_factors) 傳入，
@@ -11,11 +21,22 @@ class Structurizer:
         "L1", "L2", "L3", "L4", "L5",
         "涉及共犯", "涉及外國人", "和解", "被害人考量",
     ]
+    PROMPT = "prompts/construct_boolean_table.txt"
+    CHUNK_TOKENS = 32000        # 裁定書超過此 token 數改走分段建表 (map-reduce)；0 = 不分段
+    CHUNK_CONCURRENCY = 4       # 分段建表時同時在途的段數
 
-    def __init__(self, llm, table_kb_path: str or pathlib.Path = "table_kb") -> None:
+    def __init__(self, llm, table_kb_path: str or pathlib.Path = "table_kb",
+                 store: TableStore or None = None, chunk_tokens: int = None,
+                 chunk_concurrency: int = None) -> None:
         self.llm = llm
-        self.table_kb_path = pathlib.Path(table_kb_path)
-        self.table_kb_path.mkdir(exist_ok=True)
+        self.store = store if store is not None else DirTableStore(table_kb_path)
+        self.chunk_tokens = self.CHUNK_TOKENS if chunk_tokens is None else chunk_tokens
+        self.chunk_concurrency = chunk_concurrency or self.CHUNK_CONCURRENCY
+        PROMPTS.register(self.PROMPT, "structurize")    # 建構時就載入並驗證 prompt
+
+    @property
+    def template(self):
+        return PROMPTS.get(self.PROMPT, "structurize")
 
     # ------------------------------------------------------------------
     def do_construct_table(
@@ -25,40 +46,162 @@ class Structurizer:
         instruction: str = "",
         existing_factors: Set[str] or None = None,
     ) -> str:
-        """Merge *docs* → prompt LLM → save `data_{id}.md`.
-        Returns the **header row** (first line) for logging.
+        """Merge *docs* → prompt LLM → save to the table store.
+        Returns the **table markdown** so callers can hand it to the Utilizer directly.
+        The same document + prompt + model seen before reuses the stored table (no LLM call).
         """
+        key = self.table_key(docs)
+        table_md = self.reuse(key, docs, data_id)
+        if table_md is not None:
+            return table_md
+        parts = self.chunks(docs, data_id)
+        if parts:
+            with ThreadPoolExecutor(max_workers=min(self.chunk_concurrency, len(parts))) as pool:
+                # 每段各自一份 context：stage / deadline 等 contextvar 照樣生效
+                futures = [pool.submit(contextvars.copy_context().run, self._call_chunk,
+                                       messages, data_id)
+                           for messages in self.chunk_messages(parts, existing_factors)]
+                replies = [f.result() for f in futures]
+            return self.save_table(self.merge_partials(replies, data_id), key, docs)
+        print(f"data_id {data_id}: build boolean table … (n_docs={len(docs)})")
+        messages = self.compose_messages(docs, existing_factors)
+
+        with stage("structurize", data_id):
+            response = self.llm(messages, temperature=0.0)
+        return self.save_response(response, key, docs)
+
+    async def ado_construct_table(
+        self,
+        docs: List[Dict],
+        data_id: int,
+        instruction: str = "",
+        existing_factors: Set[str] or None = None,
+    ) -> str:
+        """asyncio 版 do_construct_table：改走 `llm.acall`，其餘行為相同。"""
+        key = self.table_key(docs)
+        table_md = self.reuse(key, docs, data_id)
+        if table_md is not None:
+            return table_md
+        parts = self.chunks(docs, data_id)
+        if parts:
+            sem = asyncio.Semaphore(self.chunk_concurrency)
+
+            async def one(messages):
+                async with sem:
+                    with stage("structurize", data_id):
+                        response = await self.llm.acall(messages, temperature=0.0)
+                return response["choices"][0]["message"]["content"]
+
+            replies = await asyncio.gather(*(one(m) for m in
+                                             self.chunk_messages(parts, existing_factors)))
+            return self.save_table(self.merge_partials(replies, data_id), key, docs)
         print(f"data_id {data_id}: build boolean table … (n_docs={len(docs)})")
+        messages = self.compose_messages(docs, existing_factors)
 
+        with stage("structurize", data_id):
+            response = await self.llm.acall(messages, temperature=0.0)
+        return self.save_response(response, key, docs)
+
+    # ------------------------------------------------------------------
+    def compose_messages(self, docs: List[Dict],
+                         existing_factors: Set[str] or None = None) -> List[Dict]:
+        """→ [system: 法條/立法理由等靜態前綴, user: 裁定書 + 輸出格式 + 既有欄名]。
+        靜態前綴每件相同，可吃到 provider 的 prompt caching。
+        """
         core_content = "\n".join(d["document"] for d in docs)
-        existing_factors = existing_factors or set()
-
-        # -------------------- Compose prompt --------------------------
-        raw_prompt = pathlib.Path("prompts/construct_boolean_table.txt").read_text()
-        extra_section = ""
-        if existing_factors:
-            extra_section = (
-                "\n### Existing factors (已出現欄名，請優先沿用)\n"
+        return self.template.messages(extra=self.factors_section(existing_factors),
+                                      core=core_content.strip())
+
+    # ------------------------------------------------------------------
+    # 長裁定書：依段落切成數段，各段各自建表 (並行)，再合併成一張
+    # ------------------------------------------------------------------
+    def is_long(self, core_content: str) -> bool:
+        if not self.chunk_tokens:
+            return False
+        return get_counter(getattr(self.llm, "model_name", "")).count(core_content) \
+            > self.chunk_tokens
+
+    def chunks(self, docs: List[Dict], data_id) -> List[str] or None:
+        """超過 chunk_tokens 的裁定書 → 依 事實 / 理由 / 一、… 切好的段落；否則 None。"""
+        core_content = "\n".join(d["document"] for d in docs).strip()
+        if not self.is_long(core_content):
+            return None
+        counter = get_counter(getattr(self.llm, "model_name", ""))
+        parts = chunk_sections(core_content, self.chunk_tokens, counter.count)
+        print(f"data_id {data_id}: long document ({counter.count(core_content)} tokens) "
+              f"→ {len(parts)} chunks")
+        return parts
+
+    def chunk_messages(self, parts: List[str],
+                       existing_factors: Set[str] or None = None) -> List[List[Dict]]:
+        n = len(parts)
+        return [self.template.messages(
+                    extra=self.factors_section(existing_factors)
+                    + f"\n### 分段說明\n本段為裁定書第 {i}/{n} 段；只依本段內容填表，"
+                      "本段未提及的欄位填 FALSE。",
+                    core=part.strip())
+                for i, part in enumerate(parts, 1)]
+
+    def _call_chunk(self, messages: List[Dict], data_id) -> str:
+        with stage("structurize", data_id):
+            response = self.llm(messages, temperature=0.0)
+        return response["choices"][0]["message"]["content"]
+
+    def merge_partials(self, replies: List[str], data_id) -> str:
+        """各段的表格 → 一張表 (布林欄 OR；其他值不一致時取多數並在表格下方註明)。"""
+        merged, conflicts = merge_rows([parse_row(r, self.BASE_COLS) for r in replies],
+                                       self.BASE_COLS)
+        table_md = format_row(merged)
+        if conflicts:
+            note = "；".join(f"{k} = {' / '.join(v)}" for k, v in conflicts.items())
+            print(f"⚠️ data_id {data_id}: 分段結果不一致 ({note})")
+            table_md += f"\n\n> 分段結果不一致 (取多數，同票取後段)：{note}"
+        return table_md
+
+    @staticmethod
+    def factors_section(existing_factors: Set[str] or None = None) -> str:
+        if not existing_factors:
+            return ""
+        return ("\n### Existing factors (已出現欄名，請優先沿用)\n"
                 + ", ".join(sorted(existing_factors))
-                + "\n若無相符再新增新欄。"
-            )
-        prompt = raw_prompt.format(core=core_content.strip()) + extra_section
+                + "\n若無相符再新增新欄。")
 
-        response = self.llm([
-            {"role": "user", "content": prompt}
-        ], temperature=0.0)
+    def table_key(self, docs: List[Dict]) -> str:
+        """裁定書內容 + prompt 指紋 + model → table store 的 key (與列號無關)。
+
+        既有欄名提示不納入 key：提示只影響用詞 (輸出欄名之後會經 FactorVocab 正規化)，
+        納入的話字彙表每長大一次，已存的表格就全部失效。
+        """
+        core_content = "\n".join(d["document"] for d in docs)
+        if self.is_long(core_content.strip()):       # 分段建表的結果另有自己的 key
+            prompt_fp = self.template.fingerprint_with(self.factors_section(),
+                                                       f"chunk_tokens={self.chunk_tokens}")
+        else:
+            prompt_fp = self.template.fingerprint_with(self.factors_section())
+        return table_key(core_content, prompt_fp, getattr(self.llm, "model_name", ""))
+
+    def reuse(self, key: str, docs: List[Dict], data_id) -> str or None:
+        """table store 已有同一份表格 → 直接回傳 (並更新 裁定字號 索引)；否則 None。"""
+        table_md = self.store.get(key)
+        if table_md is None:
+            return None
+        print(f"data_id {data_id}: reuse stored table {key}")
+        for d in docs:
+            self.store.link(d["title"], key)
+        return table_md
+
+    def save_response(self, response: Dict, key: str, docs: List[Dict] = ()) -> str:
         table_md = response["choices"][0]["message"]["content"].strip()
 
         # print(f"[DEBUG] Structurizer LLM output ↓\n{response}\n")
         # print(f"[DEBUG] Structurizer LLM output ↓\n{table_md}\n")
-        
-
-        # -------------------- Save --------------------------
-        out_path = self.table_kb_path / f"data_{data_id}.md"
-        out_path.write_text(table_md, encoding="utf-8")
+        return self.save_table(table_md, key, docs)
 
-        # -------------------- Return header -----------------
-        return table_md.split("\n", 1)[0]
+    def save_table(self, table_md: str, key: str, docs: List[Dict] = ()) -> str:
+        self.store.put(key, table_md)
+        for d in docs:
+            self.store.link(d["title"], key)
+        return table_md
 
 
     # def __init__(self, llm, chunk_kb_path, graph_kb_path, table_kb_path, algorithm_kb_path, catalogue_kb_path):
@@ -1,6 +1,12 @@
 import re
-import pathlib, io, pandas as pd
-from typing import Dict
+import pathlib
+from typing import Dict, List
+
+from utils.prompts import PROMPTS
+from utils.telemetry import stage
+
+# 串流回覆開頭的判決 token；後面需再跟一個非字母字元才算完整 (避免 "TRU" 半截)
+VERDICT_HEAD = re.compile(r"^[\s\*]*(?P<tok>true|false|unknown)(?=[^a-z])", re.IGNORECASE)
 
 class Utilizer():
     """Boolean-table Utilizer: read table markdown, prompt LLM, return bool."""
@@ -14,29 +20,94 @@ class Utilizer():
     五、其他有事實足認行國民參與審判顯不適當。
     """
 
-    def __init__(self, llm, table_kb_path: str or pathlib.Path,
-                 prompt_path: str = "prompts/util_boolean.txt"):
+    def __init__(self, llm, prompt_path: str = "prompts/util_boolean.txt"):
         self.llm = llm
-        self.table_kb_path = pathlib.Path(table_kb_path)
         self.prompt_path = pathlib.Path(prompt_path)
-        if not self.prompt_path.exists():
-            raise FileNotFoundError(self.prompt_path)
+        PROMPTS.register(self.prompt_path, "utilize")   # 建構時就載入並驗證；檔案不存在丟 FileNotFoundError
+
+    @property
+    def template(self):
+        return PROMPTS.get(self.prompt_path, "utilize")
 
     # ------------------------------------------------------------------
-    def infer_boolean(self, query: str, core_text: str, data_id: int or str) -> bool:
-        """Read data_<id>.md -> ask LLM -> return True/False."""
-        md_file = self.table_kb_path / f"data_{data_id}.md"
-        if not md_file.exists():
-            raise FileNotFoundError(md_file)
-        table_md = md_file.read_text(encoding="utf-8")
+    def infer_boolean(self, query: str, core_text: str, data_id: int or str,
+                      verdict_only: bool = False, on_verdict=None, *,
+                      table_md: str) -> bool:
+        """Table (from Structurizer) -> ask LLM -> return True/False.
+
+        verdict_only / on_verdict 時改用串流：開頭 TRUE/FALSE 一出現就回呼
+        on_verdict(verdict)；verdict_only 則立刻關閉串流、reason 留空。
+        """
+        messages = self.compose_messages(query, core_text, data_id, table_md)
+
+        with stage("utilize", data_id):
+            if verdict_only or on_verdict is not None:
+                pieces = self.llm.stream(messages, temperature=0.0)
+                buf, decided = "", False
+                try:
+                    for piece in pieces:
+                        buf += piece
+                        if not decided:
+                            decided, verdict = self.match_verdict(buf)
+                            if decided:
+                                if on_verdict is not None:
+                                    on_verdict(verdict)
+                                if verdict_only:
+                                    return verdict, ""
+                finally:
+                    pieces.close()
+                return self.parse_reply(buf)
+
+            reply = self.llm(messages, temperature=0.0)["choices"][0]["message"]["content"]
+            return self.parse_reply(reply)
+
+    async def ainfer_boolean(self, query: str, core_text: str, data_id: int or str,
+                             verdict_only: bool = False, on_verdict=None, *,
+                             table_md: str) -> bool:
+        """asyncio 版 infer_boolean：改走 `llm.acall` / `llm.astream`。"""
+        messages = self.compose_messages(query, core_text, data_id, table_md)
+
+        with stage("utilize", data_id):
+            if verdict_only or on_verdict is not None:
+                pieces = self.llm.astream(messages, temperature=0.0)
+                buf, decided = "", False
+                try:
+                    async for piece in pieces:
+                        buf += piece
+                        if not decided:
+                            decided, verdict = self.match_verdict(buf)
+                            if decided:
+                                if on_verdict is not None:
+                                    on_verdict(verdict)
+                                if verdict_only:
+                                    return verdict, ""
+                finally:
+                    await pieces.aclose()
+                return self.parse_reply(buf)
+
+            reply = (await self.llm.acall(messages, temperature=0.0))["choices"][0]["message"]["content"]
+            return self.parse_reply(reply)
+
+    @staticmethod
+    def match_verdict(buf: str):
+        """串流開頭已能判定時 → (True, verdict)；UNKNOWN 的 verdict 為 None。"""
+        m = VERDICT_HEAD.match(buf)
+        if m is None:
+            return False, None
+        tok = m.group("tok").upper()
+        return True, (None if tok == "UNKNOWN" else tok == "TRUE")
 
-        raw_prompt = self.prompt_path.read_text(encoding="utf-8")
-        prompt = raw_prompt.format(table=table_md.strip(), query=query, core=core_text)
+    # ------------------------------------------------------------------
+    def compose_messages(self, query: str, core_text: str, data_id: int or str,
+                         table_md: str) -> List[Dict]:
+        """→ [system: 靜態法條前綴, user: 布林表 + 裁定書 + Task]。
 
-        reply = self.llm([
-            {"role": "user", "content": prompt}
-        ], temperature=0.0)["choices"][0]["message"]["content"]
+        table_md 由呼叫端傳入 (table store 以內容雜湊為 key，無法只憑 data_id 找回表格)。
+        """
+        return self.template.messages(table=table_md.strip(), query=query, core=core_text)
 
+    @staticmethod
+    def parse_reply(reply: str):
         m = re.match(
             r"""^[\s\*]*          # 可能的 * 與空白
                 (?P<tok>true|false)
@@ -52,8 +123,10 @@ class Utilizer():
             verdict = m.group("tok").upper().startswith("T")
             reason  = m.group("rest").strip().lstrip('。.')
         else:
+            # UNKNOWN 或格式不符：verdict 留空，整段回覆當 reason
             print('utilizer 輸出有問題')
-            
+            verdict, reason = None, reply.strip()
+
         return verdict, reason
     
     # def __init__(self, llm, chunk_kb_path, graph_kb_path, table_kb_path, algorithm_kb_path, catalogue_kb_path):
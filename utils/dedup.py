@@ -0,0 +1,144 @@
+"""送 LLM 之前的重複案件偵測：完全相同 (正規化後 hash) + 近似重複 (MinHash / LSH)。
+
+重新爬取的裁定書常只差空白、全形半形或頁首頁尾等樣板文字；正規化後 hash 相同即為
+完全重複，其餘以字元 shingle 的 MinHash 估計 Jaccard 相似度，LSH 分桶找候選、
+再以估計值 >= threshold 確認。同一群只留第一列 (代表) 送 LLM，結果再複製回其他列。
+"""
+import re
+import hashlib
+import unicodedata
+from typing import Dict, Iterable, List, Optional, Tuple
+
+MERSENNE = (1 << 61) - 1
+MAX_HASH = (1 << 32) - 1
+WHITESPACE = re.compile(r"\s+")
+PUNCT = re.compile(r"[，。、；：「」『』（）()《》〈〉！？,.;:!?\"'\-─_＿*#|]")
+
+
+def normalize(text: str) -> str:
+    """NFKC (全形→半形) + 去掉所有空白與標點；只比內容，不比排版。"""
+    text = unicodedata.normalize("NFKC", text)
+    return PUNCT.sub("", WHITESPACE.sub("", text))
+
+
+def exact_hash(norm: str) -> str:
+    return hashlib.sha1(norm.encode("utf-8")).hexdigest()
+
+
+class MinHasher:
+    """datasketch 式 MinHash：shingle 先 sha1 取 32-bit，再用 num_perm 組 (a·x + b) mod p。"""
+
+    def __init__(self, num_perm: int = 128, shingle: int = 5, seed: int = 1024):
+        import numpy as np
+
+        self.np = np
+        self.num_perm = num_perm
+        self.shingle = shingle
+        rng = np.random.RandomState(seed)
+        self.a = rng.randint(1, MERSENNE, size=num_perm, dtype=np.uint64)
+        self.b = rng.randint(0, MERSENNE, size=num_perm, dtype=np.uint64)
+
+    def shingles(self, norm: str) -> Iterable[str]:
+        k = self.shingle
+        if len(norm) <= k:
+            return [norm]
+        return {norm[i:i + k] for i in range(len(norm) - k + 1)}
+
+    def signature(self, norm: str):
+        np = self.np
+        hv = np.fromiter((int.from_bytes(hashlib.sha1(s.encode("utf-8")).digest()[:4], "little")
+                          for s in self.shingles(norm)), dtype=np.uint64)
+        # (a·x + b) mod p：uint64 溢位回繞，與 datasketch 相同做法，分布仍足夠均勻
+        phv = (np.outer(hv, self.a) + self.b) % np.uint64(MERSENNE) & np.uint64(MAX_HASH)
+        return phv.min(axis=0)
+
+    def similarity(self, sig_a, sig_b) -> float:
+        return float((sig_a == sig_b).mean())
+
+
+class DuplicatePlan:
+    """dedup 結果：rep_of[idx] = 代表列號；只有重複列 (非代表) 會出現在 rep_of。"""
+
+    def __init__(self):
+        self.rep_of: Dict[int, int] = {}
+        self.kind: Dict[int, str] = {}           # idx → "exact" / "near"
+        self.rows = 0
+
+    def __contains__(self, idx: int) -> bool:
+        return idx in self.rep_of
+
+    def __len__(self) -> int:
+        return len(self.rep_of)
+
+    def summary(self) -> str:
+        exact = sum(1 for k in self.kind.values() if k == "exact")
+        return (f"dedup: {self.rows} 列 → {self.rows - len(self)} 件送 LLM "
+                f"(完全重複 {exact}、近似重複 {len(self) - exact})")
+
+
+def find_duplicates(rows: Iterable[Tuple[int, str]], near: bool = True,
+                    threshold: float = 0.9, num_perm: int = 128,
+                    shingle: int = 5) -> DuplicatePlan:
+    """rows = [(idx, 裁定書內容)] (依列號順序)；先出現的列當代表。
+
+    LSH 分桶數依 threshold 自動挑 (band 數 × 每 band 列數 = num_perm)，
+    使候選門檻 (1/b)^(1/r) 略低於 threshold，再以 MinHash 估計值確認。
+    """
+    plan = DuplicatePlan()
+    by_hash: Dict[str, int] = {}
+    reps: List[int] = []
+    norms: Dict[int, str] = {}
+    for idx, text in rows:
+        plan.rows += 1
+        norm = normalize(text)
+        h = exact_hash(norm)
+        if h in by_hash:
+            plan.rep_of[idx], plan.kind[idx] = by_hash[h], "exact"
+            continue
+        by_hash[h] = idx
+        reps.append(idx)
+        if near:
+            norms[idx] = norm
+
+    if not near or len(reps) < 2:
+        return plan
+
+    hasher = MinHasher(num_perm=num_perm, shingle=shingle)
+    bands, rows_per_band = _lsh_params(threshold, num_perm)
+    sigs = {idx: hasher.signature(norms[idx]) for idx in reps}
+    buckets: Dict[Tuple[int, bytes], List[int]] = {}
+    for idx in reps:                                  # reps 依列號遞增
+        sig = sigs[idx]
+        match: Optional[int] = None
+        for band in range(bands):
+            key = (band, sig[band * rows_per_band:(band + 1) * rows_per_band].tobytes())
+            for other in buckets.get(key, ()):
+                if other not in plan.rep_of and \
+                        hasher.similarity(sig, sigs[other]) >= threshold:
+                    match = other
+                    break
+            if match is not None:
+                break
+        if match is not None:
+            plan.rep_of[idx], plan.kind[idx] = match, "near"
+            continue
+        for band in range(bands):
+            key = (band, sig[band * rows_per_band:(band + 1) * rows_per_band].tobytes())
+            buckets.setdefault(key, []).append(idx)
+    # 完全重複的列若指向後來被判為近似重複的代表，改指最終代表
+    for idx, rep in plan.rep_of.items():
+        while rep in plan.rep_of:
+            rep = plan.rep_of[rep]
+        plan.rep_of[idx] = rep
+    return plan
+
+
+def _lsh_params(threshold: float, num_perm: int) -> Tuple[int, int]:
+    best = (num_perm, 1)
+    for r in range(1, num_perm + 1):
+        if num_perm % r:
+            continue
+        b = num_perm // r
+        if (1.0 / b) ** (1.0 / r) <= threshold * 0.9:
+            best = (b, r)
+    return best
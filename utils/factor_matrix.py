@@ -0,0 +1,305 @@
+"""整批案件的稀疏 案件 × 動態欄 矩陣 (--factor_matrix 的輸出)。
+
+_withVerdict.xlsx 把每個動態欄展開成 `{k}_value` / `{k}_type` 兩欄，欄名一多就變成又寬又
+幾乎全空的表。這裡改存成 CSR：只記有出現的儲存格 (列, 欄 id, 型別, 值)，記憶體與寫檔
+時間只和非空儲存格數成正比。
+- base：BASE_COLS 的稠密布林矩陣 (n_cases × 9)，幾乎每件都有，不必走稀疏格式。
+- factors：欄名字典 (欄 id → 名稱)。
+- 值依型別分放：value_bool / value_num (float64) / value_date (datetime64[D]) /
+  value_text (字串池 text_pool 的代碼，-1 = 無)，types 記每格的型別代碼 (TYPES)。
+存檔：`.npz` 結尾 → numpy 壓縮檔；其餘視為目錄 → cases / factors / cells 三個 Parquet。
+FactorMatrix.load() 讀回兩種格式；to_scipy() / dense() 供分析用。
+"""
+import json
+import pathlib
+from array import array
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+TYPES = ("empty", "bool", "number", "date", "text")
+TYPE_CODE = {t: i for i, t in enumerate(TYPES)}
+VERDICT_CODE = {True: 1, False: 0, None: -1}
+
+
+class FactorMatrixBuilder:
+    """逐件 add()，最後 build() 一次轉成 numpy 陣列。"""
+
+    def __init__(self, base_cols: Sequence[str]):
+        self.base_cols = list(base_cols)
+        self.factor_ids: Dict[str, int] = {}
+        self.text_ids: Dict[str, int] = {}
+        self.case_idx = array("q")
+        self.titles: List[str] = []
+        self.verdicts = array("b")
+        self.base = bytearray()
+        self.rows, self.cols, self.codes = array("i"), array("i"), array("b")
+        self.nums, self.texts = array("d"), array("i")
+
+    def add(self, idx: int, title: str, verdict, bool_cols: Dict[str, Any],
+            extra_cols: Dict[str, Dict[str, Any]]) -> None:
+        row = len(self.case_idx)
+        self.case_idx.append(idx)
+        self.titles.append(title)
+        self.verdicts.append(VERDICT_CODE.get(verdict, -1))
+        self.base.extend(bool(bool_cols.get(c)) for c in self.base_cols)
+        for name, meta in extra_cols.items():
+            code = TYPE_CODE.get(meta.get("type"), TYPE_CODE["text"])
+            value = meta.get("value")
+            num, text = float("nan"), -1
+            if code == TYPE_CODE["bool"]:
+                num = float(bool(value) if not isinstance(value, str) else value.upper() == "TRUE")
+            elif code == TYPE_CODE["number"]:
+                try:
+                    num = float(value)
+                except (TypeError, ValueError):
+                    code = TYPE_CODE["text"]
+            if code in (TYPE_CODE["date"], TYPE_CODE["text"]):
+                text = self.text_ids.setdefault(str(value), len(self.text_ids))
+            self.rows.append(row)
+            self.cols.append(self.factor_ids.setdefault(name, len(self.factor_ids)))
+            self.codes.append(code)
+            self.nums.append(num)
+            self.texts.append(text)
+
+    def build(self) -> "FactorMatrix":
+        import numpy as np
+
+        n = len(self.case_idx)
+        rows = np.frombuffer(self.rows, dtype=np.int32) if self.rows else np.zeros(0, np.int32)
+        cols = np.frombuffer(self.cols, dtype=np.int32) if self.cols else np.zeros(0, np.int32)
+        order = np.lexsort((cols, rows))              # CSR：列內依欄 id 排序
+        codes = np.frombuffer(self.codes, dtype=np.int8)[order] if self.codes \
+            else np.zeros(0, np.int8)
+        nums = np.frombuffer(self.nums, dtype=np.float64)[order] if self.nums \
+            else np.zeros(0, np.float64)
+        texts = np.frombuffer(self.texts, dtype=np.int32)[order] if self.texts \
+            else np.zeros(0, np.int32)
+        pool = list(self.text_ids)
+        return FactorMatrix(
+            base_cols=self.base_cols,
+            factors=list(self.factor_ids),
+            case_idx=np.frombuffer(self.case_idx, dtype=np.int64).copy() if n
+            else np.zeros(0, np.int64),
+            titles=self.titles,
+            verdict=np.frombuffer(self.verdicts, dtype=np.int8).copy() if n
+            else np.zeros(0, np.int8),
+            base=np.frombuffer(bytes(self.base), dtype=np.bool_).reshape(n, len(self.base_cols)),
+            indptr=np.concatenate([[0], np.cumsum(np.bincount(rows, minlength=n))]).astype(np.int64),
+            indices=cols[order],
+            types=codes,
+            value_num=nums,
+            value_text=texts,
+            text_pool=pool,
+        )
+
+
+class FactorMatrix:
+    """CSR 形式的 案件 × 動態欄 矩陣 + BASE_COLS 稠密區塊。"""
+
+    def __init__(self, base_cols, factors, case_idx, titles, verdict, base,
+                 indptr, indices, types, value_num, value_text, text_pool):
+        self.base_cols = list(base_cols)
+        self.factors = list(factors)
+        self.case_idx = case_idx
+        self.titles = list(titles)
+        self.verdict = verdict            # 1 / 0 / -1 (無法判定)
+        self.base = base
+        self.indptr = indptr
+        self.indices = indices
+        self.types = types
+        self.value_num = value_num
+        self.value_text = value_text
+        self.text_pool = list(text_pool)
+
+    @property
+    def shape(self) -> Tuple[int, int]:
+        return len(self.case_idx), len(self.factors)
+
+    @property
+    def nnz(self) -> int:
+        return len(self.indices)
+
+    def __repr__(self) -> str:
+        return (f"FactorMatrix({self.shape[0]} cases × {self.shape[1]} factors, "
+                f"nnz={self.nnz}, base={len(self.base_cols)})")
+
+    # ------------------------------------------------------------------
+    @property
+    def value_bool(self):
+        """bool 型別的格 → True/False；其他型別為 False (搭配 types 判斷)。"""
+        return (self.types == TYPE_CODE["bool"]) & (self.value_num == 1.0)
+
+    @property
+    def value_date(self):
+        import numpy as np
+        import pandas as pd
+
+        out = np.full(self.nnz, np.datetime64("NaT"), dtype="datetime64[D]")
+        mask = self.types == TYPE_CODE["date"]
+        if mask.any():
+            pool = np.array(self.text_pool, dtype=object)
+            dates = pd.to_datetime(pd.Series(pool[self.value_text[mask]]),
+                                   format="%Y-%m-%d", errors="coerce")
+            out[mask] = dates.to_numpy().astype("datetime64[D]")
+        return out
+
+    def row_of(self):
+        """每格所在的列 (COO 的 row 陣列)。"""
+        import numpy as np
+        return np.repeat(np.arange(self.shape[0]), np.diff(self.indptr))
+
+    def column(self, name: str):
+        """→ (列號 case_idx, 型別代碼, 數值, 文字)；只含該欄有出現的案件。"""
+        import numpy as np
+
+        fid = self.factors.index(name)
+        mask = self.indices == fid
+        pool = np.array(self.text_pool + [None], dtype=object)
+        return (self.case_idx[self.row_of()[mask]], self.types[mask],
+                self.value_num[mask], pool[self.value_text[mask]])
+
+    def to_scipy(self, kind: str = "bool"):
+        """→ scipy.sparse.csr_matrix；kind="bool" 只取 TRUE 的格，"number" 取數值格。"""
+        import numpy as np
+        from scipy.sparse import csr_matrix
+
+        if kind == "bool":
+            data = self.value_bool.astype(np.int8)
+        elif kind == "number":
+            data = np.where(self.types == TYPE_CODE["number"], self.value_num, 0.0)
+        else:
+            raise ValueError("kind 只能是 bool / number")
+        m = csr_matrix((data, self.indices, self.indptr), shape=self.shape)
+        m.eliminate_zeros()
+        return m
+
+    def dense(self, factors: Sequence[str] = None):
+        """→ pandas DataFrame (列 = 案件)；只展開指定的動態欄，值依型別還原。"""
+        import pandas as pd
+
+        df = pd.DataFrame(self.base, columns=self.base_cols, index=self.case_idx)
+        df.insert(0, "verdict", pd.Series(self.verdict, index=self.case_idx)
+                  .map({1: True, 0: False, -1: None}))
+        df.insert(0, "裁定字號", self.titles)
+        for name in factors if factors is not None else self.factors:
+            idx, types, nums, texts = self.column(name)
+            vals = [_typed(t, n, s) for t, n, s in zip(types, nums, texts)]
+            df[name] = pd.Series(vals, index=idx, dtype=object)
+        return df
+
+    # ------------------------------------------------------------------
+    def save(self, path: str or pathlib.Path) -> pathlib.Path:
+        path = pathlib.Path(path)
+        if path.suffix == ".npz":
+            self._save_npz(path)
+        else:
+            self._save_parquet(path)
+        return path
+
+    @classmethod
+    def load(cls, path: str or pathlib.Path) -> "FactorMatrix":
+        path = pathlib.Path(path)
+        return cls._load_npz(path) if path.suffix == ".npz" else cls._load_parquet(path)
+
+    def _save_npz(self, path: pathlib.Path) -> None:
+        import numpy as np
+
+        path.parent.mkdir(parents=True, exist_ok=True)
+        meta = {"base_cols": self.base_cols, "factors": self.factors,
+                "titles": self.titles, "text_pool": self.text_pool, "types": TYPES}
+        np.savez_compressed(
+            path, meta=np.frombuffer(json.dumps(meta, ensure_ascii=False).encode("utf-8"),
+                                     dtype=np.uint8),
+            case_idx=self.case_idx, verdict=self.verdict, base=self.base,
+            indptr=self.indptr, indices=self.indices, types=self.types,
+            value_num=self.value_num, value_text=self.value_text)
+
+    @classmethod
+    def _load_npz(cls, path: pathlib.Path) -> "FactorMatrix":
+        import numpy as np
+
+        with np.load(path) as z:
+            meta = json.loads(z["meta"].tobytes().decode("utf-8"))
+            arrays = {k: z[k] for k in z.files if k != "meta"}
+        return cls(base_cols=meta["base_cols"], factors=meta["factors"],
+                   titles=meta["titles"], text_pool=meta["text_pool"], **arrays)
+
+    def _save_parquet(self, root: pathlib.Path) -> None:
+        import numpy as np
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        root.mkdir(parents=True, exist_ok=True)
+        cases = {"row_index": self.case_idx, "裁定字號": self.titles,
+                 "verdict": pa.array(self.verdict).cast(pa.int8())}
+        for j, c in enumerate(self.base_cols):
+            cases[c] = self.base[:, j]
+        pq.write_table(pa.table(cases), root / "cases.parquet")
+
+        counts = np.bincount(self.indices, minlength=len(self.factors))
+        pq.write_table(pa.table({"factor_id": np.arange(len(self.factors), dtype=np.int32),
+                                 "factor": self.factors, "cases": counts}),
+                       root / "factors.parquet")
+
+        is_text = self.value_text >= 0
+        text = pa.DictionaryArray.from_arrays(
+            pa.array(self.value_text, mask=~is_text), pa.array(self.text_pool, pa.string()))
+        num = pa.array(self.value_num, mask=np.isnan(self.value_num))
+        row = self.row_of().astype(np.int32)
+        pq.write_table(pa.table({
+            "row": row, "factor_id": self.indices,
+            "type": pa.DictionaryArray.from_arrays(pa.array(self.types), pa.array(TYPES)),
+            "value_num": num, "value_text": text,
+        }), root / "cells.parquet")
+
+    @classmethod
+    def _load_parquet(cls, root: pathlib.Path) -> "FactorMatrix":
+        import numpy as np
+        import pyarrow.compute as pc
+        import pyarrow.parquet as pq
+
+        cases = pq.read_table(root / "cases.parquet")
+        factors = pq.read_table(root / "factors.parquet")
+        cells = pq.read_table(root / "cells.parquet")
+        base_cols = cases.column_names[3:]
+        n = cases.num_rows
+
+        types = cells.column("type").combine_chunks()
+        type_map = np.array([TYPE_CODE[t] for t in types.dictionary.to_pylist()], dtype=np.int8)
+        text = cells.column("value_text").combine_chunks()
+        rows = cells.column("row").to_numpy()
+        return cls(
+            base_cols=base_cols,
+            factors=factors.column("factor").to_pylist(),
+            case_idx=cases.column("row_index").to_numpy(),
+            titles=cases.column("裁定字號").to_pylist(),
+            verdict=cases.column("verdict").to_numpy(),
+            base=np.column_stack([cases.column(c).to_numpy(zero_copy_only=False)
+                                  for c in base_cols]) if base_cols
+            else np.zeros((n, 0), dtype=bool),
+            indptr=np.concatenate([[0], np.cumsum(np.bincount(rows, minlength=n))]),
+            indices=cells.column("factor_id").to_numpy(),
+            types=type_map[types.indices.to_numpy(zero_copy_only=False)],
+            value_num=pc.fill_null(cells.column("value_num"), np.nan).to_numpy(),
+            value_text=pc.fill_null(text.indices, -1).to_numpy().astype(np.int32),
+            text_pool=text.dictionary.to_pylist(),
+        )
+
+
+def build_from_records(records: Iterable[Tuple[int, Dict[str, Any]]],
+                       base_cols: Sequence[str]) -> FactorMatrix:
+    """[(列號, journal 紀錄)] → FactorMatrix。"""
+    builder = FactorMatrixBuilder(base_cols)
+    for idx, rec in records:
+        builder.add(idx, rec["title"], rec["verdict"], rec["bool_cols"], rec["extra_cols"])
+    return builder.build()
+
+
+def _typed(code: int, num: float, text: Optional[str]):
+    t = TYPES[code]
+    if t == "bool":
+        return num == 1.0
+    if t == "number":
+        return int(num) if num.is_integer() else num
+    if t in ("date", "text"):
+        return text
+    return None
@@ -0,0 +1,208 @@
+"""跨執行保存的動態欄名字彙表：近似欄名歸到同一個正式名稱，prompt 只帶相關的前 K 個。
+
+Structurizer 每件都可能自創欄名 (「證人人數」/「證人數量」/「證人之人數」…)，
+直接累積所有欄名塞進 prompt 會越來越長，輸出欄位也各說各話。FactorVocab：
+- canonical()：欄名正規化 (NFKC、去空白標點與「之」「的」「是否」…) 後以字元 bigram 的 Dice
+  相似度找最接近的既有正式名稱，>= threshold 且型別不衝突 (bool 不併進 number) 就視為同義；
+  給了 embedder (本機 sentence-transformers 模型) 時，向量 cosine >= embed_threshold 也算。
+- observe()：把一件的動態欄改用正式名稱 (同義欄重複時保留有值的那個)，並累計次數 / 型別。
+- relevant()：依欄名 bigram 出現在裁定書中的比例挑前 K 個 (不足再補最常見的)，給 prompt 參考。
+以 JSON 存檔 (預設 cache/factor_vocab.json)，先寫暫存再換名。
+"""
+import json
+import math
+import pathlib
+from collections import Counter
+from typing import Any, Callable, Dict, List, Optional, Set
+
+from utils.dedup import normalize
+
+STOP_CHARS = str.maketrans("", "", "之的")
+# 欄名常見的同義寫法：「是否」「與否」不影響語意，「程度」「數量」與「度」「數」同義
+AFFIXES = (("是否", ""), ("與否", ""), ("有無", ""), ("程度", "度"), ("數量", "數"))
+
+
+def name_key(name: str) -> str:
+    key = normalize(name).lower().translate(STOP_CHARS)
+    for old, new in AFFIXES:
+        key = key.replace(old, new)
+    return key
+
+
+def bigrams(s: str) -> Set[str]:
+    if len(s) < 2:
+        return {s} if s else set()
+    return {s[i:i + 2] for i in range(len(s) - 1)}
+
+
+def dice(a: Set[str], b: Set[str]) -> float:
+    if not a or not b:
+        return 0.0
+    return 2 * len(a & b) / (len(a) + len(b))
+
+
+def load_embedder(model_name: str) -> Callable[[List[str]], Any]:
+    """本機 sentence-transformers 模型 → (names → 單位向量矩陣)；未安裝時丟 ImportError。"""
+    from sentence_transformers import SentenceTransformer
+
+    model = SentenceTransformer(model_name)
+    return lambda names: model.encode(list(names), normalize_embeddings=True)
+
+
+class FactorVocab:
+    def __init__(self, path: str or pathlib.Path = None, threshold: float = 0.7,
+                 top_k: int = 30, embedder: Callable = None, embed_threshold: float = 0.88):
+        self.path = pathlib.Path(path) if path else None
+        self.threshold = threshold
+        self.top_k = top_k
+        self.embedder = embedder
+        self.embed_threshold = embed_threshold
+        self.factors: Dict[str, Dict[str, Any]] = {}    # 正式名稱 → {count, types, aliases}
+        self.alias: Dict[str, str] = {}                 # 任一寫法 → 正式名稱
+        self._by_key: Dict[str, str] = {}               # name_key → 正式名稱
+        self._grams: Dict[str, Set[str]] = {}           # 正式名稱 → bigrams
+        self._index: Dict[str, Set[str]] = {}           # bigram → 正式名稱們
+        self._alias_grams: Dict[str, Set[str]] = {}
+        self._vectors: Dict[str, Any] = {}
+        self.dirty = False
+        if self.path is not None and self.path.exists():
+            self._load()
+
+    def __len__(self) -> int:
+        return len(self.factors)
+
+    def __repr__(self) -> str:
+        aliases = sum(len(f["aliases"]) for f in self.factors.values()) - len(self.factors)
+        return f"FactorVocab({len(self)} factors, {aliases} aliases, path={str(self.path)!r})"
+
+    # ------------------------------------------------------------------
+    def _load(self) -> None:
+        data = json.loads(self.path.read_text(encoding="utf-8"))
+        for name, rec in data.get("factors", {}).items():
+            self._add(name)
+            self.factors[name].update(count=rec.get("count", 0),
+                                      types=Counter(rec.get("types", {})),
+                                      aliases=Counter(rec.get("aliases", {})))
+            for alias in self.factors[name]["aliases"]:
+                self.alias[alias] = name
+                self._by_key.setdefault(name_key(alias), name)
+
+    def save(self) -> None:
+        if self.path is None or not self.dirty:
+            return
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        data = {"version": 1, "factors": {
+            name: {"count": f["count"], "types": dict(f["types"]), "aliases": dict(f["aliases"])}
+            for name, f in sorted(self.factors.items(), key=lambda kv: -kv[1]["count"])}}
+        tmp = self.path.with_name(f".{self.path.name}.tmp")
+        tmp.write_text(json.dumps(data, ensure_ascii=False, indent=1), encoding="utf-8")
+        tmp.replace(self.path)
+        self.dirty = False
+
+    def _add(self, name: str) -> None:
+        self.factors[name] = {"count": 0, "types": Counter(), "aliases": Counter({name: 0})}
+        self.alias[name] = name
+        key = name_key(name)
+        self._by_key.setdefault(key, name)
+        grams = self._grams[name] = bigrams(key)
+        for g in grams:
+            self._index.setdefault(g, set()).add(name)
+
+    @staticmethod
+    def _main_type(f: Dict[str, Any]) -> Optional[str]:
+        types = {t: n for t, n in f["types"].items() if t != "empty"}
+        return max(types, key=types.get) if types else None
+
+    def _compatible(self, name: str, typ: Optional[str]) -> bool:
+        main = self._main_type(self.factors[name])
+        return typ in (None, "empty") or main is None or main == typ
+
+    def _embed_match(self, name: str, typ: Optional[str]) -> Optional[str]:
+        import numpy as np
+
+        missing = [c for c in self.factors if c not in self._vectors]
+        if missing:
+            self._vectors.update(zip(missing, self.embedder(missing)))
+        names = list(self._vectors)
+        if not names:
+            return None
+        sims = np.stack([self._vectors[c] for c in names]) @ self.embedder([name])[0]
+        for i in np.argsort(-sims):
+            if sims[i] < self.embed_threshold:
+                break
+            if self._compatible(names[i], typ):
+                return names[i]
+        return None
+
+    # ------------------------------------------------------------------
+    def canonical(self, name: str, typ: str = None) -> str:
+        """欄名 → 正式名稱；找不到夠像的就成為新的正式名稱。"""
+        if name in self.alias:
+            return self.alias[name]
+        key = name_key(name)
+        match = self._by_key.get(key)
+        if match is not None and not self._compatible(match, typ):
+            match = None                    # 正規化後同名但型別衝突 (bool vs number)：不併
+        if match is None and key:
+            grams = bigrams(key)
+            candidates = set().union(*(self._index.get(g, ()) for g in grams))
+            scored = sorted(((dice(grams, self._grams[c]), c) for c in candidates),
+                            key=lambda sc: (-sc[0], -self.factors[sc[1]]["count"]))
+            match = next((c for s, c in scored
+                          if s >= self.threshold and self._compatible(c, typ)), None)
+        if match is None and self.embedder is not None and self.factors:
+            match = self._embed_match(name, typ)
+        if match is None:
+            self._add(name)
+            match = name
+        self.alias[name] = match
+        self.dirty = True
+        return match
+
+    def observe(self, extra_cols: Dict[str, Dict[str, Any]]) -> Dict[str, Dict[str, Any]]:
+        """一件的動態欄 → 改用正式名稱；同一正式名稱出現多次時保留第一個有值的。"""
+        out: Dict[str, Dict[str, Any]] = {}
+        for name, meta in extra_cols.items():
+            typ = meta.get("type")
+            c = self.canonical(name, typ)
+            f = self.factors[c]
+            f["aliases"][name] += 1
+            f["types"][typ] += 1
+            if c not in out:
+                f["count"] += 1
+                out[c] = meta
+            elif out[c].get("type") == "empty":
+                out[c] = meta
+        if extra_cols:
+            self.dirty = True
+        return out
+
+    def relevant(self, text: str, k: int = None) -> List[str]:
+        """與裁定書最相關的前 k 個正式名稱 (k=0 → 不提示)。"""
+        k = self.top_k if k is None else k
+        if k <= 0 or not self.factors:
+            return []
+        by_count = sorted(self.factors, key=lambda c: -self.factors[c]["count"])
+        if len(self.factors) <= k:
+            return by_count
+        doc = bigrams(name_key(text))
+        scores = {}
+        for c, f in self.factors.items():
+            best = max(len(g & doc) / len(g) for g in map(self._alias_bigrams, f["aliases"]))
+            if best > 0:
+                scores[c] = best + math.log1p(f["count"]) / 100     # 同分時常見的優先
+        chosen = sorted(scores, key=scores.get, reverse=True)[:k]
+        picked = set(chosen)
+        chosen += [c for c in by_count if c not in picked][:k - len(chosen)]
+        return chosen
+
+    def _alias_bigrams(self, alias: str) -> Set[str]:
+        grams = self._alias_grams.get(alias)
+        if grams is None:
+            grams = self._alias_grams[alias] = bigrams(name_key(alias)) or {alias}
+        return grams
+
+    def summary(self) -> str:
+        merged = sum(1 for f in self.factors.values() if len(f["aliases"]) > 1)
+        return f"factor vocab: {len(self)} 個正式欄名 ({merged} 個合併了同義寫法) → {self.path}"
+
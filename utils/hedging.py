@@ -0,0 +1,214 @@
+import time
+import asyncio
+import threading
+import contextlib
+import contextvars
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import Any, Dict, Optional
+
+from utils.telemetry import percentile
+
+# 目前案件 / 呼叫的截止時間 (time.monotonic())；巢狀 deadline() 取較早者
+DEADLINE: contextvars.ContextVar = contextvars.ContextVar("deadline", default=None)
+
+
+class DeadlineExpired(TimeoutError):
+    """截止時間已過；SCHEDULER 不會重試 (名稱刻意不含 RETRYABLE_NAMES 關鍵字)。"""
+
+
+@contextlib.contextmanager
+def deadline(seconds: Optional[float]):
+    """`with deadline(300):` 內所有 LLM 呼叫 (含重試、退避) 須在 300 秒內完成。
+
+    seconds=None 不設限；外層已有較早的截止時間時沿用外層。
+    """
+    if seconds is None:
+        yield
+        return
+    due = time.monotonic() + seconds
+    outer = DEADLINE.get()
+    token = DEADLINE.set(due if outer is None else min(outer, due))
+    try:
+        yield
+    finally:
+        DEADLINE.reset(token)
+
+
+def remaining() -> Optional[float]:
+    """距截止時間的秒數；未設 deadline 時回傳 None。"""
+    due = DEADLINE.get()
+    return None if due is None else due - time.monotonic()
+
+
+def check_deadline() -> None:
+    left = remaining()
+    if left is not None and left <= 0:
+        raise DeadlineExpired("deadline exceeded")
+
+
+def timeout_kw(kw: Dict[str, Any], key: str = "timeout") -> Dict[str, Any]:
+    """有 deadline 時把剩餘秒數當作 SDK 的單次請求 timeout (openai / anthropic)。"""
+    left = remaining()
+    if left is None or key in kw:
+        return kw
+    return dict(kw, **{key: max(left, 0.001)})
+
+
+class HedgedLLM:
+    """primary 超過歷史延遲的 p{percentile} 仍未回覆時，同一請求再送給 secondary。
+
+    先回來的答案勝出，另一個取消 (sync 路徑無法中斷執行中的 thread，只會丟棄結果)。
+    primary 直接失敗時立即改送 secondary (failover)。stream / astream 不做 hedge。
+    其餘屬性 (model_name, lookup, usage_totals …) 轉給 primary。
+    """
+
+    def __init__(self, primary, secondary, percentile: float = 95.0,
+                 hedge_after: Optional[float] = None, min_samples: int = 20,
+                 default_delay: float = 60.0, window: int = 500):
+        self.primary = primary
+        self.secondary = secondary
+        self.percentile = percentile
+        self.hedge_after = hedge_after        # 固定秒數；None 時依歷史延遲
+        self.min_samples = min_samples
+        self.default_delay = default_delay    # 樣本不足時的 hedge 門檻
+        self._latencies = deque(maxlen=window)
+        self._lock = threading.Lock()
+        self._pool = None
+        self.n_calls = self.n_hedged = self.n_secondary_wins = self.n_failover = 0
+
+    def __getattr__(self, name):
+        return getattr(self.primary, name)
+
+    # ------------------------------------------------------------------
+    def hedge_delay(self) -> float:
+        if self.hedge_after is not None:
+            delay = self.hedge_after
+        else:
+            with self._lock:
+                samples = list(self._latencies)
+            delay = (percentile(samples, self.percentile)
+                     if len(samples) >= self.min_samples else self.default_delay)
+        left = remaining()
+        return delay if left is None else max(0.0, min(delay, left))
+
+    def _observe(self, seconds: float) -> None:
+        with self._lock:
+            self._latencies.append(seconds)
+
+    def _count(self, **inc) -> None:
+        with self._lock:
+            for k, v in inc.items():
+                setattr(self, k, getattr(self, k) + v)
+
+    @property
+    def pool(self) -> ThreadPoolExecutor:
+        if self._pool is None:
+            self._pool = ThreadPoolExecutor(max_workers=16, thread_name_prefix="hedge")
+        return self._pool
+
+    # ------------------------------------------------------------------
+    def __call__(self, messages, temperature=0.7, max_tokens=2048, **kw):
+        self._count(n_calls=1)
+        t0 = time.monotonic()
+
+        def submit(llm):
+            # 複製 contextvars (stage / case_id / deadline) 到 worker thread
+            ctx = contextvars.copy_context()
+            return self.pool.submit(ctx.run, llm, messages, temperature=temperature,
+                                    max_tokens=max_tokens, **kw)
+
+        first = submit(self.primary)
+        done, _ = wait([first], timeout=self.hedge_delay())
+        if done and first.exception() is None:
+            self._observe(time.monotonic() - t0)
+            return first.result()
+        if done and isinstance(first.exception(), DeadlineExpired):
+            raise first.exception()
+        if done:
+            self._count(n_failover=1)
+            print(f"⚠️ primary 失敗 ({type(first.exception()).__name__})，改送 secondary")
+            return self.secondary(messages, temperature=temperature,
+                                  max_tokens=max_tokens, **kw)
+
+        self._count(n_hedged=1)
+        second = submit(self.secondary)
+        pending = {first, second}
+        error = None
+        while pending:
+            done, pending = wait(pending, timeout=remaining(), return_when=FIRST_COMPLETED)
+            if not done:
+                raise DeadlineExpired("deadline exceeded while hedging")
+            for fut in done:
+                if fut.exception() is not None:
+                    error = fut.exception()
+                    continue
+                if fut is first:
+                    self._observe(time.monotonic() - t0)
+                else:
+                    self._count(n_secondary_wins=1)
+                for other in pending:
+                    other.cancel()
+                return fut.result()
+        raise error
+
+    async def acall(self, messages, temperature=0.7, max_tokens=2048, **kw):
+        self._count(n_calls=1)
+        t0 = time.monotonic()
+        first = asyncio.ensure_future(self.primary.acall(
+            messages, temperature=temperature, max_tokens=max_tokens, **kw))
+        try:
+            done, _ = await asyncio.wait({first}, timeout=self.hedge_delay())
+            if done and first.exception() is None:
+                self._observe(time.monotonic() - t0)
+                return first.result()
+            if done and isinstance(first.exception(), DeadlineExpired):
+                raise first.exception()
+            if done:
+                self._count(n_failover=1)
+                print(f"⚠️ primary 失敗 ({type(first.exception()).__name__})，改送 secondary")
+                return await self.secondary.acall(messages, temperature=temperature,
+                                                  max_tokens=max_tokens, **kw)
+
+            self._count(n_hedged=1)
+            second = asyncio.ensure_future(self.secondary.acall(
+                messages, temperature=temperature, max_tokens=max_tokens, **kw))
+            pending = {first, second}
+            error = None
+            try:
+                while pending:
+                    done, pending = await asyncio.wait(pending, timeout=remaining(),
+                                                       return_when=asyncio.FIRST_COMPLETED)
+                    if not done:
+                        raise DeadlineExpired("deadline exceeded while hedging")
+                    for task in done:
+                        if task.exception() is not None:
+                            error = task.exception()
+                            continue
+                        if task is first:
+                            self._observe(time.monotonic() - t0)
+                        else:
+                            self._count(n_secondary_wins=1)
+                        return task.result()
+                raise error
+            finally:
+                # 輸家 (或 deadline 到期時兩者) 一律取消，釋放 SCHEDULER 名額與連線
+                for task in (first, second):
+                    if not task.done():
+                        task.cancel()
+        finally:
+            if not first.done():
+                first.cancel()
+
+    def stream(self, messages, temperature=0.7, max_tokens=2048, **kw):
+        return self.primary.stream(messages, temperature=temperature,
+                                   max_tokens=max_tokens, **kw)
+
+    def astream(self, messages, temperature=0.7, max_tokens=2048, **kw):
+        return self.primary.astream(messages, temperature=temperature,
+                                    max_tokens=max_tokens, **kw)
+
+    def stats(self) -> Dict[str, Any]:
+        return {"calls": self.n_calls, "hedged": self.n_hedged,
+                "secondary_wins": self.n_secondary_wins, "failover": self.n_failover,
+                "hedge_delay_s": round(self.hedge_delay(), 2)}
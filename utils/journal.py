@@ -0,0 +1,94 @@
+import os
+import json
+import time
+import hashlib
+import pathlib
+import threading
+from typing import Any, Dict, Iterator, Optional
+
+
+def case_key(title: str, core_text: str) -> str:
+    """案件身分 = 裁定字號 + 裁定書內容 hash；與列號無關，插列 / 排序後仍可對上。"""
+    digest = hashlib.sha256(f"{title}\0{core_text}".encode("utf-8")).hexdigest()
+    return digest[:24]
+
+
+def content_hash(core_text: str) -> str:
+    return hashlib.sha256(core_text.encode("utf-8")).hexdigest()[:16]
+
+
+class ResultJournal:
+    """Append-only JSONL：每完成一件就寫一行並 fsync，當掉最多損失進行中的案件。
+
+    同一 key 出現多次時以最後一筆為準；結尾若有寫到一半的行 (crash) 會被略過。
+    """
+
+    def __init__(self, path: str or pathlib.Path, fsync: bool = True):
+        self.path = pathlib.Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.fsync = fsync
+        self._records: Dict[str, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+        self._load()
+        self._fh = self.path.open("a", encoding="utf-8")
+        if self._fh.tell():
+            with self.path.open("rb") as raw:
+                raw.seek(-1, os.SEEK_END)
+                if raw.read(1) != b"\n":
+                    self._fh.write("\n")  # crash 留下的半行：換行隔開，之後的紀錄才完整
+
+    def _load(self) -> None:
+        if not self.path.exists():
+            return
+        bad = 0
+        with self.path.open(encoding="utf-8") as fh:
+            for line in fh:
+                if not line.strip():
+                    continue
+                try:
+                    rec = json.loads(line)
+                except json.JSONDecodeError:
+                    bad += 1
+                    continue
+                self._records[rec["key"]] = rec
+        if bad:
+            print(f"⚠️ journal {self.path}: 略過 {bad} 行不完整紀錄")
+
+    # ------------------------------------------------------------------
+    def __contains__(self, key: str) -> bool:
+        return key in self._records
+
+    def __len__(self) -> int:
+        return len(self._records)
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        return self._records.get(key)
+
+    def records(self) -> Iterator[Dict[str, Any]]:
+        return iter(list(self._records.values()))
+
+    def append(self, key: str, title: str, core_text: str, row_index,
+               verdict, reason: str, bool_cols: Dict, extra_cols: Dict) -> Dict[str, Any]:
+        rec = {
+            "key": key,
+            "title": title,
+            "content_hash": content_hash(core_text),
+            "row_index": row_index,
+            "verdict": verdict,
+            "reason": reason,
+            "bool_cols": bool_cols,
+            "extra_cols": extra_cols,
+            "ts": time.time(),
+        }
+        line = json.dumps(rec, ensure_ascii=False, default=str)
+        with self._lock:
+            self._fh.write(line + "\n")
+            self._fh.flush()
+            if self.fsync:
+                os.fsync(self._fh.fileno())
+            self._records[key] = json.loads(line)      # 與重新讀檔時的型別一致
+        return rec
+
+    def close(self) -> None:
+        with self._lock:
+            self._fh.close()
@@ -0,0 +1,205 @@
+import json
+import time
+import sqlite3
+import hashlib
+import pathlib
+import threading
+from typing import Any, Dict, List, Optional
+
+
+class LLMCache:
+    """On-disk (SQLite) content-addressed store of LLM responses.
+
+    key = sha256(provider, model, messages, generation settings)，
+    value = 包好的 OpenAI 相容回傳 dict。可跨程序共用 (WAL)。
+    """
+
+    def __init__(self, path: str or pathlib.Path = "cache/llm_cache.sqlite",
+                 max_entries: Optional[int] = None,
+                 max_age_days: Optional[float] = None,
+                 max_size_mb: Optional[float] = None):
+        self.path = pathlib.Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.max_entries = max_entries
+        self.max_age_days = max_age_days
+        self.max_size_mb = max_size_mb
+        self.hits = self.misses = self.writes = 0
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(self.path), check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            " key TEXT PRIMARY KEY,"
+            " provider TEXT, model TEXT,"
+            " response TEXT NOT NULL,"
+            " created_at REAL NOT NULL,"
+            " accessed_at REAL NOT NULL)"
+        )
+        self._conn.commit()
+        self.evict()
+
+    # ------------------------------------------------------------------
+    @staticmethod
+    def make_key(provider: str, model: str, messages: List[Dict],
+                 temperature: float, max_tokens: int, **kw) -> str:
+        payload = {
+            "provider": provider,
+            "model": model,
+            "messages": messages,
+            "temperature": temperature,
+            "max_tokens": max_tokens,
+            "kw": kw,
+        }
+        blob = json.dumps(payload, ensure_ascii=False, sort_keys=True, default=str)
+        return hashlib.sha256(blob.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT response, created_at FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is not None and self._expired(row[1], now):
+                self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self._conn.commit()
+                row = None
+            if row is None:
+                self.misses += 1
+                return None
+            self._conn.execute(
+                "UPDATE responses SET accessed_at = ? WHERE key = ?", (now, key))
+            self._conn.commit()
+            self.hits += 1
+        return json.loads(row[0])
+
+    def put(self, key: str, response: Dict[str, Any],
+            provider: str = "", model: str = "") -> None:
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)",
+                (key, provider, model,
+                 json.dumps(response, ensure_ascii=False, default=str), now, now),
+            )
+            self._conn.commit()
+            self.writes += 1
+        # 每 100 次寫入檢查一次容量上限
+        if self.writes % 100 == 0:
+            self.evict()
+
+    # ------------------------------------------------------------------
+    def _expired(self, created_at: float, now: float) -> bool:
+        return (self.max_age_days is not None
+                and now - created_at > self.max_age_days * 86400)
+
+    def evict(self) -> int:
+        """依 max_age_days / max_entries / max_size_mb 淘汰 (LRU)；回傳刪除筆數。"""
+        removed = 0
+        with self._lock:
+            cur = self._conn
+            if self.max_age_days is not None:
+                cutoff = time.time() - self.max_age_days * 86400
+                removed += cur.execute(
+                    "DELETE FROM responses WHERE created_at < ?", (cutoff,)).rowcount
+            if self.max_entries is not None:
+                removed += cur.execute(
+                    "DELETE FROM responses WHERE key IN ("
+                    " SELECT key FROM responses ORDER BY accessed_at DESC"
+                    " LIMIT -1 OFFSET ?)", (self.max_entries,)).rowcount
+            if self.max_size_mb is not None:
+                budget = int(self.max_size_mb * 1024 * 1024)
+                rows = cur.execute(
+                    "SELECT key, LENGTH(response) FROM responses"
+                    " ORDER BY accessed_at DESC").fetchall()
+                total, stale = 0, []
+                for key, size in rows:
+                    total += size
+                    if total > budget:
+                        stale.append((key,))
+                cur.executemany("DELETE FROM responses WHERE key = ?", stale)
+                removed += len(stale)
+            cur.commit()
+        return removed
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            n = self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        return {"hits": self.hits, "misses": self.misses,
+                "writes": self.writes, "entries": n}
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+class CachedLLM:
+    """包住任一 `llm(messages, temperature, max_tokens)` callable（含 acall）。
+
+    bypass=True 時不讀快取、照常打 API，並以新結果覆寫快取。
+    其餘屬性 (model_name, response, *_tokens …) 直接轉給原本的 llm。
+    """
+
+    def __init__(self, llm, cache: LLMCache, provider: Optional[str] = None,
+                 bypass: bool = False):
+        self.llm = llm
+        self.cache = cache
+        self.provider = provider or type(llm).__name__
+        self.bypass = bypass
+
+    def __getattr__(self, name):
+        return getattr(self.llm, name)
+
+    def _key(self, messages, temperature, max_tokens, kw) -> str:
+        model = getattr(self.llm, "model_name", "")
+        return LLMCache.make_key(self.provider, model, messages,
+                                 temperature, max_tokens, **kw)
+
+    def lookup(self, messages, temperature=0.7, max_tokens=2048, **kw):
+        """查快取 (bypass 時一律 miss)；batch 模式送出前用來剔除已有結果的請求。"""
+        if self.bypass:
+            return None
+        return self.cache.get(self._key(messages, temperature, max_tokens, kw))
+
+    def store(self, response, messages, temperature=0.7, max_tokens=2048, **kw):
+        self.cache.put(self._key(messages, temperature, max_tokens, kw), response,
+                       self.provider, getattr(self.llm, "model_name", ""))
+
+    def __call__(self, messages, temperature=0.7, max_tokens=2048, **kw):
+        hit = self.lookup(messages, temperature, max_tokens, **kw)
+        if hit is not None:
+            return hit
+        resp = self.llm(messages, temperature=temperature, max_tokens=max_tokens, **kw)
+        self.store(resp, messages, temperature, max_tokens, **kw)
+        return resp
+
+    async def acall(self, messages, temperature=0.7, max_tokens=2048, **kw):
+        hit = self.lookup(messages, temperature, max_tokens, **kw)
+        if hit is not None:
+            return hit
+        resp = await self.llm.acall(messages, temperature=temperature,
+                                    max_tokens=max_tokens, **kw)
+        self.store(resp, messages, temperature, max_tokens, **kw)
+        return resp
+
+    def stream(self, messages, temperature=0.7, max_tokens=2048, **kw):
+        """快取命中時一次吐出完整回覆；否則直接串流 (可能被提早中斷，故不寫入快取)。"""
+        hit = self.lookup(messages, temperature, max_tokens, **kw)
+        if hit is not None:
+            yield hit["choices"][0]["message"]["content"]
+            return
+        yield from self.llm.stream(messages, temperature=temperature,
+                                   max_tokens=max_tokens, **kw)
+
+    async def astream(self, messages, temperature=0.7, max_tokens=2048, **kw):
+        hit = self.lookup(messages, temperature, max_tokens, **kw)
+        if hit is not None:
+            yield hit["choices"][0]["message"]["content"]
+            return
+        inner = self.llm.astream(messages, temperature=temperature,
+                                 max_tokens=max_tokens, **kw)
+        try:
+            async for piece in inner:
+                yield piece
+        finally:
+            await inner.aclose()
@@ -0,0 +1,216 @@
+"""Structurizer 輸出的 Markdown 布林表 → 型別化欄位。
+
+表格格式固定是「表頭一列 + 資料一列」，不需要 DataFrame / CSV 來回轉：
+- parse_row：逐行掃描，找出表格區塊、略過 `|---|` 分隔列，以未跳脫的 `|` 切欄
+  (儲存格內的逗號不影響)；欄數不齊時補空字串 / 截掉多餘欄，格式壞掉回傳 None 而不丟例外。
+- cast_cell：單一儲存格 → (value, type)，以預先編譯的 regex 判斷，不靠 try/except。
+- cast_cells：同樣的規則一次套在整批儲存格上 (pandas 向量化字串運算)，供 batch 模式
+  一次解析上百張表。
+- merge_rows / format_row：長裁定書分段建表後合併 (見 Structurizer 的 map-reduce)。
+型別：empty / bool / number / date / text。
+"""
+import re
+import datetime as dt
+from collections import Counter
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+CELL_SPLIT = re.compile(r"(?<!\\)\|")
+SEPARATOR = re.compile(r"^\|?\s*:?-+:?\s*(\|\s*:?-+:?\s*)*\|?$")
+EMPTY = r"[-_─]*"
+BOOL = r"(?i:true|false)"
+INT = r"[+-]?\d+"
+FLOAT = r"[+-]?(?:\d+\.\d*|\.\d+)(?:[eE][+-]?\d+)?"
+DATE = r"\d{4}-\d{2}-\d{2}"
+CAST = re.compile(rf"(?P<empty>{EMPTY})|(?P<bool>{BOOL})|(?P<int>{INT})|"
+                  rf"(?P<float>{FLOAT})|(?P<date>{DATE})")
+
+
+def split_cells(line: str) -> List[str]:
+    """`| a | b \\| c |` → ["a", "b | c"]；頭尾的 | 可有可無。"""
+    s = line.strip()
+    if s.startswith("|"):
+        s = s[1:]
+    if s.endswith("|") and not s.endswith("\\|"):
+        s = s[:-1]
+    return [c.strip().replace("\\|", "|") for c in CELL_SPLIT.split(s)]
+
+
+def table_blocks(tbl_md: str) -> Iterable[List[List[str]]]:
+    """連續的 `|` 開頭行為一個表格區塊；回傳各區塊的列 (不含分隔列)。"""
+    block: List[List[str]] = []
+    for ln in tbl_md.splitlines():
+        s = ln.strip()
+        if not s.startswith("|"):
+            if block:
+                yield block
+                block = []
+            continue
+        if SEPARATOR.match(s):
+            continue
+        block.append(split_cells(s))
+    if block:
+        yield block
+
+
+def parse_row(tbl_md: str, prefer: Sequence[str] = ()) -> Optional[Dict[str, str]]:
+    """→ {欄名: 原始字串}；取第一個含 prefer 欄名的表格 (沒有就取第一個有資料列的)。
+
+    表頭空白或重複的欄略過 (同名取第一個)；找不到 表頭 + 資料列 時回傳 None。
+    """
+    chosen = None
+    want = set(prefer)
+    for block in table_blocks(tbl_md):
+        if len(block) < 2:
+            continue
+        if chosen is None:
+            chosen = block
+        if want & set(block[0]):
+            chosen = block
+            break
+    if chosen is None:
+        return None
+    header, data = chosen[0], chosen[1]
+    row: Dict[str, str] = {}
+    for i, name in enumerate(header):
+        if name and name not in row:
+            row[name] = data[i] if i < len(data) else ""
+    return row
+
+
+def cast_cell(txt: str) -> Tuple[Any, str]:
+    s = str(txt).strip()
+    m = CAST.fullmatch(s)
+    if m is None:
+        return s, "text"
+    kind = m.lastgroup
+    if kind == "empty":                 # 空字串或只含 -、_、─ 視為 missing
+        return None, "empty"
+    if kind == "bool":
+        return s.upper() == "TRUE", "bool"
+    if kind == "int":
+        return int(s), "number"
+    if kind == "float":
+        return float(s), "number"
+    try:
+        return dt.date.fromisoformat(s), "date"
+    except ValueError:                  # 形如日期但不存在 (2024-02-30)
+        return s, "text"
+
+
+def cast_cells(cells: Sequence[str]) -> List[Tuple[Any, str]]:
+    """cast_cell 的批次版：整批儲存格以 pandas 字串運算一次分類、轉型。"""
+    import numpy as np
+    import pandas as pd
+
+    if not cells:
+        return []
+    s = pd.Series(cells, dtype=object).astype(str).str.strip()
+    values = s.to_numpy(dtype=object).copy()
+    types = np.full(len(s), "text", dtype=object)
+
+    empty = s.str.fullmatch(EMPTY).to_numpy()
+    values[empty], types[empty] = None, "empty"
+
+    upper = s.str.upper()
+    is_bool = upper.isin(["TRUE", "FALSE"]).to_numpy()
+    values[is_bool] = (upper[is_bool] == "TRUE").tolist()
+    types[is_bool] = "bool"
+
+    is_int = s.str.fullmatch(INT).to_numpy()
+    if is_int.any():
+        values[is_int] = [int(x) for x in s[is_int]]          # 不經 int64，大數不溢位
+        types[is_int] = "number"
+    is_float = s.str.fullmatch(FLOAT).to_numpy()
+    if is_float.any():
+        values[is_float] = s[is_float].astype(float).tolist()
+        types[is_float] = "number"
+
+    is_date = s.str.fullmatch(DATE).to_numpy()
+    if is_date.any():
+        dates = pd.to_datetime(s[is_date], format="%Y-%m-%d", errors="coerce")
+        ok = dates.notna().to_numpy()
+        where = np.flatnonzero(is_date)[ok]
+        values[where] = dates[ok].dt.date.tolist()
+        types[where] = "date"
+    return list(zip(values.tolist(), types.tolist()))
+
+
+def split_cols(row: Optional[Dict[str, str]], base: Sequence[str],
+               cast=None) -> Tuple[Dict[str, bool], Dict[str, Dict[str, Any]]]:
+    """{欄名: 原始字串} → (base 布林欄, 其餘動態欄)；row 為 None 時 base 全 False。
+
+    cast：已轉好的 [(value, type)] (與 row 的欄位順序相同)；未給則逐格 cast_cell。
+    """
+    row = row or {}
+    casted = cast if cast is not None else [cast_cell(v) for v in row.values()]
+    bool_cols: Dict[str, bool] = {name: False for name in base}
+    extra_cols: Dict[str, Dict[str, Any]] = {}
+    for name, (val, typ) in zip(row, casted):
+        if name in bool_cols:
+            bool_cols[name] = bool(val) if typ == "bool" else False
+        elif val is not None:
+            extra_cols[name] = {"value": val, "type": typ}
+        else:
+            extra_cols[name] = {"value": "NA", "type": "empty"}
+    return bool_cols, extra_cols
+
+
+def parse_tables(tables: Dict[Any, str], base: Sequence[str]
+                 ) -> Dict[Any, Tuple[Dict[str, bool], Dict[str, Dict[str, Any]]]]:
+    """{id: 表格 markdown} → {id: (bool_cols, extra_cols)}；所有儲存格一次 cast_cells。
+
+    格式壞掉的表格不丟例外：base 欄全 False、沒有動態欄 (id 列在 `.malformed`)。
+    """
+    rows = {key: parse_row(md, base) for key, md in tables.items()}
+    flat = [v for row in rows.values() if row for v in row.values()]
+    casted = iter(cast_cells(flat))
+    out = ParsedTables()
+    for key, row in rows.items():
+        if row is None:
+            out.malformed.append(key)
+        cast = [next(casted) for _ in row] if row else []
+        out[key] = split_cols(row, base, cast)
+    return out
+
+
+class ParsedTables(dict):
+    def __init__(self):
+        super().__init__()
+        self.malformed: List[Any] = []
+
+
+def merge_rows(rows: Sequence[Optional[Dict[str, str]]], base: Sequence[str] = ()
+               ) -> Tuple[Dict[str, str], Dict[str, List[str]]]:
+    """各段的 {欄名: 原始字串} → (合併後的一列, {欄名: 各段不一致的值})。
+
+    - 布林欄 (含 base 欄)：任一段 TRUE 即 TRUE (某段提到就成立)。
+    - 其他值：各段一致就沿用；不一致時取出現最多的值，同票取較後段 (理由段在後，
+      通常是法院的結論)，並記進 conflicts。
+    - 空白值不參與；欄位順序 = base 在前，其餘依第一次出現的順序。
+    """
+    order = list(base) + [c for row in rows if row for c in row if c not in base]
+    merged: Dict[str, str] = {}
+    conflicts: Dict[str, List[str]] = {}
+    for name in dict.fromkeys(order):
+        values = [row[name].strip() for row in rows if row and name in row]
+        casted = [(v, cast_cell(v)[1]) for v in values]
+        present = [(v, t) for v, t in casted if t != "empty"]
+        if not present:
+            merged[name] = "FALSE" if name in base else ""
+        elif all(t == "bool" for _, t in present):
+            merged[name] = "TRUE" if any(v.upper() == "TRUE" for v, _ in present) else "FALSE"
+        else:
+            seen = list(dict.fromkeys(v for v, _ in present))
+            if len(seen) > 1:
+                conflicts[name] = seen
+            counts = Counter(v for v, _ in present)
+            top = max(counts.values())
+            merged[name] = next(v for v, _ in reversed(present) if counts[v] == top)
+    return merged, conflicts
+
+
+def format_row(row: Dict[str, str]) -> str:
+    """{欄名: 值} → 兩行 Markdown 表格 (與 Structurizer 的輸出格式相同)。"""
+    esc = lambda s: str(s).replace("|", "\\|")
+    return ("| " + " | ".join(esc(c) for c in row) + " |\n"
+            + "| " + " | ".join(esc(v) for v in row.values()) + " |")
@@ -0,0 +1,181 @@
+import re
+import time
+import hashlib
+import pathlib
+import threading
+from typing import Dict, List, Tuple
+
+# 未跳脫的 {name}（排除 {{ }}）
+PLACEHOLDER = re.compile(r"(?<!\{)\{(\w+)\}(?!\})")
+
+
+def split_template(template: str) -> Tuple[str, str]:
+    """把 prompt 拆成 (靜態前綴, 動態後綴)。
+
+    前綴 = 第一個 placeholder 所在 `###` 小節之前的全部文字（法條、立法理由等），
+    每件案件都相同，適合放 system message 讓 provider 做 prompt caching。
+    沒有 placeholder 時整份都是前綴。
+    """
+    m = PLACEHOLDER.search(template)
+    if m is None:
+        return template, ""
+    head = template[:m.start()]
+    cut = head.rfind("\n#")
+    if cut == -1:
+        cut = head.rfind("\n")
+    cut = cut + 1 if cut != -1 else 0
+    return template[:cut], template[cut:]
+
+
+def build_messages(template: str, extra: str = "", **fields) -> List[Dict[str, str]]:
+    """→ [system(靜態前綴), user(填好欄位的後綴 + extra)]。
+
+    與整份 `template.format(**fields)` 當單一 user message 的內容完全相同，只是切成兩段。
+    """
+    prefix, suffix = split_template(template)
+    messages = []
+    if prefix.strip():
+        messages.append({"role": "system", "content": prefix.format().rstrip()})
+    messages.append({"role": "user", "content": suffix.format(**fields) + extra})
+    return messages
+
+
+# -----------------------------------------------------------------------------
+# Registry：啟動時載入並驗證一次，之後每次呼叫只做 suffix.format
+# -----------------------------------------------------------------------------
+
+class PromptError(ValueError):
+    """模板缺少必要欄位、有多餘欄位，或大括號未跳脫。"""
+
+
+# 各角色：(必要 placeholder, 呼叫端會提供的 placeholder)
+ROLES: Dict[str, Tuple[frozenset, frozenset]] = {
+    "structurize": (frozenset({"core"}), frozenset({"core"})),
+    "utilize":     (frozenset({"table"}), frozenset({"table", "core", "query"})),
+    "fused":       (frozenset({"core"}), frozenset({"core"})),
+}
+
+
+class PromptTemplate:
+    """已拆好 (system 前綴, user 後綴) 的模板；system 前綴在載入時就 format 好。"""
+
+    def __init__(self, path: pathlib.Path, role: str = None):
+        self.path = path
+        self.role = role
+        stat = path.stat()
+        self.mtime_ns = stat.st_mtime_ns
+        self.text = path.read_text(encoding="utf-8")
+        prefix, self.suffix = split_template(self.text)
+        self.fields = frozenset(PLACEHOLDER.findall(self.text))
+        self._fp = hashlib.sha256(self.text.encode("utf-8") + b"\0")
+        self.fingerprint = self._fp.hexdigest()[:16]
+        self.validate(prefix)
+        self.system = prefix.format().rstrip() if prefix.strip() else None
+
+    def validate(self, prefix: str) -> None:
+        try:
+            prefix.format()
+        except (IndexError, KeyError, ValueError) as e:
+            raise PromptError(f"{self.path}: 靜態前綴格式錯誤 {e!r}") from None
+        if self.role is None:
+            return
+        required, allowed = ROLES[self.role]
+        missing = required - self.fields
+        if missing:
+            raise PromptError(f"{self.path}: 缺少 {', '.join('{%s}' % f for f in sorted(missing))}")
+        unknown = self.fields - allowed
+        if unknown:
+            raise PromptError(f"{self.path}: 未知欄位 {', '.join('{%s}' % f for f in sorted(unknown))}"
+                              f" ({self.role} 只提供 {', '.join(sorted(allowed))})")
+        try:
+            self.suffix.format(**{f: "" for f in allowed})
+        except (IndexError, KeyError, ValueError) as e:
+            raise PromptError(f"{self.path}: 格式錯誤 {e!r}") from None
+
+    def fingerprint_with(self, *parts: str) -> str:
+        """= utils.table_store.fingerprint(self.text, *parts)，但模板本身不必重新 hash。"""
+        h = self._fp.copy()
+        for part in parts:
+            h.update(part.encode("utf-8"))
+            h.update(b"\0")
+        return h.hexdigest()[:16]
+
+    def messages(self, extra: str = "", **fields) -> List[Dict[str, str]]:
+        """與 build_messages(self.text, extra, **fields) 相同。"""
+        messages = []
+        if self.system is not None:
+            messages.append({"role": "system", "content": self.system})
+        messages.append({"role": "user", "content": self.suffix.format(**fields) + extra})
+        return messages
+
+    def format(self, **fields) -> str:
+        """整份模板當單一字串 (舊式 prompt，如 route.txt)。"""
+        return self.text.format(**fields)
+
+
+class PromptRegistry:
+    """path → PromptTemplate；hot_reload 時每 check_interval 秒最多 stat 一次，改了就重新載入。
+
+    重新載入失敗 (檔案寫到一半、欄位錯) 時沿用舊版並印出警告。
+    """
+
+    def __init__(self, hot_reload: bool = False, check_interval: float = 1.0):
+        self.hot_reload = hot_reload
+        self.check_interval = check_interval
+        self._templates: Dict[str, PromptTemplate] = {}
+        self._checked: Dict[str, float] = {}
+        self._failed: Dict[str, int] = {}         # 驗證失敗的版本 (mtime)，同一版只警告一次
+        self._lock = threading.Lock()
+
+    def configure(self, hot_reload: bool = None, check_interval: float = None) -> None:
+        if hot_reload is not None:
+            self.hot_reload = hot_reload
+        if check_interval is not None:
+            self.check_interval = check_interval
+
+    @staticmethod
+    def _key(path) -> str:
+        return str(pathlib.Path(path))
+
+    def register(self, path, role: str = None) -> PromptTemplate:
+        """載入並驗證；錯誤時丟 PromptError / FileNotFoundError。"""
+        tpl = PromptTemplate(pathlib.Path(path), role)
+        with self._lock:
+            self._templates[self._key(path)] = tpl
+            self._checked[self._key(path)] = time.monotonic()
+        return tpl
+
+    def get(self, path, role: str = None) -> PromptTemplate:
+        key = self._key(path)
+        tpl = self._templates.get(key)
+        if tpl is None:
+            return self.register(path, role)
+        if self.hot_reload:
+            tpl = self._maybe_reload(key, tpl)
+        return tpl
+
+    def _maybe_reload(self, key: str, tpl: PromptTemplate) -> PromptTemplate:
+        now = time.monotonic()
+        if now - self._checked.get(key, 0.0) < self.check_interval:
+            return tpl
+        self._checked[key] = now
+        try:
+            mtime_ns = tpl.path.stat().st_mtime_ns
+        except OSError as e:
+            print(f"⚠️ prompt {tpl.path} 無法讀取，沿用舊版: {e}")
+            return tpl
+        if mtime_ns in (tpl.mtime_ns, self._failed.get(key)):
+            return tpl
+        try:
+            new = PromptTemplate(tpl.path, tpl.role)
+        except (OSError, PromptError) as e:
+            self._failed[key] = mtime_ns
+            print(f"⚠️ prompt {tpl.path} 重新載入失敗，沿用舊版: {e}")
+            return tpl
+        print(f"prompt {tpl.path} reloaded ({tpl.fingerprint} → {new.fingerprint})")
+        with self._lock:
+            self._templates[key] = new
+        return new
+
+
+PROMPTS = PromptRegistry()
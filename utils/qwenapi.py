@@ -1,44 +1,291 @@
 import time
 import json
+import asyncio
+import weakref
 import requests
-import os
-from transformers import AutoTokenizer
+from requests.adapters import HTTPAdapter
+import threading
+from collections import Counter
+from utils.rate_limit import SCHEDULER, RETRYABLE_STATUS, estimate_tokens
+from utils.tokens import get_counter
+from utils.hedging import remaining
+
+
+class HTTPStatusError(Exception):
+    """vLLM server 回傳可重試的 HTTP 狀態 (429 / 5xx)；供 SCHEDULER 判斷退避。"""
+    def __init__(self, response):
+        super().__init__(f"HTTP {response.status_code}: {response.text[:200]}")
+        self.response = response
+        self.status_code = response.status_code
+
+
+# 同一個 server 共用一個 keep-alive 連線池 (requests.Session 可跨 thread 使用)
+_SESSIONS = {}
+_SESSIONS_LOCK = threading.Lock()
+
+
+def _shared_session(url, pool_size):
+    with _SESSIONS_LOCK:
+        session = _SESSIONS.get(url)
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            _SESSIONS[url] = session
+        return session
 
 
 class QwenAPI():
-    def __init__(self, url):
+    """OpenAI 相容 (vLLM) chat-completions client。
+
+    `llm(messages, temperature, max_tokens)` / `await llm.acall(...)` 與其他
+    provider client 介面相同；連線走共用的 keep-alive 連線池，
+    connect / read 各有 deadline。`response(input_text)` 保留舊介面。
+    """
+
+    def __init__(self, url, model_name="Qwen", connect_timeout=10.0,
+                 read_timeout=600.0, pool_size=64, max_input_tokens=128000):
         self.url = url
+        self.model_name = model_name
+        self.timeout = (connect_timeout, read_timeout)
+        self.pool_size = pool_size
+        self.session = _shared_session(url, pool_size)
+        self._aclients = weakref.WeakKeyDictionary()     # event loop → httpx.AsyncClient
+        self.headers = {"Authorization": "EMPTY"}
+
+        self.response_obj = None
+        self.prompt_tokens = self.completion_tokens = self.total_tokens = 0
+        self.cached_prompt_tokens = 0
+        self.usage_totals = Counter()
+
+        # tokenizer 由 utils.tokens 延遲載入 (STRUCTRAG_TOKENIZER)，沒有就用估算器
+        self.max_input_tokens = max_input_tokens
+        self.counter = get_counter(model_name)
+
+    @property
+    def aclient(self):
+        """httpx.AsyncClient 綁定建立它的 event loop：每個 loop 各一個 (loop 被回收時一併移除)。"""
+        import httpx
+
+        loop = asyncio.get_running_loop()
+        client = self._aclients.get(loop)
+        if client is None:
+            connect, read = self.timeout
+            client = self._aclients[loop] = httpx.AsyncClient(
+                headers=self.headers,
+                timeout=httpx.Timeout(read, connect=connect),
+                limits=httpx.Limits(max_connections=self.pool_size,
+                                    max_keepalive_connections=self.pool_size),
+            )
+        return client
+
+    async def aclose(self):
+        """關閉目前 loop 的連線池；需在 loop 結束前呼叫 (main 的 asyncio 模式結束時會呼叫)。"""
+        client = self._aclients.pop(asyncio.get_running_loop(), None)
+        if client is not None:
+            await client.aclose()
+
+    def close(self):
+        """同步 close hook (不在 event loop 內呼叫)：關閉其餘 loop 上還開著的連線池。
+
+        keep-alive Session 為同一 server 的所有 client 共用，不在這裡關。
+        """
+        for loop, client in list(self._aclients.items()):
+            del self._aclients[loop]
+            if loop.is_closed():
+                continue                    # 無法再 await；連線隨 client 回收
+            if loop.is_running():           # 別的 thread 上的 loop
+                asyncio.run_coroutine_threadsafe(client.aclose(), loop)
+            else:
+                loop.run_until_complete(client.aclose())
+
+    # ------------------------------------------------------------------
+    def _body(self, messages, temperature, max_tokens, kw):
+        body = {
+            "model": self.model_name,
+            "messages": messages,
+            "temperature": temperature,
+            "seed": 1024,
+            "max_tokens": max_tokens,
+        }
+        body.update(kw)
+        return body
+
+    def _timeout(self):
+        """(connect, read)；有 deadline 時 read timeout 不超過剩餘秒數。"""
+        connect, read = self.timeout
+        left = remaining()
+        return self.timeout if left is None else (connect, max(min(read, left), 0.001))
+
+    def _post(self, body):
+        callback = self.session.post(self.url, headers=self.headers, json=body,
+                                     timeout=self._timeout())
+        if callback.status_code in RETRYABLE_STATUS:
+            raise HTTPStatusError(callback)
+        return callback
+
+    async def _apost(self, body):
+        callback = await self.aclient.post(self.url, json=body)
+        if callback.status_code in RETRYABLE_STATUS:
+            raise HTTPStatusError(callback)
+        return callback
 
-        print("loading tokenizer")
-        if os.path.exists("/mnt/data/lizhuoqun/hf_models/gpt2"):
-            self.tokenizer = AutoTokenizer.from_pretrained("/mnt/data/lizhuoqun/hf_models/gpt2")
+    def __call__(self, messages, temperature=0.7, max_tokens=2048, **kw):
+        messages = self.counter.fit_messages(messages, self.max_input_tokens)
+        body = self._body(messages, temperature, max_tokens, kw)
+        callback = SCHEDULER.call("qwen", self.model_name, lambda: self._post(body),
+                                  cost=estimate_tokens(messages, max_tokens, self.model_name))
+        return self._wrap(callback.status_code, callback.json(), messages)
+
+    async def acall(self, messages, temperature=0.7, max_tokens=2048, **kw):
+        messages = self.counter.fit_messages(messages, self.max_input_tokens)
+        body = self._body(messages, temperature, max_tokens, kw)
+        callback = await SCHEDULER.acall("qwen", self.model_name,
+                                         lambda: self._apost(body),
+                                         cost=estimate_tokens(messages, max_tokens, self.model_name))
+        return self._wrap(callback.status_code, callback.json(), messages)
+
+    def stream(self, messages, temperature=0.7, max_tokens=2048, **kw):
+        """SSE 串流逐段 yield 文字；提早 close() generator 會關閉連線。"""
+        messages = self.counter.fit_messages(messages, self.max_input_tokens)
+        body = self._body(messages, temperature, max_tokens, dict(kw, stream=True))
+        body.setdefault("stream_options", {"include_usage": True})   # vLLM 最後送一個 usage chunk
+
+        def open_stream():
+            callback = self.session.post(self.url, headers=self.headers, json=body,
+                                         timeout=self._timeout(), stream=True)
+            if callback.status_code in RETRYABLE_STATUS:
+                callback.close()
+                raise HTTPStatusError(callback)
+            if not 200 <= callback.status_code < 300:     # 400 / 401 …：body 沒有 data: 行
+                text = callback.text
+                callback.close()
+                raise RuntimeError(f"qwenapi HTTP {callback.status_code}: {text[:500]}")
+            return callback
+
+        callback = SCHEDULER.call("qwen", self.model_name, open_stream,
+                                  cost=estimate_tokens(messages, max_tokens, self.model_name))
+        usage, pieces = None, []
+        try:
+            for line in callback.iter_lines(decode_unicode=True):
+                chunk = self._sse_chunk(line)
+                if chunk is None:
+                    continue
+                usage = chunk.get("usage") or usage
+                piece = self._delta(chunk)
+                if piece:
+                    pieces.append(piece)
+                    yield piece
+        finally:
+            callback.close()
+            self._stream_usage(messages, usage, pieces)
+
+    async def astream(self, messages, temperature=0.7, max_tokens=2048, **kw):
+        messages = self.counter.fit_messages(messages, self.max_input_tokens)
+        body = self._body(messages, temperature, max_tokens, dict(kw, stream=True))
+        body.setdefault("stream_options", {"include_usage": True})
+
+        async def open_stream():
+            request = self.aclient.build_request("POST", self.url, json=body)
+            callback = await self.aclient.send(request, stream=True)
+            if callback.status_code in RETRYABLE_STATUS:
+                await callback.aread()
+                await callback.aclose()
+                raise HTTPStatusError(callback)
+            if not 200 <= callback.status_code < 300:
+                await callback.aread()
+                await callback.aclose()
+                raise RuntimeError(f"qwenapi HTTP {callback.status_code}: {callback.text[:500]}")
+            return callback
+
+        callback = await SCHEDULER.acall("qwen", self.model_name, open_stream,
+                                         cost=estimate_tokens(messages, max_tokens, self.model_name))
+        usage, pieces = None, []
+        try:
+            async for line in callback.aiter_lines():
+                chunk = self._sse_chunk(line)
+                if chunk is None:
+                    continue
+                usage = chunk.get("usage") or usage
+                piece = self._delta(chunk)
+                if piece:
+                    pieces.append(piece)
+                    yield piece
+        finally:
+            await callback.aclose()
+            self._stream_usage(messages, usage, pieces)
+
+    @staticmethod
+    def _sse_chunk(line):
+        """`data: {...}` → dict；空行、註解與 [DONE] → None。"""
+        if not line or not line.startswith("data:"):
+            return None
+        data = line[len("data:"):].strip()
+        if data == "[DONE]":
+            return None
+        return json.loads(data)
+
+    @staticmethod
+    def _delta(chunk):
+        if not chunk.get("choices"):
+            return None
+        return chunk["choices"][0].get("delta", {}).get("content")
+
+    def _record_usage(self, messages, usage, measured=True):
+        details = usage.get("prompt_tokens_details") or {}
+        self.prompt_tokens = usage.get("prompt_tokens", 0)
+        self.completion_tokens = usage.get("completion_tokens", 0)
+        self.total_tokens = usage.get("total_tokens", 0) \
+            or self.prompt_tokens + self.completion_tokens
+        self.cached_prompt_tokens = details.get("cached_tokens", 0) or 0
+        self.usage_totals.update(prompt=self.prompt_tokens,
+                                 cached=self.cached_prompt_tokens,
+                                 completion=self.completion_tokens)
+        if measured:
+            self.counter.observe(messages, self.prompt_tokens)
+
+    def _stream_usage(self, messages, usage, pieces):
+        """串流結束：有 usage chunk 就照實記錄；提早中斷 (沒收到) 時以估算值記錄、不校正。"""
+        if usage is not None:
+            self._record_usage(messages, usage)
         else:
-            raise Exception("No model path found")
-        print("loading tokenizer done")
+            self._record_usage(messages, {
+                "prompt_tokens": self.counter.count_messages(messages),
+                "completion_tokens": self.counter.count("".join(pieces))}, measured=False)
 
+    def _wrap(self, status_code, result, messages=()):
+        if status_code != 200 or "choices" not in result:
+            raise RuntimeError(f"qwenapi HTTP {status_code}: {result}")
+        self.response_obj = result
+        self._record_usage(messages, result.get("usage") or {})
+        choice = result["choices"][0]
+        return {
+            "choices": [{
+                "message": {"role": "assistant", "content": choice["message"]["content"]},
+                "finish_reason": choice.get("finish_reason"),
+            }],
+            "model": self.model_name,
+            "usage": {
+                "prompt_tokens": self.prompt_tokens,
+                "cached_tokens": self.cached_prompt_tokens,
+                "completion_tokens": self.completion_tokens,
+            },
+        }
+
+    # ------------------------------------------------------------------
     def response(self, input_text, max_new_tokens=4096):
         current_time = time.time()
-        
-        input_text_len = len(self.tokenizer(input_text)['input_ids'])
+
+        input_text_len = self.counter.count(input_text)
         print(f"input_text_len: {input_text_len}")
-        if input_text_len > 128000:
+        if input_text_len > self.max_input_tokens:
             print(f"input_text_len: {input_text_len}", "we reduce the input_text_len")
-            input_text = input_text[:int(len(input_text)*(128000/input_text_len))]
-
-        url = self.url
-        headers = {
-            # "Content-Type": "application/json",
-            "Authorization": "EMPTY"
-        }
-        raw_info = {
-            "model": "Qwen",
-            "messages": [{"role": "user", "content": input_text}],
-            "seed": 1024,
-            "max_tokens": max_new_tokens
-        }
+            input_text = self.counter.truncate(input_text, self.max_input_tokens)
 
-        data = json.dumps(raw_info)
-        # print(data)
+        body = self._body([{"role": "user", "content": input_text}], 0.7,
+                          max_new_tokens, {})
+        body.pop("temperature")     # 舊介面沿用 server 預設溫度
 
         try_time = 0
         response = None
@@ -46,38 +293,36 @@ class QwenAPI():
             try_time += 1
 
             try:
-                callback = requests.post(url, headers=headers, data=data, timeout=(10000, 10000))
+                # 429 / 5xx / 連線錯誤由 SCHEDULER 以指數退避重送；其餘狀態交給下方處理
+                callback = SCHEDULER.call(
+                    "qwen", self.model_name,
+                    lambda: self._post(body),
+                    cost=len(input_text) + max_new_tokens,
+                )
                 print("callback.status_code", callback.status_code)
-                print(f"prompt_tokens: {callback.json()['usage']['prompt_tokens']}, total_tokens: {callback.json()['usage']['total_tokens']}, completion_tokens: {callback.json()['usage']['completion_tokens']}")
+                result = callback.json()
             except Exception as e:
                 print(f"(print in qwenapi.py callback, try_time {try_time}) Error: {e}")
                 continue
 
             try:
-                result = callback.json()
-                # print(result)
-                # print(result.keys())
                 response = result['choices'][0]['message']['content']
-                # print(response)
-                # input()
+                print(f"prompt_tokens: {result['usage']['prompt_tokens']}, total_tokens: {result['usage']['total_tokens']}, completion_tokens: {result['usage']['completion_tokens']}")
                 break
             except Exception as e:
-                print(f"(print in qwenapi.py response, try_time {try_time}) callback: {callback.json()} Error: {e}")
-                if "Please reduce the length of the messages" in callback.json()['message']:
-                    current_tokne_len = callback.json()['message'].split("However, you requested")[1].split("tokens in the messages, Please")[0].strip()
+                print(f"(print in qwenapi.py response, try_time {try_time}) callback: {result} Error: {e}")
+                if "Please reduce the length of the messages" in result.get('message', ''):
+                    current_tokne_len = result['message'].split("However, you requested")[1].split("tokens in the messages, Please")[0].strip()
                     current_tokne_len = int(current_tokne_len)
                     print(f"current_tokne_len: {current_tokne_len}")
-                    raw_info = {
-                        "model": "Qwen",
-                        "messages": [{"role": "user", "content": input_text[:int(len(input_text)*(128000/current_tokne_len))]}],
-                        "seed": 1024,
-                        "max_tokens": max_new_tokens
-                    }
-                    data = json.dumps(raw_info)
-                continue    
+                    # 估算器低估了：以 server 回報的長度校正後重截一次
+                    self.counter.observe(body["messages"], current_tokne_len)
+                    input_text = self.counter.truncate(input_text, self.max_input_tokens)
+                    body["messages"] = [{"role": "user", "content": input_text}]
+                continue
 
         if response is None:
             raise Exception(f"response is None")
 
         print("used time in this qwenapi:", (time.time()-current_time)/60, "min")
-        return response
\ No newline at end of file
+        return response
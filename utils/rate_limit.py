@@ -0,0 +1,287 @@
+import time
+import random
+import asyncio
+import threading
+import email.utils
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from utils import telemetry
+from utils.hedging import check_deadline, remaining, DeadlineExpired
+
+
+# 預設額度 (requests / tokens per minute)；依帳號等級用 configure() 覆寫
+DEFAULT_LIMITS: Dict[str, Dict[str, float]] = {
+    "openai": {"rpm": 500,  "tpm": 200_000, "max_concurrency": 32},
+    "claude": {"rpm": 50,   "tpm": 40_000,  "max_concurrency": 8},
+    "gemini": {"rpm": 60,   "tpm": 1_000_000, "max_concurrency": 8},
+    "qwen":   {"rpm": 1_000_000, "tpm": 1e12, "max_concurrency": 64},   # 自架 vLLM
+    "mock":   {"rpm": 1_000_000, "tpm": 1e12, "max_concurrency": 256},  # mock_llm.FakeLLM
+}
+
+RETRYABLE_STATUS = {408, 409, 429, 500, 502, 503, 504, 529}
+THROTTLE_STATUS  = {429, 529}
+RETRYABLE_NAMES  = ("Timeout", "Connection", "ResourceExhausted",
+                    "ServiceUnavailable", "Overloaded", "RateLimit",
+                    "InternalServerError", "DeadlineExceeded")
+THROTTLE_NAMES   = ("ResourceExhausted", "Overloaded", "RateLimit")
+
+
+def estimate_tokens(messages: List[Dict], max_tokens: int = 0, model: str = "") -> int:
+    """一次呼叫會吃掉的 TPM 額度：輸入 token (utils.tokens) + max_tokens。"""
+    from utils.tokens import get_counter
+    return get_counter(model).count_messages(messages) + max_tokens
+
+
+def classify_error(exc: BaseException) -> Tuple[bool, bool, Optional[float]]:
+    """→ (retryable, throttled, retry_after_seconds)。
+
+    支援 openai / anthropic (exc.status_code, exc.response.headers)、
+    google api_core (exc.code) 以及 utils.qwenapi.HTTPStatusError。
+    """
+    response = getattr(exc, "response", None)
+    status = getattr(exc, "status_code", None) \
+        or getattr(response, "status_code", None)
+    code = getattr(exc, "code", None)
+    if status is None and isinstance(code, int):
+        status = code
+    name = type(exc).__name__
+
+    retryable = status in RETRYABLE_STATUS or any(k in name for k in RETRYABLE_NAMES)
+    throttled = status in THROTTLE_STATUS or any(k in name for k in THROTTLE_NAMES)
+    if "overloaded" in str(exc).lower():
+        retryable = throttled = True
+
+    headers = getattr(response, "headers", None) or getattr(exc, "headers", None) or {}
+    return retryable, throttled, _parse_retry_after(headers)
+
+
+def _parse_retry_after(headers) -> Optional[float]:
+    try:
+        ms = headers.get("retry-after-ms")
+        if ms is not None:
+            return float(ms) / 1000.0
+        val = headers.get("retry-after")
+    except AttributeError:
+        return None
+    if val is None:
+        return None
+    try:
+        return max(0.0, float(val))
+    except ValueError:
+        pass
+    try:  # HTTP-date
+        when = email.utils.parsedate_to_datetime(val)
+        return max(0.0, when.timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class ProviderLimiter:
+    """單一 (provider, model) 的 RPM / TPM token bucket + AIMD 自適應並行上限。
+
+    同一物件可同時被 thread 與 asyncio task 使用 (狀態由 threading.Lock 保護，
+    等待時各自 time.sleep / asyncio.sleep)。
+    """
+
+    def __init__(self, rpm: float, tpm: float, max_concurrency: int = 8,
+                 min_concurrency: int = 1):
+        self.rpm, self.tpm = float(rpm), float(tpm)
+        self.max_concurrency = max(1, int(max_concurrency))
+        self.min_concurrency = max(1, min(int(min_concurrency), self.max_concurrency))
+        self.limit = float(self.max_concurrency)
+
+        self._req_tokens = self.rpm
+        self._tok_tokens = self.tpm
+        self._last_refill = time.monotonic()
+        self._cooldown_until = 0.0
+        self._in_flight = 0
+        self._streak = 0
+        self._lock = threading.Lock()
+
+        # 觀測值
+        self.n_ok = self.n_throttled = self.n_errors = 0
+
+    # ------------------------------------------------------------------
+    def _refill(self, now: float) -> None:
+        dt = now - self._last_refill
+        self._last_refill = now
+        self._req_tokens = min(self.rpm, self._req_tokens + dt * self.rpm / 60.0)
+        self._tok_tokens = min(self.tpm, self._tok_tokens + dt * self.tpm / 60.0)
+
+    def _try_acquire(self, cost: int) -> float:
+        """成功 → 0；否則回傳建議等待秒數。"""
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            if now < self._cooldown_until:
+                return self._cooldown_until - now
+            if self._in_flight >= int(self.limit):
+                return 0.05
+            # 單次請求超過整桶時，等桶滿即放行 (允許透支)
+            need_tok = min(cost, self.tpm)
+            if self._req_tokens < 1:
+                return (1 - self._req_tokens) * 60.0 / self.rpm
+            if self._tok_tokens < need_tok:
+                return (need_tok - self._tok_tokens) * 60.0 / self.tpm
+            self._req_tokens -= 1
+            self._tok_tokens -= cost
+            self._in_flight += 1
+            return 0.0
+
+    def acquire(self, cost: int) -> float:
+        """阻塞直到可送出；回傳排隊等待秒數。"""
+        start = time.monotonic()
+        while True:
+            wait = self._try_acquire(cost)
+            if wait == 0.0:
+                return time.monotonic() - start
+            time.sleep(min(wait, 1.0))
+
+    async def aacquire(self, cost: int) -> float:
+        start = time.monotonic()
+        while True:
+            wait = self._try_acquire(cost)
+            if wait == 0.0:
+                return time.monotonic() - start
+            await asyncio.sleep(min(wait, 1.0))
+
+    def release(self, ok: bool, throttled: bool = False,
+                retry_after: Optional[float] = None) -> None:
+        with self._lock:
+            self._in_flight -= 1
+            if ok:
+                self.n_ok += 1
+                self._streak += 1
+                # additive increase：連續成功一個「窗」才 +1
+                if self._streak >= self.limit and self.limit < self.max_concurrency:
+                    self.limit += 1
+                    self._streak = 0
+            elif throttled:
+                self.n_throttled += 1
+                self._streak = 0
+                # multiplicative decrease
+                self.limit = max(self.min_concurrency, self.limit / 2)
+                if retry_after:
+                    self._cooldown_until = max(self._cooldown_until,
+                                               time.monotonic() + retry_after)
+            else:
+                self.n_errors += 1
+                self._streak = 0
+
+    def stats(self) -> Dict[str, Any]:
+        return {"limit": int(self.limit), "in_flight": self._in_flight,
+                "ok": self.n_ok, "throttled": self.n_throttled,
+                "errors": self.n_errors}
+
+
+class Scheduler:
+    """所有 provider client 共用的排程器：限流 + 重試 (jittered exponential backoff)。"""
+
+    def __init__(self, max_retries: int = 6, base_delay: float = 1.0,
+                 max_delay: float = 60.0):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._limiters: Dict[Tuple[str, str], ProviderLimiter] = {}
+        self._overrides: Dict[Tuple[str, Optional[str]], Dict[str, float]] = {}
+        self._lock = threading.Lock()
+
+    def configure(self, provider: str, model: Optional[str] = None, **limits) -> None:
+        """覆寫額度，例如 configure("claude", rpm=4000, tpm=400_000)。
+
+        model=None 表示套用於該 provider 底下所有尚未建立的 model。
+        """
+        limits = {k: v for k, v in limits.items() if v is not None}
+        with self._lock:
+            self._overrides.setdefault((provider, model), {}).update(limits)
+            for key in [k for k in self._limiters
+                        if k[0] == provider and model in (None, k[1])]:
+                del self._limiters[key]
+
+    def limiter(self, provider: str, model: str) -> ProviderLimiter:
+        key = (provider, model)
+        with self._lock:
+            lim = self._limiters.get(key)
+            if lim is None:
+                cfg = dict(DEFAULT_LIMITS.get(provider, DEFAULT_LIMITS["openai"]))
+                cfg.update(self._overrides.get((provider, None), {}))
+                cfg.update(self._overrides.get(key, {}))
+                lim = self._limiters[key] = ProviderLimiter(**cfg)
+            return lim
+
+    def backoff(self, attempt: int, retry_after: Optional[float] = None) -> float:
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        return max(delay, retry_after or 0.0)
+
+    # ------------------------------------------------------------------
+    def call(self, provider: str, model: str, fn: Callable[[], Any],
+             cost: int = 0, max_retries: Optional[int] = None):
+        """在限流下執行 fn()；可重試的錯誤會退避後重送。"""
+        lim = self.limiter(provider, model)
+        retries = self.max_retries if max_retries is None else max_retries
+        for attempt in range(retries + 1):
+            check_deadline()
+            telemetry.note_wait(lim.acquire(cost))
+            try:
+                result = fn()
+            except (KeyboardInterrupt, asyncio.CancelledError):
+                lim.release(False)
+                raise
+            except Exception as e:
+                retryable, throttled, retry_after = classify_error(e)
+                lim.release(False, throttled, retry_after)
+                if not retryable or attempt == retries:
+                    raise
+                delay = self.backoff(attempt, retry_after)
+                left = remaining()
+                if left is not None and delay >= left:
+                    raise DeadlineExpired(f"deadline exceeded after {attempt + 1} attempts") from e
+                telemetry.note_retry()
+                print(f"[{provider}/{model}] {type(e).__name__}; retry {attempt + 1}/{retries} in {delay:.1f}s")
+                time.sleep(delay)
+                continue
+            lim.release(True)
+            return result
+
+    async def acall(self, provider: str, model: str, fn: Callable[[], Any],
+                    cost: int = 0, max_retries: Optional[int] = None):
+        """call() 的 asyncio 版本；fn() 需回傳 awaitable。"""
+        lim = self.limiter(provider, model)
+        retries = self.max_retries if max_retries is None else max_retries
+        for attempt in range(retries + 1):
+            check_deadline()
+            telemetry.note_wait(await lim.aacquire(cost))
+            try:
+                left = remaining()
+                if left is None:
+                    result = await fn()
+                else:
+                    try:
+                        result = await asyncio.wait_for(fn(), max(left, 0.0))
+                    except asyncio.TimeoutError:
+                        raise DeadlineExpired("deadline exceeded") from None
+            except (KeyboardInterrupt, asyncio.CancelledError):
+                lim.release(False)
+                raise
+            except Exception as e:
+                retryable, throttled, retry_after = classify_error(e)
+                lim.release(False, throttled, retry_after)
+                if not retryable or attempt == retries:
+                    raise
+                delay = self.backoff(attempt, retry_after)
+                left = remaining()
+                if left is not None and delay >= left:
+                    raise DeadlineExpired(f"deadline exceeded after {attempt + 1} attempts") from e
+                telemetry.note_retry()
+                print(f"[{provider}/{model}] {type(e).__name__}; retry {attempt + 1}/{retries} in {delay:.1f}s")
+                await asyncio.sleep(delay)
+                continue
+            lim.release(True)
+            return result
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        with self._lock:
+            return {f"{p}/{m}": lim.stats() for (p, m), lim in self._limiters.items()}
+
+
+SCHEDULER = Scheduler()
@@ -0,0 +1,54 @@
+"""長裁定書切段：依段落標題切開，再依 token 預算合併成數個 chunk (map-reduce 建表用)。
+
+切點優先序：主文 / 事實 / 理由 等大標 → 壹、一、 等條列 → ㈠ / (一) 等子項 → 換行 → 硬切。
+只有超過預算的段落才往下一層切；相鄰的小段落會盡量併在同一個 chunk，chunk 數越少越好。
+"""
+import re
+from typing import Callable, List
+
+LEVELS = [
+    re.compile(r"^\s*(?:主\s*文|事\s*實(?:\s*[及與]\s*理\s*由)?|理\s*由|犯罪事實|據上論[結斷]"
+               r"|附\s*表|附\s*錄)\s*[：:]?\s*$", re.MULTILINE),
+    re.compile(r"^\s*(?:[壹貳參肆伍陸柒捌玖拾]+|[一二三四五六七八九十]+)、", re.MULTILINE),
+    re.compile(r"^\s*(?:[㈠㈡㈢㈣㈤㈥㈦㈧㈨㈩]|[（(][一二三四五六七八九十]+[)）])", re.MULTILINE),
+    re.compile(r"\n"),
+]
+
+
+def split_at(text: str, pattern: re.Pattern) -> List[str]:
+    """在每個 pattern 出現的位置前切開 (標題留在下一段開頭)。"""
+    cuts = [m.start() for m in pattern.finditer(text) if m.start() > 0]
+    bounds = [0] + cuts + [len(text)]
+    return [text[a:b] for a, b in zip(bounds, bounds[1:]) if text[a:b].strip()]
+
+
+def chunk_sections(text: str, budget: int, count: Callable[[str], int],
+                   level: int = 0) -> List[str]:
+    """→ 每段 <= budget tokens 的 chunk 清單 (依原文順序；只含空白的片段略過)。"""
+    if count(text) <= budget:
+        return [text]
+    if level >= len(LEVELS):                         # 連一行都超過預算：依比例硬切
+        n = -(-count(text) // budget)
+        step = -(-len(text) // n)
+        return [text[i:i + step] for i in range(0, len(text), step)]
+    parts = split_at(text, LEVELS[level])
+    if len(parts) <= 1:
+        return chunk_sections(text, budget, count, level + 1)
+
+    chunks: List[str] = []
+    buf, used = "", 0                   # token 數以各段相加估計，不必每次重算整個 buf
+    for part in parts:
+        n = count(part)
+        if n > budget:
+            if buf:
+                chunks.append(buf)
+                buf, used = "", 0
+            chunks.extend(chunk_sections(part, budget, count, level + 1))
+        elif buf and used + n > budget:
+            chunks.append(buf)
+            buf, used = part, n
+        else:
+            buf, used = buf + part, used + n
+    if buf:
+        chunks.append(buf)
+    return chunks
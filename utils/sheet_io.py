@@ -0,0 +1,191 @@
+"""Spreadsheet I/O：Excel → Parquet ingest 快取、逐列讀取、串流寫出。
+
+- load_sheet(path)：第一次把 .xlsx 轉成 cache/ingest/*.parquet；之後 mtime/size
+  相同直接沿用，mtime 變了但內容 hash 相同也沿用，不必重新解析 Excel。
+- iter_rows(parquet)：以 record batch 逐列產生 (idx, dict)，不把整張表載入 DataFrame。
+- SheetWriter：只保留每列的「新增欄位」(verdict、布林欄…)，結束時再與輸入列逐列合併，
+  以 openpyxl write-only 模式串流寫 Excel，可另外輸出 CSV / Parquet。
+"""
+import csv
+import json
+import hashlib
+import pathlib
+from typing import Any, Dict, Iterator, List, Sequence, Tuple
+
+INGEST_DIR = pathlib.Path("cache/ingest")
+
+
+def _file_sha256(path: pathlib.Path) -> str:
+    h = hashlib.sha256()
+    with path.open("rb") as fh:
+        for block in iter(lambda: fh.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def _to_arrow(df):
+    """DataFrame → pyarrow Table；型別混雜的 object 欄 (Excel 常見) 轉成字串。"""
+    import pyarrow as pa
+
+    for col in df.columns:
+        if df[col].dtype == object:
+            try:
+                pa.array(df[col], from_pandas=True)
+            except (pa.ArrowInvalid, pa.ArrowTypeError):
+                df[col] = df[col].map(lambda v: v if v is None or v != v else str(v))
+    return pa.Table.from_pandas(df, preserve_index=False)
+
+
+def load_sheet(path: str or pathlib.Path, cache_dir: str or pathlib.Path = INGEST_DIR,
+               sheet_name=0) -> pathlib.Path:
+    """→ 對應的 Parquet 快取檔路徑 (需要時才重新解析 Excel)。"""
+    import pyarrow.parquet as pq
+
+    path = pathlib.Path(path)
+    cache_dir = pathlib.Path(cache_dir)
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    tag = hashlib.sha1(str(path.resolve()).encode("utf-8")).hexdigest()[:8]
+    parquet_path = cache_dir / f"{path.stem}-{tag}.parquet"
+    meta_path = parquet_path.with_suffix(".meta.json")
+
+    stat = path.stat()
+    meta = json.loads(meta_path.read_text()) if meta_path.exists() else {}
+    if parquet_path.exists() and meta.get("sheet_name") == sheet_name:
+        if meta.get("mtime_ns") == stat.st_mtime_ns and meta.get("size") == stat.st_size:
+            return parquet_path
+        digest = _file_sha256(path)
+        if meta.get("sha256") == digest:
+            meta.update(mtime_ns=stat.st_mtime_ns, size=stat.st_size)
+            meta_path.write_text(json.dumps(meta))
+            return parquet_path
+    else:
+        digest = _file_sha256(path)
+
+    import pandas as pd
+    print(f"ingest {path} → {parquet_path}")
+    df = pd.read_excel(path, sheet_name=sheet_name)
+    tmp = parquet_path.with_suffix(".parquet.tmp")
+    pq.write_table(_to_arrow(df), tmp)
+    tmp.replace(parquet_path)
+    meta_path.write_text(json.dumps({"source": str(path), "sheet_name": sheet_name,
+                                     "mtime_ns": stat.st_mtime_ns, "size": stat.st_size,
+                                     "sha256": digest, "rows": len(df)}))
+    return parquet_path
+
+
+def sheet_columns(parquet_path: pathlib.Path) -> List[str]:
+    import pyarrow.parquet as pq
+    return pq.read_schema(parquet_path).names
+
+
+def iter_rows(parquet_path: pathlib.Path, batch_size: int = 256,
+              columns: Sequence[str] = None) -> Iterator[Tuple[int, Dict[str, Any]]]:
+    """逐列 yield (列號, {欄名: 值})；空白儲存格為 None，columns 中不存在的欄略過。"""
+    import pyarrow.parquet as pq
+
+    pf = pq.ParquetFile(parquet_path)
+    if columns is not None:
+        columns = [c for c in columns if c in pf.schema_arrow.names]
+    idx = 0
+    for batch in pf.iter_batches(batch_size=batch_size, columns=columns):
+        for row in batch.to_pylist():
+            yield idx, row
+            idx += 1
+
+
+def _keep(col: str) -> bool:
+    return not str(col).startswith("Unnamed")
+
+
+class SheetWriter:
+    """收集每列的新增欄位，close() 時與輸入列合併並串流寫出。
+
+    輸出欄順序與舊版 `pd.DataFrame(results)` 相同：輸入欄在前 (去掉 Unnamed、
+    去掉欄名尾空白)，其後依第一次出現的順序接上新增欄。只有 add() 過的列會輸出。
+    """
+
+    def __init__(self, out_path: str or pathlib.Path, extra_formats: Sequence[str] = ()):
+        self.out_path = pathlib.Path(out_path)
+        self.extra_formats = tuple(extra_formats)       # "csv" / "parquet"
+        self.fields: Dict[int, Dict[str, Any]] = {}
+
+    def add(self, idx: int, fields: Dict[str, Any]) -> None:
+        self.fields[idx] = fields
+
+    def __len__(self) -> int:
+        return len(self.fields)
+
+    def _new_columns(self, input_cols: List[str]) -> List[str]:
+        seen = dict.fromkeys(input_cols)
+        new = {}
+        for idx in sorted(self.fields):
+            for k in self.fields[idx]:
+                if k not in seen:
+                    new[k] = None
+        return list(new)
+
+    def close(self, source: pathlib.Path) -> List[pathlib.Path]:
+        """source：load_sheet() 回傳的 Parquet；回傳寫出的檔案清單。"""
+        from openpyxl import Workbook
+
+        self.out_path.parent.mkdir(parents=True, exist_ok=True)
+        input_cols = [c for c in sheet_columns(source) if _keep(c)]
+        new_cols = self._new_columns(input_cols)
+        header = [str(c).strip() for c in input_cols] + new_cols
+
+        wb = Workbook(write_only=True)
+        ws = wb.create_sheet()
+        ws.append(header)
+        csv_fh = writer = None
+        if "csv" in self.extra_formats:
+            csv_fh = self.out_path.with_suffix(".csv").open("w", encoding="utf-8-sig",
+                                                              newline="")
+            writer = csv.writer(csv_fh)
+            writer.writerow(header)
+        try:
+            for idx, row in iter_rows(source, columns=input_cols):
+                fields = self.fields.get(idx)
+                if fields is None:
+                    continue
+                values = [fields[c] if c in fields else row[c] for c in input_cols]
+                values += [fields.get(c) for c in new_cols]
+                ws.append(values)
+                if writer is not None:
+                    writer.writerow(["" if v is None else v for v in values])
+        finally:
+            if csv_fh is not None:
+                csv_fh.close()
+        wb.save(self.out_path)
+
+        written = [self.out_path]
+        if csv_fh is not None:
+            written.append(self.out_path.with_suffix(".csv"))
+        if "parquet" in self.extra_formats:
+            written.append(self._write_parquet(source, input_cols, new_cols))
+        return written
+
+    def _write_parquet(self, source, input_cols, new_cols) -> pathlib.Path:
+        import pyarrow.parquet as pq
+
+        order = sorted(self.fields)
+        table = pq.read_table(source, columns=input_cols, memory_map=True).take(order)
+        table = table.rename_columns([str(c).strip() for c in input_cols])
+        for c in input_cols:              # 新增欄覆寫同名輸入欄 (與 Excel 輸出一致)
+            if any(c in self.fields[i] for i in order):
+                pos = input_cols.index(c)
+                orig = table.column(pos).to_pylist()
+                vals = [self.fields[i].get(c, o) for i, o in zip(order, orig)]
+                table = table.set_column(pos, str(c).strip(), self._array(vals))
+        for c in new_cols:
+            table = table.append_column(c, self._array([self.fields[i].get(c) for i in order]))
+        path = self.out_path.with_suffix(".parquet")
+        pq.write_table(table, path)
+        return path
+
+    @staticmethod
+    def _array(values):
+        import pyarrow as pa
+        try:
+            return pa.array(values)
+        except (pa.ArrowInvalid, pa.ArrowTypeError):     # 動態欄型別混雜 → 字串
+            return pa.array([None if v is None else str(v) for v in values])
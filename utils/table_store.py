@@ -0,0 +1,192 @@
+"""布林表的持久化介面 (內容定址)。
+
+Structurizer 產生的表格直接以字串交給 Utilizer (不再寫檔再讀回)；TableStore 只負責
+留存 / 之後重用。key = hash(裁定書內容, prompt 指紋, model)，與列號、輸入檔無關：
+同一份裁定書出現在另一張 sheet 或下一次執行時，Structurizer 直接沿用已存的表格。
+另有 裁定字號 → key 的索引，方便人工查找。
+- DirTableStore：`<root>/<key>.md` + `<root>/index.jsonl`。
+- SQLiteTableStore：單一 .sqlite 檔 (WAL)，多個 worker / 程序同時寫不必搶目錄。
+舊版以列號命名的 table_kb/data_{idx}.md 用 migrate_table_kb.py 轉換。
+"""
+import json
+import time
+import hashlib
+import sqlite3
+import pathlib
+import threading
+from typing import Dict, Iterator, Optional
+
+
+def fingerprint(*parts: str) -> str:
+    h = hashlib.sha256()
+    for part in parts:
+        h.update(part.encode("utf-8"))
+        h.update(b"\0")
+    return h.hexdigest()[:16]
+
+
+def table_key(core_text: str, prompt_fp: str, model: str) -> str:
+    """表格的內容位址：裁定書全文 + prompt 指紋 (模板與附加段落) + model。"""
+    digest = hashlib.sha256(
+        f"{core_text.strip()}\0{prompt_fp}\0{model}".encode("utf-8")).hexdigest()
+    return digest[:24]
+
+
+class TableStore:
+    """key (table_key) → Markdown 表格字串；另存 裁定字號 → key 索引。"""
+
+    def get(self, key) -> Optional[str]:
+        raise NotImplementedError
+
+    def put(self, key, table_md: str) -> None:
+        raise NotImplementedError
+
+    def keys(self) -> Iterator[str]:
+        raise NotImplementedError
+
+    def link(self, title: str, key: str) -> None:
+        raise NotImplementedError
+
+    def resolve(self, title: str) -> Optional[str]:
+        """裁定字號 → 最近一次對應的 key。"""
+        raise NotImplementedError
+
+    def __contains__(self, key) -> bool:
+        return self.get(key) is not None
+
+    def load(self, key) -> str:
+        """同 get，但找不到時丟 KeyError (Utilizer 需要表格時用)。"""
+        table_md = self.get(key)
+        if table_md is None:
+            raise KeyError(f"{self}: 沒有 key {key} 的表格")
+        return table_md
+
+    def close(self) -> None:
+        pass
+
+
+class DirTableStore(TableStore):
+    INDEX = "index.jsonl"
+
+    def __init__(self, root: str or pathlib.Path = "table_kb"):
+        self.root = pathlib.Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._titles: Optional[Dict[str, str]] = None
+
+    def __repr__(self) -> str:
+        return f"DirTableStore({str(self.root)!r})"
+
+    def path(self, key) -> pathlib.Path:
+        return self.root / f"{key}.md"
+
+    def get(self, key) -> Optional[str]:
+        try:
+            return self.path(key).read_text(encoding="utf-8")
+        except FileNotFoundError:
+            return None
+
+    def put(self, key, table_md: str) -> None:
+        path = self.path(key)
+        tmp = path.with_name(f".{path.name}.tmp")     # 先寫暫存再換名，讀的人不會看到半個檔
+        tmp.write_text(table_md, encoding="utf-8")
+        tmp.replace(path)
+
+    def keys(self) -> Iterator[str]:
+        for p in sorted(self.root.glob("*.md")):
+            yield p.stem
+
+    # ------------------------------------------------------------------
+    def _index(self) -> Dict[str, str]:
+        if self._titles is None:
+            self._titles = {}
+            index = self.root / self.INDEX
+            if index.exists():
+                with index.open(encoding="utf-8") as fh:
+                    for line in fh:
+                        try:
+                            rec = json.loads(line)
+                        except json.JSONDecodeError:
+                            continue                   # crash 留下的半行
+                        self._titles[rec["title"]] = rec["key"]
+        return self._titles
+
+    def link(self, title: str, key: str) -> None:
+        with self._lock:
+            titles = self._index()
+            if titles.get(title) == key:
+                return
+            titles[title] = key
+            line = json.dumps({"title": title, "key": key}, ensure_ascii=False)
+            with (self.root / self.INDEX).open("a", encoding="utf-8") as fh:
+                fh.write(line + "\n")      # 單行 append；同名以最後一行為準
+
+    def resolve(self, title: str) -> Optional[str]:
+        with self._lock:
+            return self._index().get(title)
+
+
+class SQLiteTableStore(TableStore):
+    def __init__(self, path: str or pathlib.Path = "cache/tables.sqlite"):
+        self.path = pathlib.Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(self.path), check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS tables ("
+            " key TEXT PRIMARY KEY,"
+            " table_md TEXT NOT NULL,"
+            " created_at REAL NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS titles ("
+            " title TEXT PRIMARY KEY,"
+            " key TEXT NOT NULL,"
+            " updated_at REAL NOT NULL)"
+        )
+        self._conn.commit()
+
+    def __repr__(self) -> str:
+        return f"SQLiteTableStore({str(self.path)!r})"
+
+    def get(self, key) -> Optional[str]:
+        with self._lock:
+            row = self._conn.execute("SELECT table_md FROM tables WHERE key = ?",
+                                     (str(key),)).fetchone()
+        return None if row is None else row[0]
+
+    def put(self, key, table_md: str) -> None:
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO tables VALUES (?, ?, ?)",
+                               (str(key), table_md, time.time()))
+            self._conn.commit()
+
+    def keys(self) -> Iterator[str]:
+        with self._lock:
+            rows = self._conn.execute("SELECT key FROM tables ORDER BY key").fetchall()
+        return iter([r[0] for r in rows])
+
+    def link(self, title: str, key: str) -> None:
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO titles VALUES (?, ?, ?)",
+                               (title, key, time.time()))
+            self._conn.commit()
+
+    def resolve(self, title: str) -> Optional[str]:
+        with self._lock:
+            row = self._conn.execute("SELECT key FROM titles WHERE title = ?",
+                                     (title,)).fetchone()
+        return None if row is None else row[0]
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+def open_table_store(spec: str or pathlib.Path) -> TableStore:
+    """`.sqlite` / `.db` 結尾 → SQLiteTableStore；其餘視為目錄 → DirTableStore。"""
+    spec = pathlib.Path(spec)
+    if spec.suffix in {".sqlite", ".sqlite3", ".db"}:
+        return SQLiteTableStore(spec)
+    return DirTableStore(spec)
@@ -0,0 +1,313 @@
+import json
+import math
+import time
+import pathlib
+import threading
+import contextlib
+import contextvars
+from collections import defaultdict
+from typing import Any, Dict, List, Optional
+
+from utils.tokens import get_counter
+
+# 呼叫當下所屬的 pipeline 階段 / 案件 (asyncio task、thread 各自獨立)
+STAGE: contextvars.ContextVar = contextvars.ContextVar("telemetry_stage", default=None)
+CASE_ID: contextvars.ContextVar = contextvars.ContextVar("telemetry_case_id", default=None)
+# 進行中的單次呼叫紀錄；SCHEDULER 把排隊時間 / 重試次數寫進來
+_CURRENT: contextvars.ContextVar = contextvars.ContextVar("telemetry_call", default=None)
+
+# USD / 1M tokens：(input, cached input, cache write, output)；依 model 名稱前綴比對，越長越優先
+PRICES: Dict[str, tuple] = {
+    "gpt-4o-mini":        (0.15, 0.075, 0.15, 0.60),
+    "gpt-4o":             (2.50, 1.25, 2.50, 10.00),
+    "gpt-4.1-nano":       (0.10, 0.025, 0.10, 0.40),
+    "gpt-4.1-mini":       (0.40, 0.10, 0.40, 1.60),
+    "gpt-4.1":            (2.00, 0.50, 2.00, 8.00),
+    "o3-mini":            (1.10, 0.55, 1.10, 4.40),
+    "o4-mini":            (1.10, 0.275, 1.10, 4.40),
+    "claude-3-haiku":     (0.25, 0.03, 0.30, 1.25),
+    "claude-3-5-haiku":   (0.80, 0.08, 1.00, 4.00),
+    "claude-3-sonnet":    (3.00, 0.30, 3.75, 15.00),
+    "claude-3-5-sonnet":  (3.00, 0.30, 3.75, 15.00),
+    "claude-3-7-sonnet":  (3.00, 0.30, 3.75, 15.00),
+    "claude-sonnet-4":    (3.00, 0.30, 3.75, 15.00),
+    "claude-3-opus":      (15.00, 1.50, 18.75, 75.00),
+    "claude-opus-4":      (15.00, 1.50, 18.75, 75.00),
+    "gemini-2.0-flash":   (0.10, 0.025, 0.10, 0.40),
+    "gemini-1.5-flash":   (0.075, 0.01875, 0.075, 0.30),
+    "gemini-1.5-pro":     (1.25, 0.3125, 1.25, 5.00),
+    "gemini-2.5-flash":   (0.30, 0.075, 0.30, 2.50),
+    "gemini-2.5-pro":     (1.25, 0.31, 1.25, 10.00),
+}
+
+
+def price_for(model: str) -> Optional[tuple]:
+    """→ PRICES 中最長前綴符合的價格；自架模型 (qwen) 或未知模型回傳 None。"""
+    model = (model or "").lower()
+    best = max((k for k in PRICES if model.startswith(k)), key=len, default=None)
+    return PRICES[best] if best else None
+
+
+def estimate_cost(model: str, prompt: int, cached: int = 0, cache_creation: int = 0,
+                  completion: int = 0) -> float:
+    price = price_for(model)
+    if price is None:
+        return 0.0
+    p_in, p_cached, p_write, p_out = price
+    fresh = max(0, prompt - cached - cache_creation)
+    return (fresh * p_in + cached * p_cached + cache_creation * p_write
+            + completion * p_out) / 1e6
+
+
+@contextlib.contextmanager
+def stage(name: str, case_id=None):
+    """`with stage("structurize", idx):` 內發出的 LLM 呼叫都標上階段與案件編號。"""
+    t_stage, t_case = STAGE.set(name), CASE_ID.set(case_id)
+    try:
+        yield
+    finally:
+        STAGE.reset(t_stage)
+        CASE_ID.reset(t_case)
+
+
+def note_wait(seconds: float) -> None:
+    """SCHEDULER 取得額度後呼叫：累計限流排隊時間。"""
+    rec = _CURRENT.get()
+    if rec is not None:
+        rec["queue_wait_s"] += seconds
+
+
+def note_retry() -> None:
+    rec = _CURRENT.get()
+    if rec is not None:
+        rec["retries"] += 1
+
+
+def percentile(values: List[float], q: float) -> Optional[float]:
+    """nearest-rank 百分位；空序列回傳 None。"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    k = max(0, min(len(ordered) - 1, math.ceil(q / 100.0 * len(ordered)) - 1))
+    return ordered[k]
+
+
+class Telemetry:
+    """每次 LLM 呼叫寫一行 JSONL 事件，結束時輸出 p50 / p95 / p99 摘要。"""
+
+    def __init__(self, path: str or pathlib.Path):
+        self.path = pathlib.Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.events: List[Dict[str, Any]] = []
+        self._lock = threading.Lock()
+        self._fh = self.path.open("a", encoding="utf-8")
+
+    @property
+    def summary_path(self) -> pathlib.Path:
+        """`<path>.summary.json` (附加在完整檔名後；run.jsonl.w0 與 .w1 不會撞名)。"""
+        return self.path.with_name(self.path.name + ".summary.json")
+
+    def emit(self, event: Dict[str, Any]) -> None:
+        line = json.dumps(event, ensure_ascii=False, default=str)
+        with self._lock:
+            self.events.append(event)
+            self._fh.write(line + "\n")
+            self._fh.flush()
+
+    def absorb(self, events: List[Dict[str, Any]]) -> None:
+        """併入其他程序 (--workers) 的事件：寫進本檔並計入摘要。"""
+        for event in events:
+            self.emit(event)
+
+    # ------------------------------------------------------------------
+    @staticmethod
+    def _block(events: List[Dict[str, Any]]) -> Dict[str, Any]:
+        out: Dict[str, Any] = {
+            "calls": len(events),
+            "errors": sum(1 for e in events if e.get("error")),
+            "retries": sum(e["retries"] for e in events),
+        }
+        for field in ("latency_s", "queue_wait_s", "ttft_s"):
+            vals = [e[field] for e in events if e.get(field) is not None]
+            out[field] = {f"p{q}": percentile(vals, q) for q in (50, 95, 99)}
+        for field in ("input_tokens", "cached_tokens", "output_tokens", "cost_usd"):
+            out[field] = sum(e.get(field) or 0 for e in events)
+        out["cost_usd"] = round(out["cost_usd"], 6)
+        return out
+
+    def summary(self) -> Dict[str, Any]:
+        with self._lock:
+            events = list(self.events)
+        by_stage = defaultdict(list)
+        for e in events:
+            by_stage[e.get("stage") or "-"].append(e)
+        return {"total": self._block(events),
+                "by_stage": {k: self._block(v) for k, v in sorted(by_stage.items())}}
+
+    def close(self) -> Dict[str, Any]:
+        """關檔並把摘要寫到 `<path>.summary.json`；回傳摘要。"""
+        summary = self.summary()
+        with self._lock:
+            self._fh.close()
+        self.summary_path.write_text(
+            json.dumps(summary, ensure_ascii=False, indent=2), encoding="utf-8")
+        return summary
+
+
+class InstrumentedLLM:
+    """包住 provider client，每次 __call__ / acall / stream / astream 記一筆事件。
+
+    放在 CachedLLM 內層：快取命中不打 API，也就不產生事件。
+    其餘屬性 (model_name, usage_totals …) 直接轉給原本的 llm。
+    """
+
+    def __init__(self, llm, telemetry: Telemetry, provider: Optional[str] = None):
+        self.llm = llm
+        self.telemetry = telemetry
+        self.provider = provider or type(llm).__name__
+
+    def __getattr__(self, name):
+        return getattr(self.llm, name)
+
+    # ------------------------------------------------------------------
+    def _begin(self, mode: str) -> Dict[str, Any]:
+        return {
+            "ts": time.time(),
+            "stage": STAGE.get(),
+            "case_id": CASE_ID.get(),
+            "provider": self.provider,
+            "model": getattr(self.llm, "model_name", ""),
+            "mode": mode,
+            "queue_wait_s": 0.0,
+            "ttft_s": None,
+            "latency_s": None,
+            "input_tokens": 0,
+            "cached_tokens": 0,
+            "cache_creation_tokens": 0,
+            "output_tokens": 0,
+            "retries": 0,
+            "cost_usd": 0.0,
+            "error": None,
+            "_t0": time.monotonic(),
+        }
+
+    def _finish(self, rec: Dict[str, Any], usage: Optional[Dict] = None) -> None:
+        rec["latency_s"] = time.monotonic() - rec.pop("_t0")
+        if usage:
+            rec["input_tokens"] = usage.get("prompt_tokens", 0) or 0
+            rec["cached_tokens"] = usage.get("cached_tokens", 0) or 0
+            rec["cache_creation_tokens"] = usage.get("cache_creation_tokens", 0) or 0
+            rec["output_tokens"] = usage.get("completion_tokens", 0) or 0
+        rec["cost_usd"] = estimate_cost(rec["model"], rec["input_tokens"],
+                                        rec["cached_tokens"], rec["cache_creation_tokens"],
+                                        rec["output_tokens"])
+        self.telemetry.emit(rec)
+
+    def _stream_usage(self, rec, messages, pieces) -> Dict[str, int]:
+        """串流回覆沒有 usage：輸入 / 輸出都以 utils.tokens 估算。"""
+        counter = get_counter(rec["model"])
+        rec["usage_estimated"] = True
+        return {"prompt_tokens": counter.count_messages(messages),
+                "completion_tokens": counter.count("".join(pieces))}
+
+    # ------------------------------------------------------------------
+    def __call__(self, messages, temperature=0.7, max_tokens=2048, **kw):
+        rec = self._begin("call")
+        token = _CURRENT.set(rec)
+        try:
+            resp = self.llm(messages, temperature=temperature, max_tokens=max_tokens, **kw)
+        except Exception as e:
+            rec["error"] = f"{type(e).__name__}: {e}"[:300]
+            self._finish(rec)
+            raise
+        finally:
+            _CURRENT.reset(token)
+        self._finish(rec, resp.get("usage"))
+        return resp
+
+    async def acall(self, messages, temperature=0.7, max_tokens=2048, **kw):
+        rec = self._begin("acall")
+        token = _CURRENT.set(rec)
+        try:
+            resp = await self.llm.acall(messages, temperature=temperature,
+                                        max_tokens=max_tokens, **kw)
+        except Exception as e:
+            rec["error"] = f"{type(e).__name__}: {e}"[:300]
+            self._finish(rec)
+            raise
+        finally:
+            _CURRENT.reset(token)
+        self._finish(rec, resp.get("usage"))
+        return resp
+
+    def stream(self, messages, temperature=0.7, max_tokens=2048, **kw):
+        rec = self._begin("stream")
+        inner = self.llm.stream(messages, temperature=temperature,
+                                max_tokens=max_tokens, **kw)
+        pieces: List[str] = []
+        try:
+            # 只在取第一段 (SCHEDULER 排隊 + 建立連線) 時掛上 _CURRENT，避免漏到呼叫端
+            token = _CURRENT.set(rec)
+            try:
+                first = next(inner, None)
+            finally:
+                _CURRENT.reset(token)
+            rec["ttft_s"] = time.monotonic() - rec["_t0"]
+            if first is not None:
+                pieces.append(first)
+                yield first
+                for piece in inner:
+                    pieces.append(piece)
+                    yield piece
+            rec["completed"] = True
+        except Exception as e:
+            rec["error"] = f"{type(e).__name__}: {e}"[:300]
+            raise
+        finally:
+            inner.close()
+            rec.setdefault("completed", False)
+            self._finish(rec, self._stream_usage(rec, messages, pieces))
+
+    async def astream(self, messages, temperature=0.7, max_tokens=2048, **kw):
+        rec = self._begin("astream")
+        inner = self.llm.astream(messages, temperature=temperature,
+                                 max_tokens=max_tokens, **kw)
+        pieces: List[str] = []
+        try:
+            token = _CURRENT.set(rec)
+            try:
+                first = await inner.__anext__()
+            except StopAsyncIteration:
+                first = None
+            finally:
+                _CURRENT.reset(token)
+            rec["ttft_s"] = time.monotonic() - rec["_t0"]
+            if first is not None:
+                pieces.append(first)
+                yield first
+                async for piece in inner:
+                    pieces.append(piece)
+                    yield piece
+            rec["completed"] = True
+        except Exception as e:
+            rec["error"] = f"{type(e).__name__}: {e}"[:300]
+            raise
+        finally:
+            await inner.aclose()
+            rec.setdefault("completed", False)
+            self._finish(rec, self._stream_usage(rec, messages, pieces))
+
+
+def format_summary(summary: Dict[str, Any]) -> str:
+    """main 結束時印出的一行一階段摘要。"""
+    lines = []
+    for name, blk in [("total", summary["total"])] + list(summary["by_stage"].items()):
+        lat, wait = blk["latency_s"], blk["queue_wait_s"]
+        fmt = lambda v: "-" if v is None else f"{v:.2f}"
+        lines.append(
+            f"{name:<12} calls={blk['calls']} err={blk['errors']} retries={blk['retries']} "
+            f"latency p50/p95/p99={fmt(lat['p50'])}/{fmt(lat['p95'])}/{fmt(lat['p99'])}s "
+            f"wait p95={fmt(wait['p95'])}s "
+            f"tokens in/cached/out={blk['input_tokens']}/{blk['cached_tokens']}/{blk['output_tokens']} "
+            f"cost=${blk['cost_usd']:.4f}")
+    return "\n".join(lines)
@@ -0,0 +1,169 @@
+import os
+import bisect
+import hashlib
+import itertools
+import threading
+from collections import OrderedDict, deque
+from typing import Dict, List, Optional
+
+# HF tokenizer 路徑 (Qwen / 自架模型)；未設定時改用估算器
+TOKENIZER_ENV = "STRUCTRAG_TOKENIZER"
+LEGACY_TOKENIZER_PATH = "/mnt/data/lizhuoqun/hf_models/gpt2"
+
+# 估算器權重 (tokens / char)：中文 (非 ASCII) 約 1 字 1 token，英數約 4 字 1 token。
+# 寧可高估，截斷後才不會超出 context。
+CJK_WEIGHT = 1.0
+ASCII_WEIGHT = 0.3
+MESSAGE_OVERHEAD = 4     # chat template 每段 message 的額外 token
+# 校正：scale = 最近 CALIBRATION_WINDOW 次 (實際 / 估算) 的最大值 × CALIBRATION_MARGIN。
+# 取最大值而非平均，校正後仍是高估；舊的高比例移出視窗後才會慢慢降回來。
+CALIBRATION_WINDOW = 64
+CALIBRATION_MARGIN = 1.1
+
+
+class TokenCounter:
+    """計算 / 截斷 token；tokenizer 第一次用到才載入，載不到就用估算器。
+
+    - count(text)：依 text hash 快取結果 (靜態 prompt 前綴每次呼叫只算一次)
+    - truncate(text, budget)：一次完成，不需多次來回試
+    - observe(messages, actual)：以 API 回報的 prompt_tokens 校正估算器比例
+    """
+
+    def __init__(self, model_name: str = "", tokenizer_path: Optional[str] = None,
+                 cache_size: int = 4096):
+        self.model_name = model_name or ""
+        self.tokenizer_path = tokenizer_path
+        self.cache_size = cache_size
+        self.scale = 1.0                      # 估算器校正係數
+        self._ratios: "deque[float]" = deque(maxlen=CALIBRATION_WINDOW)
+        self._backend = None                  # "tiktoken" / "hf" / "estimate"
+        self._tok = None
+        self._cache: "OrderedDict[tuple, int]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    # ------------------------------------------------------------------
+    def _load(self) -> None:
+        if self._backend is not None:
+            return
+        name = self.model_name.lower()
+        if name.startswith(("gpt-", "o1", "o3", "o4", "chatgpt")):
+            try:
+                import tiktoken
+                try:
+                    self._tok = tiktoken.encoding_for_model(self.model_name)
+                except KeyError:
+                    self._tok = tiktoken.get_encoding("o200k_base")
+                self._backend = "tiktoken"
+                return
+            except ImportError:
+                pass
+        path = self.tokenizer_path or os.getenv(TOKENIZER_ENV)
+        if path is None and "qwen" in name and os.path.exists(LEGACY_TOKENIZER_PATH):
+            path = LEGACY_TOKENIZER_PATH
+        if path:
+            try:
+                from transformers import AutoTokenizer
+                self._tok = AutoTokenizer.from_pretrained(path)
+                self._backend = "hf"
+                return
+            except Exception as e:
+                print(f"⚠️ tokenizer {path} 載入失敗，改用估算器: {e}")
+        self._backend = "estimate"
+
+    @property
+    def backend(self) -> str:
+        self._load()
+        return self._backend
+
+    # ------------------------------------------------------------------
+    def _estimate(self, text: str) -> int:
+        n_ascii = len(text.encode("ascii", "ignore"))
+        raw = (len(text) - n_ascii) * CJK_WEIGHT + n_ascii * ASCII_WEIGHT
+        return int(raw * self.scale + 0.999)
+
+    def _count_uncached(self, text: str) -> int:
+        self._load()
+        if self._backend == "tiktoken":
+            return len(self._tok.encode(text, disallowed_special=()))
+        if self._backend == "hf":
+            return len(self._tok(text, add_special_tokens=False)["input_ids"])
+        return self._estimate(text)
+
+    def count(self, text: str) -> int:
+        if not text:
+            return 0
+        key = (len(text), hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest())
+        with self._lock:
+            n = self._cache.get(key)
+            if n is not None:
+                self._cache.move_to_end(key)
+                return n
+        n = self._count_uncached(text)
+        with self._lock:
+            self._cache[key] = n
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return n
+
+    def count_messages(self, messages: List[Dict]) -> int:
+        return sum(self.count(str(m.get("content", ""))) + MESSAGE_OVERHEAD
+                   for m in messages)
+
+    # ------------------------------------------------------------------
+    def truncate(self, text: str, budget: int) -> str:
+        """保留開頭、截到最多 *budget* tokens；一次完成。"""
+        if budget <= 0:
+            return ""
+        if self.count(text) <= budget:
+            return text
+        self._load()
+        if self._backend == "tiktoken":
+            return self._tok.decode(self._tok.encode(text, disallowed_special=())[:budget])
+        if self._backend == "hf":
+            enc = self._tok(text, add_special_tokens=False, return_offsets_mapping=True)
+            return text[:enc["offset_mapping"][budget - 1][1]]
+        # 估算器：逐字累積權重後二分搜尋切點
+        weights = (CJK_WEIGHT if ord(c) > 127 else ASCII_WEIGHT for c in text)
+        cum = list(itertools.accumulate(w * self.scale for w in weights))
+        return text[:bisect.bisect_right(cum, budget)]
+
+    def fit_messages(self, messages: List[Dict], budget: int) -> List[Dict]:
+        """總長超過 budget 時只截最後一段 user message（裁定書本文所在）。"""
+        total = self.count_messages(messages)
+        if total <= budget:
+            return messages
+        last = max(i for i, m in enumerate(messages) if m.get("role") == "user")
+        content = str(messages[last]["content"])
+        keep = self.count(content) - (total - budget)
+        print(f"input {total} tokens > {budget}; truncate message {last} to {max(keep, 0)} tokens")
+        fitted = list(messages)
+        fitted[last] = dict(messages[last], content=self.truncate(content, keep))
+        return fitted
+
+    def observe(self, messages: List[Dict], actual_prompt_tokens: int) -> None:
+        """用實際 prompt_tokens 校正估算器 (取近期比例的上緣)；真 tokenizer 不需校正。"""
+        if self.backend != "estimate" or not actual_prompt_tokens:
+            return
+        raw = sum(self._estimate(str(m.get("content", ""))) / self.scale
+                  for m in messages)
+        if raw <= 0:
+            return
+        self._ratios.append(actual_prompt_tokens / raw)
+        new_scale = max(self._ratios) * CALIBRATION_MARGIN
+        if abs(new_scale - self.scale) > 0.01:
+            with self._lock:
+                self._cache.clear()        # 比例變了，估算快取作廢
+        self.scale = new_scale
+
+
+_COUNTERS: Dict[str, TokenCounter] = {}
+_COUNTERS_LOCK = threading.Lock()
+
+
+def get_counter(model_name: str = "") -> TokenCounter:
+    """每個 model 共用一個 TokenCounter (tokenizer 與快取只建一次)。"""
+    with _COUNTERS_LOCK:
+        counter = _COUNTERS.get(model_name)
+        if counter is None:
+            counter = _COUNTERS[model_name] = TokenCounter(model_name)
+        return counter